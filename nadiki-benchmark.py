@@ -0,0 +1,737 @@
+#!env python3
+#
+# Benchmarks of the Nadiki scripts with synthetic load and stub servers
+#
+# The processors are fed with metrics of nadiki_loadgen.py through stdin, the
+# crawlers poll the stubs of nadiki_stubs.py on SIGHUP and the ingester posts to
+# the stub of the Proton ingest API (ingester-native: inserts into the stub of the
+# native protocol). For every script, the benchmark reports
+#
+#   - lines_per_sec: input lines (crawlers: output lines) per second
+#   - p50_ms, p99_ms: latency per output line, from writing the input line which
+#     caused it (crawlers: from the SIGHUP) until it was read from stdout (ingester:
+#     until the stub received it)
+#   - peak_rss_mb: maximum resident set size of the script
+#   - correct: whether the output matches a reference (see the check_* functions)
+#
+# server-processor-replay runs the processor with --replay on a file, its lines_per_sec
+# and mb_per_sec include the start of the script.
+#
+# ingester-transports compares the two transports of the ingester at several batch
+# sizes by rows_per_sec and cpu_us_per_row (CPU time of the ingester per row),
+# ingester-workers the lines per second with 0 to 4 parse workers (PROTON_PARSE_WORKERS).
+#
+# and the results are saved as JSON (by default in nadiki-benchmark-results.json in the
+# temporary directory, not in the working tree), so they can be compared with an earlier run:
+#
+#   python3 nadiki-benchmark.py --output before.json
+#   python3 nadiki-benchmark.py --output after.json --compare before.json
+#
+# --targets selects the scripts (see TARGETS), --scale multiplies the amount of
+# data and --rate paces the input of the processors (lines per second, default:
+# as fast as possible, which makes the latency mostly queueing time).
+#
+
+import argparse
+import collections
+import copy
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from nadiki_counters import CounterDiff
+from nadiki_energy import EnergyIntegrator
+from nadiki_lineprotocol import format_line, parse_line, parse_lines
+from nadiki_loadgen import LoadGenerator
+from nadiki_stubs import (ElectricityMapsData, ElectricityMapsHandler, ProtonIngestHandler, ProtonNativeServer,
+    RecordingServer, VictoriaMetricsData, VictoriaMetricsHandler, ZabbixData, ZabbixHandler)
+
+
+def load_script(name, env):
+    # import a script with a hyphenated name as module, with the environment it would run with
+    saved = dict(os.environ)
+    os.environ.update(env)
+    try:
+        spec = importlib.util.spec_from_file_location(name.replace("-", "_").replace(".py", ""), os.path.join(HERE, name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def percentile(values, q):
+    # values must be sorted
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+class Child:
+    """
+    A script started with pipes, the lines of its stdout are collected with their arrival time by a thread
+    """
+
+    def __init__(self, script, env, directory, stdin=True, unbuffered=False, arguments=()):
+        self.stderr = open(os.path.join(directory, f"{script}.stderr"), "w+")
+        args = [sys.executable] + (["-u"] if unbuffered else []) + [os.path.join(HERE, script)] + list(arguments)
+        # the metrics are still counted, but their reports would be mixed into the output which is checked
+        env = {**os.environ, "PYTHONPATH": HERE, "NADIKI_METRICS_INTERVAL": "0", **env}
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=self.stderr, env=env, cwd=directory)
+        self.output = []  # (monotonic time, line)
+        self.peak_rss = 0  # kB
+        self.cpu_seconds = 0.0  # user and system time, as of the last check before the exit
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.output.append((time.monotonic(), line))
+
+    def _monitor(self):
+        # the peak RSS since the exec (the rusage of the child would include the memory of this
+        # process, which the child shares until it calls exec) and the CPU time, read until the child exits
+        ticks = os.sysconf("SC_CLK_TCK")
+        while self.proc.returncode is None:
+            try:
+                with open(f"/proc/{self.proc.pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            self.peak_rss = max(self.peak_rss, int(line.split()[1]))
+                with open(f"/proc/{self.proc.pid}/stat") as f:
+                    stat = f.read().rsplit(")", 1)[1].split()
+                self.cpu_seconds = (int(stat[11]) + int(stat[12])) / ticks
+            except (OSError, ValueError, IndexError):
+                return
+            time.sleep(0.02)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the end of the output and the exit of the script
+
+        Returns:
+            float: peak RSS in MB
+        """
+        self.reader.join(timeout)
+        self.proc.wait(timeout)
+        return self.peak_rss / 1024
+
+    def stop(self):
+        # terminate an execd script which runs forever
+        self.proc.terminate()
+        return self.wait(10)
+
+    def errors(self):
+        self.stderr.seek(0)
+        return self.stderr.read()[-2000:]
+
+    def handles(self, signum):
+        # whether the script has installed a handler for the signal (Linux only)
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith("SigCgt:"):
+                        return bool(int(line.split()[1], 16) >> (signum - 1) & 1)
+        except OSError:
+            pass
+        return False
+
+
+def feed(child, lines, timestamps, rate):
+    """
+    Write the lines to the stdin of a child, at most rate lines per second
+
+    Returns:
+        dict: timestamp -> monotonic time at which the last line with this timestamp was written
+    """
+    sent = {}
+    chunk = max(1, int(rate / 100)) if rate else 1000
+    start = time.monotonic()
+    for i in range(0, len(lines), chunk):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.monotonic()
+        for ts in timestamps[i:i + chunk]:
+            sent[ts] = now
+        child.proc.stdin.write("".join(lines[i:i + chunk]).encode("utf-8"))
+        child.proc.stdin.flush()
+    child.proc.stdin.close()
+    return sent
+
+
+def compare(output, reference):
+    """
+    Compare output lines with reference lines regardless of their order
+    """
+    got = collections.Counter(output)
+    expected = collections.Counter(reference)
+    missing = sum((expected - got).values())
+    unexpected = sum((got - expected).values())
+    return {"correct": missing == 0 and unexpected == 0, "missing": missing, "unexpected": unexpected}
+
+
+#
+# processors
+#
+
+def run_processor(script, env, gen, ticks, args, reference, trigger=lambda line, ts: ts):
+    """
+    Feed the lines of ticks ticks to a processor and measure it
+
+    Args:
+        trigger (callable): timestamp of the input line which caused an output line, from the output line and
+            its timestamp; output caused by the end of the input is measured from the last line
+    """
+    lines = []
+    timestamps = []
+    for tick in range(ticks):
+        for (i, line) in enumerate(gen.tick(tick)):
+            lines.append(line + "\n")
+            timestamps.append(gen.timestamp(tick, i))
+    expected = reference(lines)
+    with tempfile.TemporaryDirectory() as directory:
+        if gen.pod_labels:
+            with open(os.path.join(directory, "crictl-ps.json"), "w") as f:
+                json.dump(gen.crictl_json(), f)
+            env = {"POD_LABELS_FILE": os.path.join(directory, "crictl-ps.json"), **env}
+        child = Child(script, env, directory, unbuffered=args.unbuffered)
+        start = time.monotonic()
+        sent = feed(child, lines, timestamps, args.rate)
+        peak_rss = child.wait()
+        if child.proc.returncode != 0:
+            return {"error": f"exit status {child.proc.returncode}: {child.errors()}"}
+        end = child.output[-1][0] if child.output else time.monotonic()
+    output = [line.decode("utf-8").rstrip("\n") for (_, line) in child.output]
+    last = max(sent.values()) if sent else 0.0
+    latencies = sorted(t - sent.get(trigger(line, int(line.rsplit(b" ", 1)[1])), last) for (t, line) in child.output)
+    return {
+        "lines_in": len(lines),
+        "lines_out": len(output),
+        "seconds": round(end - start, 3),
+        "lines_per_sec": round(len(lines) / (end - start), 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "peak_rss_mb": round(peak_rss, 1),
+        **compare(output, expected),
+    }
+
+
+def energy_reference(lines):
+    # the streaming path of the processor, in this process
+    engine = EnergyIntegrator()
+    result = []
+    for line in lines:
+        metric = engine.process(*parse_line(line))
+        if metric is not None:
+            result.append(format_line(*metric))
+    result.extend(format_line(*metric) for metric in engine.flush())
+    return result
+
+
+def energy_generator(args):
+    return LoadGenerator(servers=args.servers, sensors=4, packages=2, gpus=args.gpus, interval=10)
+
+
+def bench_server_processor(args, batch_window=0):
+    gen = energy_generator(args)
+    env = {"ENERGY_BATCH_WINDOW": str(batch_window), "ENERGY_STATS_INTERVAL": "0"}
+    # the energy of a reading is emitted with its timestamp when the next reading arrives, the
+    # totals of the packages and GPUs of a server when the reading after that arrives
+    return run_processor("nadiki-server-telegraf-processor.py", env, gen, args.ticks, args, energy_reference,
+        trigger=lambda line, ts: ts + gen.interval_ns * (1 if line.startswith(b"server,") and b" server_" in line else 2))
+
+
+def bench_server_processor_batch(args):
+    return bench_server_processor(args, batch_window=0.05)
+
+
+def bench_server_processor_replay(args):
+    # the processor with --replay on a file of 4 times the ticks of server-processor; the output must
+    # be the same as that of the streaming path, in the same order
+    gen = energy_generator(args)
+    lines = [line + "\n" for tick in range(4 * args.ticks) for line in gen.tick(tick)]
+    expected = energy_reference(lines)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dump.lp")
+        with open(path, "w") as f:
+            f.writelines(lines)
+        size = os.path.getsize(path)
+        start = time.monotonic()
+        child = Child("nadiki-server-telegraf-processor.py", {}, directory, stdin=False, arguments=["--replay", path])
+        peak_rss = child.wait()
+        seconds = time.monotonic() - start
+        if child.proc.returncode != 0:
+            return {"error": f"exit status {child.proc.returncode}: {child.errors()}"}
+        summary = child.errors().strip().splitlines()[-1:]
+    output = [line.decode("utf-8").rstrip("\n") for (_, line) in child.output]
+    return {
+        "lines_in": len(lines),
+        "lines_out": len(output),
+        "seconds": round(seconds, 3),
+        "lines_per_sec": round(len(lines) / seconds, 1),
+        "mb_per_sec": round(size / 10**6 / seconds, 1),
+        "peak_rss_mb": round(peak_rss, 1),
+        "summary": summary[0] if summary else None,
+        "ordered": output == expected,
+        **compare(output, expected),
+    }
+
+
+def bench_cadvisor_processor(args):
+    gen = LoadGenerator(servers=args.servers, sensors=0, packages=0, pods=args.pods, unknown_pods=args.pods // 100)
+
+    def reference(lines):
+        result = []
+        for line in lines:
+            (measurement, tags, fields, ts) = parse_line(line)
+            # the lines of unknown pods are passed on without labels
+            labels = gen.pod_labels.get(tags["id"].rsplit("cri-containerd-", 1)[1].split(".")[0], {})
+            result.append(format_line(measurement, {**tags, **labels}, fields, ts))
+        return result
+
+    return run_processor("nadiki-server-cadvisor-processor.py", {}, gen, args.ticks, args, reference)
+
+
+def diff_star(key_tags, calculate_ratio, invert):
+    """
+    The Starlark script diff.star, which the counter processor replaced, ported to Python:
+    the key is joined from strings and the state is a deep copy of the last metric
+
+    Returns:
+        callable: apply() of the script for metrics as dicts with name, tags, fields and time
+    """
+    state = {}
+
+    def apply(metric):
+        key = "-".join([metric["name"]] + list(metric["fields"]) + [metric["tags"].get(x, "") for x in key_tags])
+        last_metric = state.get(key)
+        result = None
+        if last_metric is not None:
+            result = copy.deepcopy(metric)
+            for f in metric["fields"]:
+                divisor = 1
+                if calculate_ratio:
+                    divisor = (metric["time"] - last_metric["time"]) / 1000000000
+                if invert:
+                    result["fields"][f] = 1 - (metric["fields"][f] - last_metric["fields"][f]) / divisor
+                else:
+                    result["fields"][f] = (metric["fields"][f] - last_metric["fields"][f]) / divisor
+        state[key] = copy.deepcopy(metric)
+        return result
+
+    return apply
+
+
+def bench_counter_processor(args):
+    # one node with many cores and devices, all node_* series are counters
+    gen = LoadGenerator(servers=1, sensors=0, packages=0, node_metrics=args.node_series)
+    key_tags = ["instance", "cpu", "device"]
+    env = {"DIFF_KEY_TAGS": ",".join(key_tags), "DIFF_CALCULATE_RATIO": "true", "DIFF_INVERT": "false"}
+    speeds = {}
+
+    def reference(lines):
+        # diff.star and the engine of the processor in this process, without the pipes
+        start = time.perf_counter()
+        apply = diff_star(key_tags, True, False)
+        result = []
+        for line in lines:
+            (measurement, tags, fields, ts) = parse_line(line)
+            metric = apply({"name": measurement, "tags": tags, "fields": fields, "time": ts})
+            if metric is not None:
+                result.append(format_line(metric["name"], metric["tags"], metric["fields"], metric["time"]))
+        speeds["diff_star_lines_per_sec"] = round(len(lines) / (time.perf_counter() - start), 1)
+        start = time.perf_counter()
+        engine_lines = CounterDiff(key_tags, calculate_ratio=True).process_batch(parse_lines("".join(lines)))
+        speeds["engine_lines_per_sec"] = round(len(lines) / (time.perf_counter() - start), 1)
+        speeds["engine_matches_diff_star"] = engine_lines == result
+        return result
+
+    result = run_processor("nadiki-counter-diff-processor.py", env, gen, args.ticks, args, reference)
+    return {**result, **speeds}
+
+
+def ingester_load(args):
+    # lines for the ingester and the (stream, timestamp) pairs which must arrive
+    gen = LoadGenerator(servers=args.servers, sensors=0, packages=0, node_metrics=args.node_metrics)
+    with open(os.path.join(HERE, "nadiki-proton-config.json")) as f:
+        streams = json.load(f)["streams"]
+    lines = []
+    timestamps = []
+    for tick in range(args.ticks):
+        for (i, line) in enumerate(gen.tick(tick)):
+            lines.append(line + "\n")
+            timestamps.append(gen.timestamp(tick, i))
+    expected = [(line.split(",", 1)[0], ts) for (line, ts) in zip(lines, timestamps) if line.split(",", 1)[0] in streams]
+    return (lines, timestamps, expected)
+
+
+def run_ingester(args, lines, timestamps, expected, transport="http", env=None):
+    """
+    Feed the lines to the ingester, which sends them to the stub of the ingest API
+    (transport http) or of the native protocol (transport native)
+    """
+    env = {"PROTON_QUERY_MODE": "off", "PROTON_FLUSH_INTERVAL": "0.2", **(env or {})}
+    if transport == "native":
+        server = ProtonNativeServer(latency=args.stub_latency)
+        env.update({"PROTON_INGEST_TRANSPORT": "native", "PROTON_HOST": server.host, "PROTON_NATIVE_PORT": str(server.port)})
+    else:
+        server = RecordingServer(ProtonIngestHandler, latency=args.stub_latency)
+        env["PROTON_INGEST_URL"] = server.url + "/proton/v1/ingest/streams/"
+    with server, tempfile.TemporaryDirectory() as directory:
+        child = Child("nadiki-telegraf-to-proton-ingester.py", env, directory)
+        start = time.monotonic()
+        sent = feed(child, lines, timestamps, args.rate)
+        peak_rss = child.wait()
+        if child.proc.returncode != 0:
+            return {"error": f"exit status {child.proc.returncode}: {child.errors()}"}
+        if transport == "native":
+            received = [(r.stream, ts, r.received) for r in server.inserts for ts in r.column("timestamp")]
+            requests = len(server.inserts)
+        else:
+            received = []
+            for request in server.accepted():
+                body = request.json()
+                column = body["columns"].index("timestamp")
+                stream = request.path.rsplit("/", 1)[1]
+                received.extend((stream, int(row[column]), request.received) for row in body["data"])
+            requests = len(server.accepted())
+    latencies = sorted(r - sent[ts] for (_, ts, r) in received)
+    end = max((r for (_, _, r) in received), default=time.monotonic())
+    return {
+        "lines_in": len(lines),
+        "rows_received": len(received),
+        "requests": requests,
+        "seconds": round(end - start, 3),
+        "lines_per_sec": round(len(lines) / (end - start), 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "peak_rss_mb": round(peak_rss, 1),
+        "cpu_seconds": child.cpu_seconds,
+        **compare([(stream, ts) for (stream, ts, _) in received], expected),
+    }
+
+
+def bench_ingester(args, transport="http"):
+    (lines, timestamps, expected) = ingester_load(args)
+    result = run_ingester(args, lines, timestamps, expected, transport)
+    result.pop("cpu_seconds", None)
+    return result
+
+
+def bench_ingester_native(args):
+    return bench_ingester(args, "native")
+
+
+def bench_ingester_workers(args):
+    # lines per second of the ingester with the lines parsed by 0 (in the main thread), 1, 2 and 4 worker
+    # processes; cpu_seconds is the CPU time of the ingester process without its workers, i.e. what is
+    # left for the process which cannot be sharded
+    (lines, timestamps, expected) = ingester_load(args)
+    results = {}
+    correct = True
+    for workers in (0, 1, 2, 4):
+        result = run_ingester(args, lines, timestamps, expected, env={"PROTON_PARSE_WORKERS": str(workers)})
+        if "error" in result:
+            return result
+        correct = correct and result["correct"]
+        results[f"workers_{workers}"] = {k: result[k] for k in ("lines_per_sec", "p99_ms", "peak_rss_mb", "cpu_seconds")}
+    return {"lines_in": len(lines), "cpus": os.cpu_count(), "correct": correct, **results}
+
+
+def bench_ingester_transports(args):
+    # rows per second and CPU time of the ingester per row, for both transports and several
+    # batch sizes; the CPU time of starting the ingester (measured without input) is subtracted
+    (lines, timestamps, expected) = ingester_load(args)
+    results = {}
+    correct = True
+    for transport in ("http", "native"):
+        idle = run_ingester(args, [], [], [], transport)
+        for batch_size in (100, 1000, 10000):
+            result = run_ingester(args, lines, timestamps, expected, transport, {"PROTON_BATCH_SIZE": str(batch_size)})
+            if "error" in result:
+                return result
+            correct = correct and result["correct"]
+            results[f"{transport}_{batch_size}"] = {
+                "rows_per_sec": round(result["rows_received"] / result["seconds"], 1),
+                "cpu_us_per_row": round((result["cpu_seconds"] - idle["cpu_seconds"]) / max(1, result["rows_received"]) * 1e6, 2),
+                "requests": result["requests"],
+                "p99_ms": result["p99_ms"],
+            }
+    return {"lines_in": len(lines), "correct": correct, **results}
+
+
+#
+# crawlers
+#
+
+def run_crawler(script, env, args, check, directory):
+    """
+    Start a crawler, trigger args.polls polls with SIGHUP (args.poll_interval seconds apart)
+    and check its output
+
+    Args:
+        check (callable): called with the output lines, returns a dict with at least "correct"
+    """
+    child = Child(script, env, directory, stdin=False, unbuffered=True)
+    deadline = time.monotonic() + 30
+    while not child.handles(signal.SIGHUP):
+        if child.proc.poll() is not None or time.monotonic() > deadline:
+            child.stop()
+            return {"error": f"the crawler did not start: {child.errors()}"}
+        time.sleep(0.05)
+    latencies = []
+    busy = 0.0
+    for poll in range(args.polls):
+        if poll:
+            time.sleep(args.poll_interval)
+        seen = len(child.output)
+        start = time.monotonic()
+        os.kill(child.proc.pid, signal.SIGHUP)
+        # the poll is over when no more lines arrive for a while
+        quiet = max(0.5, 10 * args.stub_latency)
+        while True:
+            count = len(child.output)
+            time.sleep(quiet)
+            if len(child.output) == count and (count > seen or time.monotonic() - start > 5 * quiet):
+                break
+        new = child.output[seen:]
+        latencies.extend(t - start for (t, _) in new)
+        busy += (new[-1][0] - start) if new else 0.0
+    peak_rss = child.stop()
+    output = [line.decode("utf-8").rstrip("\n") for (_, line) in child.output]
+    latencies.sort()
+    return {
+        "polls": args.polls,
+        "lines_out": len(output),
+        "seconds": round(busy, 3),
+        "lines_per_sec": round(len(output) / busy, 1) if busy else None,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "peak_rss_mb": round(peak_rss, 1),
+        **check(output),
+    }
+
+
+def point(line):
+    # (measurement and tags, field, value, timestamp) of a crawler line with one field
+    (head, field, ts) = line.rsplit(" ", 2)
+    (name, value) = field.split("=", 1)
+    return head, name, float(value), int(ts)
+
+
+def check_series(output, expected_value, step_ns=None):
+    """
+    No point may be output twice, the values must match the stub and (with step_ns)
+    the points of a series must not have gaps
+    """
+    series = collections.defaultdict(list)
+    wrong = 0
+    for line in output:
+        (head, name, value, ts) = point(line)
+        series[(head, name)].append(ts)
+        if value != expected_value(head, name, ts):
+            wrong += 1
+    duplicates = sum(len(v) - len(set(v)) for v in series.values())
+    gaps = 0
+    if step_ns:
+        for timestamps in series.values():
+            timestamps.sort()
+            gaps += sum(1 for (a, b) in zip(timestamps, timestamps[1:]) if b - a > step_ns)
+    return {"correct": not (wrong or duplicates or gaps) and bool(output), "series": len(series),
+        "wrong_values": wrong, "duplicates": duplicates, "gaps": gaps}
+
+
+def bench_zabbix_crawler(args, mode="lastvalue"):
+    env = {"SEVERIUS_DC_PREFIX": "NL3", "ZABBIX_USERNAME": "nadiki", "ZABBIX_PASSWORD": "secret",
+        "TAG_COUNTRY_CODE": "NL", "TAG_FACILITY_ID": "ams1", "ZABBIX_MODE": mode,
+        "ZABBIX_BACKFILL_HOURS": str(args.zabbix_hours), "ZABBIX_MAX_SAMPLES": "10000000"}
+    crawler = load_script("nadiki-facility-zabbix-crawler.py", env)
+    keys = [desc["zabbix_key"] for desc in crawler.METRIC_MAP.values()]
+    # the host has many more items than the crawler needs
+    data = ZabbixData(keys + [f"other_item_{i}" for i in range(args.zabbix_items)], interval=1)
+    itemids = {item["key_"]: itemid for (itemid, item) in data.items.items()}
+
+    def expected_value(head, name, ts):
+        return data.value(itemids[crawler.METRIC_MAP[name]["zabbix_key"]], ts // 10**9)
+
+    with RecordingServer(ZabbixHandler, latency=args.stub_latency) as server, tempfile.TemporaryDirectory() as directory:
+        server.zabbix = data
+        env = {**env, "ZABBIX_URL": server.url + "/api_jsonrpc.php",
+            "ZABBIX_CHECKPOINT_FILE": os.path.join(directory, "checkpoint.json")}
+        result = run_crawler("nadiki-facility-zabbix-crawler.py", env, args,
+            lambda output: check_series(output, expected_value, 10**9 if mode == "history" else None), directory)
+        result["requests"] = len(server.requests)
+    return result
+
+
+def bench_zabbix_crawler_history(args):
+    return bench_zabbix_crawler(args, mode="history")
+
+
+def bench_victoriametrics_crawler(args):
+    # every series has a point per second, the first poll exports the last hour
+    instances = [f"10.0.{i // 250}.{i % 250 + 1}:9100" for i in range(max(1, args.servers // 10))]
+    data = VictoriaMetricsData(instances, series_per_instance=4, interval=1)
+    metrics = ["node_network_transmit_bytes_total", "node_network_receive_bytes_total", "node_disk_read_bytes_total"]
+    index = {f"srv{i:05d}": i for i in range(len(instances))}
+
+    def expected_value(head, name, ts):
+        tags = dict(tag.split("=", 1) for tag in head.split(",")[1:])
+        return data.value(index[tags["server_id"]], int(tags["device"][3:]), ts // 10**6)
+
+    with RecordingServer(VictoriaMetricsHandler, latency=args.stub_latency) as server, tempfile.TemporaryDirectory() as directory:
+        server.victoriametrics = data
+        with open(os.path.join(directory, "server-ids.json"), "w") as f:
+            json.dump({instance: f"srv{i:05d}" for (i, instance) in enumerate(instances)}, f)
+        env = {"VICTORIA_METRICS_URL": server.url, "VICTORIA_METRICS_METRICS": ",".join(metrics),
+            "TAG_SERVER_ID_MAPPING_FILE": os.path.join(directory, "server-ids.json"),
+            "TAG_COUNTRY_CODE": "NL", "TAG_FACILITY_ID": "ams1", "TAG_RACK_ID": "r01",
+            "VM_CHECKPOINT_FILE": os.path.join(directory, "checkpoint.json")}
+        result = run_crawler("nadiki-victoriametrics-crawler.py", env, args,
+            lambda output: check_series(output, expected_value, 10**9), directory)
+        result["requests"] = len(server.requests)
+    return result
+
+
+def bench_electricitymap_crawler(args):
+    data = ElectricityMapsData(missing_every=5)
+    zones = [{"zone": f"Z{i:03d}", "tags": {"country_code": f"Z{i:03d}", "facility_id": f"fac{i}"}} for i in range(args.zones)]
+    fields = {"grid_emission_factor_grams": "carbon-intensity", "grid_renewable_percentage": "power-breakdown"}
+
+    def expected_value(head, name, ts):
+        zone = dict(tag.split("=", 1) for tag in head.split(",")[1:])["country_code"]
+        return data.value(fields[name], zone, ts // 10**9)
+
+    def check(output):
+        result = check_series(output, expected_value)
+        # every zone has 24 hours of carbon intensity and the renewable percentage of the hours which have one
+        end = int(time.time()) // 3600 * 3600
+        hours = range(end - 23 * 3600, end + 1, 3600)
+        expected = len(zones) * (len(hours) + sum(1 for h in hours if h // 3600 % data.missing_every))
+        result["expected_lines"] = expected
+        result["correct"] = result["correct"] and len(output) == expected
+        return result
+
+    with RecordingServer(ElectricityMapsHandler, latency=args.stub_latency) as server, tempfile.TemporaryDirectory() as directory:
+        server.electricitymaps = data
+        env = {"ELECTRICITYMAP_MODE": "execd", "ELECTRICITYMAP_URL": server.url + "/v3", "ELECTRICITYMAP_AUTH_TOKEN": "token",
+            "ELECTRICITYMAP_ZONES": json.dumps(zones), "ELECTRICITYMAP_CACHE_TTL": "0", "ELECTRICITYMAP_RATE": "1000",
+            "ELECTRICITYMAP_CHECKPOINT_FILE": os.path.join(directory, "checkpoint.json")}
+        result = run_crawler("nadiki-facility-electricitymap-crawler.py", env, args, check, directory)
+        result["requests"] = len(server.requests)
+    return result
+
+
+TARGETS = {
+    "server-processor": bench_server_processor,
+    "server-processor-batch": bench_server_processor_batch,
+    "server-processor-replay": bench_server_processor_replay,
+    "cadvisor-processor": bench_cadvisor_processor,
+    "counter-processor": bench_counter_processor,
+    "ingester": bench_ingester,
+    "ingester-native": bench_ingester_native,
+    "ingester-transports": bench_ingester_transports,
+    "ingester-workers": bench_ingester_workers,
+    "zabbix-crawler": bench_zabbix_crawler,
+    "zabbix-crawler-history": bench_zabbix_crawler_history,
+    "victoriametrics-crawler": bench_victoriametrics_crawler,
+    "electricitymap-crawler": bench_electricitymap_crawler,
+}
+
+
+def regressions(previous, results, args):
+    """
+    Targets which got slower by more than args.tolerance (a fraction) or whose output is no longer correct
+
+    The speed is only compared if both runs used the same load.
+    """
+    found = []
+    load = ("scale", "rate", "unbuffered", "stub_latency", "polls", "poll_interval")
+    same_load = all(previous.get("args", {}).get(k) == getattr(args, k) for k in load)
+    if not same_load:
+        print(f"the previous run used a different load ({', '.join(load)}), only comparing the correctness", file=sys.stderr)
+    for (target, result) in results.items():
+        old = previous.get("results", {}).get(target)
+        if old is None or "error" in old:
+            continue
+        if "error" in result:
+            found.append(f"{target}: {result['error'][:200]}")
+            continue
+        if old.get("correct") and not result.get("correct"):
+            found.append(f"{target}: the output is no longer correct")
+        if same_load and old.get("lines_per_sec") and result.get("lines_per_sec") is not None:
+            ratio = result["lines_per_sec"] / old["lines_per_sec"]
+            print(f"{target}: {old['lines_per_sec']} -> {result['lines_per_sec']} lines/s ({ratio:.2f}x), "
+                f"p99 {old.get('p99_ms')} -> {result.get('p99_ms')} ms", file=sys.stderr)
+            if ratio < 1 - args.tolerance:
+                found.append(f"{target}: {ratio:.2f}x the lines per second of the previous run")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Nadiki scripts with synthetic load and stub servers")
+    parser.add_argument("--targets", default=",".join(TARGETS), help=f"comma separated, any of {', '.join(TARGETS)}")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number of ticks, servers, pods, zones and counter series")
+    parser.add_argument("--rate", type=float, default=0, help="input lines per second for the processors, 0: as fast as possible")
+    parser.add_argument("--unbuffered", action="store_true", help="run the processors with python3 -u")
+    parser.add_argument("--stub-latency", type=float, default=0.005, help="seconds the stub servers wait before responding")
+    parser.add_argument("--polls", type=int, default=5, help="polls per crawler")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between two polls")
+    parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "nadiki-benchmark-results.json"),
+        help="file for the results (default: %(default)s)")
+    parser.add_argument("--compare", help="results of an earlier run, regressions make the exit status 1")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed loss of lines per second in --compare")
+    args = parser.parse_args()
+    args.ticks = max(2, int(50 * args.scale))
+    args.servers = max(1, int(200 * args.scale))
+    args.gpus = 2
+    args.pods = max(1, int(2000 * args.scale))
+    args.node_metrics = 10
+    args.node_series = max(9, int(2000 * args.scale))
+    args.zones = max(1, int(20 * args.scale))
+    args.zabbix_items = 3000
+    args.zabbix_hours = 1
+
+    targets = args.targets.split(",")
+    unknown = [t for t in targets if t not in TARGETS]
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(unknown)}")
+    results = {}
+    for target in targets:
+        print(f"running {target}", file=sys.stderr)
+        try:
+            results[target] = TARGETS[target](args)
+        except Exception as e:
+            results[target] = {"error": f"{type(e).__name__}: {e}"}
+        print(json.dumps({"target": target, **results[target]}))
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(json.load(f), results, args)
+        for message in found:
+            print(f"regression: {message}", file=sys.stderr)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,63 @@
+#!env python3
+#
+# This script acts as a processor to Telegraf and converts counters
+# (e.g. of the inputs net, diskio and cpu or of node_exporter) into the
+# differences between consecutive metrics, see nadiki_counters.py.
+# It replaces the Starlark script diff.star, with the same constants as
+# environment variables of the [[processors.execd]]:
+#
+#   [[processors.execd]]
+#     namepass = ["net"]
+#     command = ["python3", "nadiki-counter-diff-processor.py"]
+#     environment = ["DIFF_KEY_TAGS=interface", "DIFF_CALCULATE_RATIO=false", "DIFF_INVERT=false",
+#                    "NADIKI_METRICS_INSTANCE=network"]
+#
+# NADIKI_METRICS_INSTANCE tells the internal metrics of the processors of one
+# telegraf.conf apart, every [[processors.execd]] should set a different one.
+#
+
+import os
+import sys
+
+from nadiki_counters import CounterDiff
+from nadiki_lineprotocol import parse_lines, read_batches
+from nadiki_metrics import REGISTRY, start_reporting
+
+# comma separated names of the tags which distinguish the series, e.g. "instance,device"
+KEY_TAGS = [t.strip() for t in os.getenv("DIFF_KEY_TAGS", "").split(",") if t.strip()]
+# divide the differences by the elapsed seconds
+CALCULATE_RATIO = os.getenv("DIFF_CALCULATE_RATIO", "false").lower() in ("1", "true", "yes")
+# subtract the results from 1, e.g. to turn idle CPU seconds into the busy fraction
+INVERT = os.getenv("DIFF_INVERT", "false").lower() in ("1", "true", "yes")
+# series which have not been seen for this many seconds are dropped
+SERIES_TTL = float(os.getenv("DIFF_SERIES_TTL", "900"))
+# upper bound for the number of series
+MAX_SERIES = int(os.getenv("DIFF_MAX_SERIES", "100000"))
+# comma separated names of the fields which are 32-bit counters (e.g. of SNMP), only these
+# are taken to wrap around at 2**32, a drop of any other field near 2**32 is a reset
+COUNTER32_FIELDS = [f.strip() for f in os.getenv("DIFF_COUNTER32_FIELDS", "").split(",") if f.strip()]
+# seconds to collect lines before they are processed, 0 processes everything which has arrived
+BATCH_WINDOW = float(os.getenv("DIFF_BATCH_WINDOW", "0"))
+# the lines read and written, the series, resets and wraps are also reported in the
+# measurement nadiki_internal, see nadiki_metrics.py for the NADIKI_METRICS_* settings
+
+engine = CounterDiff(KEY_TAGS, calculate_ratio=CALCULATE_RATIO, invert=INVERT, ttl=SERIES_TTL, max_series=MAX_SERIES,
+    counter32_fields=COUNTER32_FIELDS)
+
+lines_in = REGISTRY.counter("lines_in")
+lines_out = REGISTRY.counter("lines_out")
+for name in ("series", "expired", "resets", "wraps", "dropped"):
+    REGISTRY.gauge(f"counter_{name}", function=lambda name=name: engine.stats()[name])
+# reported by the main loop, which writes all output
+reporter = start_reporting("counter-diff-processor", lambda lines: print("\n".join(lines)), background=False)
+
+source = open(sys.argv[1], "rb") if len(sys.argv) > 1 else sys.stdin.buffer
+for buffer in read_batches(source.fileno(), BATCH_WINDOW):
+    metrics = parse_lines(buffer, strict=False)
+    lines = engine.process_batch(metrics)
+    lines_in.inc(len(metrics))
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        lines_out.inc(len(lines))
+    reporter.maybe_report()
@@ -7,18 +7,77 @@ The following environment variables must be set:
 - ELECTRICITYMAP_ZONE: zone parameter to use for electricitimap, defaults to NL
 - TAG_COUNTRY_CODE: country_code to tag output metrics
 - TAG_FACILITY_ID: facility_id to tag output metrict
+- ELECTRICITYMAP_URL: base URL of the API, defaults to https://api.electricitymap.org/v3
+
+Several zones can be crawled by one process with ELECTRICITYMAP_ZONES, a JSON list
+of zones with the tags of their output (instead of ELECTRICITYMAP_ZONE and the TAG_*
+variables), e.g.
+
+    [{"zone": "NL", "tags": {"country_code": "NL", "facility_id": "ams1"}},
+     {"zone": "DE", "tags": {"country_code": "DE", "facility_id": "fra1"}}]
+
+All histories of a poll are fetched concurrently by up to ELECTRICITYMAP_CONCURRENCY
+threads (default 8), at most ELECTRICITYMAP_RATE requests per second (default 10)
+are started. Failed requests are retried ELECTRICITYMAP_RETRIES times (default 3)
+with exponential backoff.
+
+By default, the script fetches the histories once and outputs all of their points (for
+[[inputs.exec]]). With ELECTRICITYMAP_MODE=execd it stays resident (for [[inputs.execd]]
+with signal = "SIGHUP") and outputs only the points which are newer than the last point
+output per zone and data type. These high-water marks are stored in the file
+ELECTRICITYMAP_CHECKPOINT_FILE, so nothing is output twice after a restart. The histories
+only change once per hour, a response is therefore reused for ELECTRICITYMAP_CACHE_TTL
+seconds (default 600) instead of calling the API on every SIGHUP.
+
+The crawler reports its own metrics (API latency, errors, points output) in the
+measurement nadiki_internal, at the end of every run in exec mode and every
+NADIKI_METRICS_INTERVAL seconds in execd mode (see nadiki_metrics.py).
 """
 
+import calendar
+import concurrent.futures
+import json
 import os
-import requests
-import dateutil.parser
-#import pprint
+import signal
+import sys
+import threading
+import time
+
+from nadiki_http import TokenBucket, make_session, request_with_retry
+from nadiki_lineprotocol import LineWriter, escape_key
+from nadiki_metrics import REGISTRY, start_reporting
 
 DEFAULT_ZONE = "NL"
+ELECTRICITYMAP_URL = os.environ.get("ELECTRICITYMAP_URL", "https://api.electricitymap.org/v3")
+ELECTRICITYMAP_MODE = os.environ.get("ELECTRICITYMAP_MODE", "exec")
+ELECTRICITYMAP_CHECKPOINT_FILE = os.environ.get("ELECTRICITYMAP_CHECKPOINT_FILE", "nadiki-electricitymap-checkpoint.json")
+ELECTRICITYMAP_CACHE_TTL = float(os.environ.get("ELECTRICITYMAP_CACHE_TTL", "600"))
+ELECTRICITYMAP_TIMEOUT = float(os.environ.get("ELECTRICITYMAP_TIMEOUT", "30"))
+ELECTRICITYMAP_ZONES = os.environ.get("ELECTRICITYMAP_ZONES")
+ELECTRICITYMAP_CONCURRENCY = int(os.environ.get("ELECTRICITYMAP_CONCURRENCY", "8"))
+ELECTRICITYMAP_RATE = float(os.environ.get("ELECTRICITYMAP_RATE", "10"))
+ELECTRICITYMAP_RETRIES = int(os.environ.get("ELECTRICITYMAP_RETRIES", "3"))
+
+# data type -> (metric name, property name)
+DATA_TYPES = {
+    "carbon-intensity": ("grid_emission_factor_grams", "carbonIntensity"),
+    "power-breakdown": ("grid_renewable_percentage", "renewablePercentage"),
+}
+
+session = make_session(pool_size=ELECTRICITYMAP_CONCURRENCY)
+limiter = TokenBucket(ELECTRICITYMAP_RATE, burst=max(1, int(ELECTRICITYMAP_RATE)))
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=ELECTRICITYMAP_CONCURRENCY, thread_name_prefix="electricitymap")
+writer = LineWriter(sys.stdout)
+
+api_seconds = REGISTRY.histogram("api_seconds", {"api": "electricitymaps"})
+api_errors = REGISTRY.counter("api_errors", {"api": "electricitymaps"})
+points_output = REGISTRY.counter("points_output")
+checkpoint_errors = REGISTRY.counter("checkpoint_errors")
+
 
 def fetch_electricity_data(data_type: str, zone: str, auth_token: str) -> list:
     """
-    Perform an API call to electricitymaps and return the result 
+    Perform an API call to electricitymaps and return the result
 
     Args:
         data_type (str): name of the data to retrieve (see electricitymaps documentation)
@@ -27,22 +86,135 @@ def fetch_electricity_data(data_type: str, zone: str, auth_token: str) -> list:
     Returns:
         list: list of dictionaries as returned by electricitymaps
     """
-    url = f"https://api.electricitymap.org/v3/{data_type}/history?zone={zone}"
-    response = requests.get(url, headers={"auth-token": auth_token})
-    response.raise_for_status()
-    data = response.json()
+    url = f"{ELECTRICITYMAP_URL}/{data_type}/history?zone={zone}"
+    try:
+        with api_seconds.time():
+            response = request_with_retry(session, "GET", url, retries=ELECTRICITYMAP_RETRIES, limiter=limiter,
+                headers={"auth-token": auth_token}, timeout=ELECTRICITYMAP_TIMEOUT)
+            data = response.json()
+    except Exception:
+        api_errors.inc()
+        raise
     history = data.get("history", [])
     return history
-#    history = [
-#        {
-#            "value": float(item["carbonIntensity"]),
-#            "time": dateutil.parser.isoparse(item["datetime"]),
-#        }
-#        for item in history
-#    ]
-#    return history
 
-def print_em_history_as_influx_data(history: list, metricname: str, propertyname: str) -> None:
+
+def parse_timestamp(value: str) -> int:
+    """
+    Seconds since the epoch of an ISO 8601 timestamp
+
+    The API delivers UTC timestamps like 2024-05-01T12:00:00.000Z, these are parsed
+    by position. Other formats are left to dateutil.
+
+    Args:
+        value (str): the timestamp
+    Returns:
+        int: seconds since the epoch (fractions of a second are cut off)
+    """
+    if (len(value) in (20, 24) and value[-1] == "Z" or len(value) in (25, 29) and value.endswith("+00:00")) \
+            and value[4] == "-" and value[7] == "-" and value[10] == "T" and value[13] == ":" and value[16] == ":":
+        try:
+            return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19])))
+        except ValueError:
+            pass
+    import dateutil.parser
+    return int(dateutil.parser.parse(value).timestamp())
+
+
+class HighWaterMarks:
+    """
+    Timestamp (in seconds) of the newest point output per zone and data type,
+    persisted in a checkpoint file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.marks = {}  # zone -> data type -> timestamp
+        try:
+            with open(path) as f:
+                self.marks = json.load(f)["zones"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"ignoring checkpoint file {path}: {e}", file=sys.stderr)
+
+    def get(self, zone, data_type):
+        return self.marks.get(zone, {}).get(data_type)
+
+    def update(self, zone, data_type, timestamp):
+        self.marks.setdefault(zone, {})[data_type] = timestamp
+
+    def save(self):
+        # write to a temporary file first, so a crash does not leave a broken checkpoint
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as f:
+            json.dump({"zones": self.marks}, f)
+        os.replace(temp, self.path)
+
+
+class HistoryCache:
+    """
+    Responses of the history API, reused for ttl seconds
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.responses = {}  # (data type, zone) -> (monotonic time of the fetch, history)
+
+    def get(self, data_type, zone, auth_token):
+        key = (data_type, zone)
+        cached = self.responses.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        history = fetch_electricity_data(data_type, zone, auth_token)
+        self.responses[key] = (time.monotonic(), history)
+        return history
+
+
+def load_zones() -> list:
+    """
+    Zones to crawl, from ELECTRICITYMAP_ZONES or ELECTRICITYMAP_ZONE and the TAG_* variables
+
+    Returns:
+        list: dicts with the zone and the tags of its output
+    """
+    if ELECTRICITYMAP_ZONES:
+        zones = json.loads(ELECTRICITYMAP_ZONES)
+        for entry in zones:
+            if not isinstance(entry, dict) or "zone" not in entry:
+                raise ValueError(f"ELECTRICITYMAP_ZONES: every entry needs a zone, got {entry!r}")
+            entry.setdefault("tags", {})
+        return zones
+    return [{
+        "zone": os.environ.get("ELECTRICITYMAP_ZONE", DEFAULT_ZONE),
+        "tags": {"country_code": os.environ.get("TAG_COUNTRY_CODE"), "facility_id": os.environ.get("TAG_FACILITY_ID")},
+    }]
+
+
+def fetch_all(zones: list, get=fetch_electricity_data) -> dict:
+    """
+    Fetch the histories of all data types for all zones concurrently
+
+    Args:
+        zones (list): see load_zones(), zones which occur several times are fetched once
+        get (callable): called with data type, zone and auth token, e.g. HistoryCache.get
+    Returns:
+        dict: (data type, zone) -> history, or the exception if the fetch failed
+    """
+    keys = list(dict.fromkeys((data_type, entry["zone"]) for entry in zones for data_type in DATA_TYPES))
+    auth_token = os.environ.get("ELECTRICITYMAP_AUTH_TOKEN")
+    futures = {key: executor.submit(get, key[0], key[1], auth_token) for key in keys}
+    results = {}
+    for (key, future) in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            results[key] = e
+    return results
+
+
+def print_em_history_as_influx_data(history: list, metricname: str, propertyname: str, since: int = None, tags: dict = None) -> int:
     """
     Print an electricitymaps history structure as a list of Influx metrics
 
@@ -50,12 +222,88 @@ def print_em_history_as_influx_data(history: list, metricname: str, propertyname
         history (list): list of dicts as returned by electricitymaps calls of type "history"
         metricname (str): name of the metric to print
         propertyname (str): name of the property in each of history's entries, containing the value to print
+        since (int): only print entries which are newer than this timestamp (in seconds)
+        tags (dict): tags of the metrics, country_code and facility_id from the TAG_* variables by default
     Returns:
-        None
+        int: timestamp of the newest printed entry, since if there was none
     """
+    if tags is None:
+        tags = {"country_code": os.environ.get("TAG_COUNTRY_CODE"), "facility_id": os.environ.get("TAG_FACILITY_ID")}
+    # tags without value are left out like in format_line(), the line protocol cannot represent them
+    prefix = ",".join(["electricitymap"] + [f"{escape_key(k)}={escape_key(str(v))}" for (k, v) in tags.items()
+        if v is not None and v != ""])
+    prefix = f"{prefix} {escape_key(metricname)}="
+    newest = since
     for item in history:
-        print(f"electricitymap,country_code={os.environ.get('TAG_COUNTRY_CODE')},facility_id={os.environ.get('TAG_FACILITY_ID')} {metricname}={item[propertyname]} {int(dateutil.parser.parse(item['datetime']).timestamp())*10**9}")
+        ts = parse_timestamp(item["datetime"])
+        if since is not None and ts <= since:
+            continue
+        if item.get(propertyname) is None:
+            # no value (yet) for this hour
+            continue
+        writer.write_line(f"{prefix}{item[propertyname]} {ts*10**9}")
+        points_output.inc()
+        if newest is None or ts > newest:
+            newest = ts
+    return newest
+
+
+def crawl(zones: list, get=fetch_electricity_data, marks: "HighWaterMarks" = None) -> None:
+    """
+    Fetch the histories of all zones and print them, only the new points if marks are given
+    """
+    histories = fetch_all(zones, get)
+    updates = {}  # the marks are updated at the end, the same zone may be listed several times
+    for entry in zones:
+        zone = entry["zone"]
+        for (data_type, (metricname, propertyname)) in DATA_TYPES.items():
+            history = histories[(data_type, zone)]
+            if isinstance(history, Exception):
+                print(f"fetching {data_type} for {zone} failed: {history}", file=sys.stderr)
+                continue
+            since = marks.get(zone, data_type) if marks is not None else None
+            newest = print_em_history_as_influx_data(history, metricname, propertyname, since, entry["tags"])
+            if newest is not None:
+                updates[(zone, data_type)] = newest
+    writer.flush()
+    if marks is not None:
+        for ((zone, data_type), newest) in updates.items():
+            marks.update(zone, data_type, newest)
+        try:
+            marks.save()
+        except OSError as e:
+            # keep crawling, the marks stay in memory and the next crawl saves them again
+            print(f"saving checkpoint file {marks.path} failed: {e}", file=sys.stderr)
+            checkpoint_errors.inc()
+
+
+poll_lock = threading.Lock()
+
+def signal_handler(signum, frame):
+    """
+    Signal handler which outputs the new points of all zones and stores the high-water marks
+    """
+    # a SIGHUP can interrupt the wait for the fetches of a running crawl, which would
+    # output the same points again since the marks are only updated at its end
+    if not poll_lock.acquire(blocking=False):
+        print("previous crawl is still running, skipping this one", file=sys.stderr)
+        return
+    try:
+        crawl(zones, cache.get, marks)
+    finally:
+        poll_lock.release()
+
 
 if __name__ == "__main__":
-    print_em_history_as_influx_data(fetch_electricity_data("carbon-intensity", os.environ.get("ELECTRICITYMAP_ZONE", DEFAULT_ZONE), os.environ.get("ELECTRICITYMAP_AUTH_TOKEN")), "grid_emission_factor_grams", "carbonIntensity")
-    print_em_history_as_influx_data(fetch_electricity_data("power-breakdown", os.environ.get("ELECTRICITYMAP_ZONE", DEFAULT_ZONE), os.environ.get("ELECTRICITYMAP_AUTH_TOKEN")), "grid_renewable_percentage", "renewablePercentage")
+    zones = load_zones()
+    reporter = start_reporting("electricitymap-crawler", writer.write_lines, background=ELECTRICITYMAP_MODE == "execd")
+    if ELECTRICITYMAP_MODE == "execd":
+        marks = HighWaterMarks(ELECTRICITYMAP_CHECKPOINT_FILE)
+        cache = HistoryCache(ELECTRICITYMAP_CACHE_TTL)
+        signal.signal(signal.SIGHUP, signal_handler)
+        while True:
+            time.sleep(3600)
+    crawl(zones)
+    if reporter.interval:
+        reporter.report()
+    writer.close()
@@ -15,6 +15,20 @@ The configuration is done with envitonment variables:
   for Zabbix. These will be used for HTTP basic auth and for logging into Zabbix.
 - DC_PREFIX is used as a prefix for the Zabbix metric names
 - NADIKI_HOST is the host inside Zabbix which contains the metrics relevant for us.
+- ZABBIX_MODE is "lastvalue" (default) to output the latest value of every item, or
+  "history" to output every sample since the last one which was output (see below).
+- ZABBIX_TIMEOUT is the timeout of API requests in seconds (default 30).
+- NADIKI_METRICS_* configure the reports of the crawler's own metrics (API latency,
+  errors, samples output, failed polls) in the measurement nadiki_internal, see nadiki_metrics.py.
+
+In history mode, the clock of the last sample output per metric is stored in the file
+ZABBIX_CHECKPOINT_FILE, so that samples recorded while the crawler was not running
+are output after a restart. Samples are read with history.get for all items at once,
+in pages of ZABBIX_PAGE_SIZE samples. Periods which are older than ZABBIX_HISTORY_DAYS
+(the history retention of Zabbix) are filled with the hourly averages of trend.get.
+At most ZABBIX_MAX_SAMPLES samples are output per SIGHUP, so that a long outage is
+caught up with over several polls. Without a checkpoint, the crawler starts
+ZABBIX_BACKFILL_HOURS in the past.
 
 The global dict METRIC_MAP describes which output metrics are generated from which
 Zabbix metrics. The keys are names of fields in the output (the measurement name
@@ -27,17 +41,37 @@ is always "facility"). The value is again a dictionary with these keys:
 """
 import requests
 from requests.auth import HTTPBasicAuth
+import heapq
+import json
 import os, sys
 import signal
 import time
 
+from nadiki_http import make_session, request_with_retry, PermanentHTTPError
+from nadiki_metrics import REGISTRY, start_reporting
+
 ZABBIX_URL      = os.environ.get("ZABBIX_URL")
 ZABBIX_USERNAME = os.environ.get("ZABBIX_USERNAME")
 ZABBIX_PASSWORD = os.environ.get("ZABBIX_PASSWORD")
 DC_PREFIX       = os.environ.get("SEVERIUS_DC_PREFIX")
 NADIKI_HOST     = os.environ.get("NADIKI_HOST", "EDS-NADIKI")
+ZABBIX_MODE     = os.environ.get("ZABBIX_MODE", "lastvalue")
+ZABBIX_CHECKPOINT_FILE = os.environ.get("ZABBIX_CHECKPOINT_FILE", "nadiki-zabbix-checkpoint.json")
+ZABBIX_PAGE_SIZE = int(os.environ.get("ZABBIX_PAGE_SIZE", "1000"))
+ZABBIX_MAX_SAMPLES = int(os.environ.get("ZABBIX_MAX_SAMPLES", "5000"))
+ZABBIX_HISTORY_DAYS = float(os.environ.get("ZABBIX_HISTORY_DAYS", "7"))
+ZABBIX_BACKFILL_HOURS = float(os.environ.get("ZABBIX_BACKFILL_HOURS", "1"))
+ZABBIX_TIMEOUT  = float(os.environ.get("ZABBIX_TIMEOUT", "30"))
 #JOULES_PER_KWH = 3600000
 
+api_seconds = REGISTRY.histogram("api_seconds", {"api": "zabbix"})
+api_errors = REGISTRY.counter("api_errors", {"api": "zabbix"})
+relogins = REGISTRY.counter("zabbix_relogins")
+samples_output = REGISTRY.counter("samples_output")
+poll_failures = REGISTRY.counter("poll_failures")
+checkpoint_errors = REGISTRY.counter("checkpoint_errors")
+poll_seconds = REGISTRY.histogram("poll_seconds")
+
 METRIC_MAP = {
     "heatpump_avg_watts": {
         "zabbix_key": f"{DC_PREFIX}_Heat_Pump_Power", #NL3_Heat_Pump_Power
@@ -86,54 +120,276 @@ METRIC_MAP = {
     }
 }
 
+class ZabbixError(Exception):
+    """
+    Error returned by the Zabbix API
+    """
+    def __init__(self, error):
+        super().__init__(f"{error.get('message')} {error.get('data')}")
+        self.code = error.get("code")
+        self.data = error.get("data")
+
+    @property
+    def session_expired(self):
+        # "Session terminated, re-login, please." or "Not authorised." for an unknown token
+        return "re-login" in str(self.data) or "Not authorised" in str(self.data)
+
+
 class ZabbixClient:
     """
     Generic client for the Zabbix API
 
     The only assumption that we make here is that the same credentials are used for HTTP basic auth and 
     for Zabbix itself.
+
+    All calls go through one keep-alive session. When Zabbix reports that the session has
+    expired, the client logs in again and repeats the call once.
     """
-    def __init__(self, url, username, password, basic_auth_username, basic_auth_password):
+    def __init__(self, url, username, password, basic_auth_username, basic_auth_password, timeout=30):
         self.url = url
         self.username = username
         self.password = password
         self.basic_auth_username = basic_auth_username
         self.basic_auth_password = basic_auth_password
         self.basic_auth_token = HTTPBasicAuth(basic_auth_username, basic_auth_password)
+        self.timeout = timeout
+        self.session = make_session(pool_size=1, headers={"Content-Type": "application/json-rpc"})
+        self.session.auth = self.basic_auth_token
+        self.request_id = 0
+        self.items = {}  # (hostid, key) -> item, items do not change their IDs
+        self.auth_token = None
         self.auth_token = self._authenticate()
 
-    def _zabbix_api_call(self, method, params, auth=None):
-        headers = {"Content-Type": "application/json-rpc"}
+    def _request(self, method, params, auth=True):
+        self.request_id += 1
         payload = {
             "jsonrpc": "2.0",
             "method": method,
             "params": params,
-            "id": 1,
-            "auth": auth,
+            "id": self.request_id,
         }
-        response = requests.post(self.url, headers=headers, json=payload, auth=self.basic_auth_token)
-        response.raise_for_status()
-        if response.json().get("error"):
-            raise Exception(response.json()["error"])
-        return response
+        if auth:
+            payload["auth"] = self.auth_token
+        return payload
+
+    def _post(self, payload):
+        # the decoded body, which is a list for batch requests
+        try:
+            with api_seconds.time():
+                response = request_with_retry(self.session, "POST", self.url, json=payload, timeout=self.timeout)
+                return response.json()
+        except Exception:
+            api_errors.inc()
+            raise
+
+    @staticmethod
+    def _result(body):
+        if "error" in body:
+            api_errors.inc()
+            raise ZabbixError(body["error"])
+        return body["result"]
 
     def _authenticate(self):
-        response = self._zabbix_api_call("user.login", {"user": self.username, "password": self.password})
-        return response.json()["result"]
+        return self._result(self._post(self._request("user.login", {"user": self.username, "password": self.password}, auth=False)))
+
+    def call(self, method, params):
+        """
+        Call an API method and return its result
+        """
+        try:
+            return self._result(self._post(self._request(method, params)))
+        except ZabbixError as e:
+            if not e.session_expired:
+                raise
+        print("Zabbix session expired, logging in again", file=sys.stderr)
+        relogins.inc()
+        self.auth_token = self._authenticate()
+        return self._result(self._post(self._request(method, params)))
+
+    def batch(self, calls):
+        """
+        Call several API methods with one JSON-RPC batch request
+
+        Args:
+            calls (list): (method, params) tuples
+        Returns:
+            list: the results in the order of the calls
+        """
+        for attempt in (0, 1):
+            payload = [self._request(method, params) for (method, params) in calls]
+            body = self._post(payload)
+            if isinstance(body, dict):
+                # the batch as a whole was rejected
+                body = [body]
+            responses = {r.get("id"): r for r in body}
+            try:
+                return [self._result(responses.get(p["id"], {"error": {"message": "No response for call", "data": p["method"]}}))
+                    for p in payload]
+            except ZabbixError as e:
+                if attempt or not e.session_expired:
+                    raise
+            print("Zabbix session expired, logging in again", file=sys.stderr)
+            relogins.inc()
+            self.auth_token = self._authenticate()
 
     def get_host_id_by_name(self, hostname):
-        response = self._zabbix_api_call("host.get", {"output": ["hostid"], "filter":{"host": hostname}}, self.auth_token)
-        assert len(response.json()["result"]) == 1, f"Expected one result, but received {response.json()['result']}"
-        return response.json()["result"][0]["hostid"]
-
-#    def get_item_id_by_name(self, hostid, itemname):
-#        response = self._zabbix_api_call("item.get", {"output": ["itemid"], "filter":{"key_": itemname}, "hostids": hostid}, self.auth_token)
-#        assert len(response.json()["result"]) == 1, f"Expected one result, but received {response.json()['result']}"
-#        return response.json()["result"][0]["itemid"]
-#
-#    def get_item(self, hostid, itemid):
-#        response = self._zabbix_api_call("item.get", {"hostids": hostid, "itemids": itemid, "output": ["lastvalue"]}, self.auth_token)
-#        #print(response.json())
+        result = self.call("host.get", {"output": ["hostid"], "filter":{"host": hostname}})
+        assert len(result) == 1, f"Expected one result, but received {result}"
+        return result[0]["hostid"]
+
+    def get_host_and_items(self, hostname, keys):
+        """
+        Host ID and the items with the given keys (see get_items_by_key) with one batch request
+        """
+        (hosts, items) = self.batch([
+            ("host.get", {"output": ["hostid"], "filter": {"host": hostname}}),
+            ("item.get", {"host": hostname, "output": ["itemid", "hostid", "key_", "value_type"],
+                "filter": {"key_": list(keys)}}),
+        ])
+        assert len(hosts) == 1, f"Expected one result, but received {hosts}"
+        hostid = hosts[0]["hostid"]
+        for item in items:
+            self.items[(hostid, item["key_"])] = item
+        return hostid, {item["key_"]: item for item in items}
+
+    def get_items_by_key(self, hostid, keys):
+        """
+        Items of a host with the given keys, as dict from key to item (with itemid and value_type)
+
+        Only the keys which are not cached yet are requested from Zabbix.
+        """
+        missing = [key for key in keys if (hostid, key) not in self.items]
+        if missing:
+            result = self.call("item.get", {"hostids": hostid, "output": ["itemid", "hostid", "key_", "value_type"],
+                "filter": {"key_": missing}})
+            for item in result:
+                self.items[(hostid, item["key_"])] = item
+        return {key: self.items[(hostid, key)] for key in keys if (hostid, key) in self.items}
+
+    def forget_items(self, hostid):
+        """
+        Drop the cached items of a host, e.g. when one of them has been deleted
+        """
+        self.items = {k: v for (k, v) in self.items.items() if k[0] != hostid}
+
+    def history(self, itemids, value_type, time_from, time_till, page_size=1000):
+        """
+        Generator for the history of several items in ascending order of the clock,
+        fetched in pages of page_size samples
+        """
+        previous = set()  # (itemid, clock, ns) of the samples with the last clock of the previous page
+        while True:
+            samples = self.call("history.get", {"itemids": itemids, "history": value_type,
+                "time_from": time_from, "time_till": time_till, "sortfield": "clock", "sortorder": "ASC",
+                "limit": page_size, "output": ["itemid", "clock", "ns", "value"]})
+            for sample in samples:
+                if (sample["itemid"], sample["clock"], sample["ns"]) not in previous:
+                    yield sample
+            if len(samples) < page_size:
+                return
+            last = int(samples[-1]["clock"])
+            if last == time_from:
+                # more samples within one second than fit on a page, the rest cannot be fetched
+                print(f"more than {page_size} samples at clock {last}, skipping the rest of them", file=sys.stderr)
+                time_from = last + 1
+                previous = set()
+            else:
+                # the next page starts with the last second of this one, in case it was cut off
+                time_from = last
+                previous = {(x["itemid"], x["clock"], x["ns"]) for x in samples if x["clock"] == samples[-1]["clock"]}
+
+    def trends(self, itemids, time_from, time_till, page_size=1000):
+        """
+        Generator for the hourly trends of several items in ascending order of the clock
+        """
+        # a page covers as many hours as fit for all items
+        hours = max(1, page_size // max(1, len(itemids)))
+        start = time_from
+        while start <= time_till:
+            end = min(time_till, start + hours * 3600 - 1)
+            result = self.call("trend.get", {"itemids": itemids, "time_from": start, "time_till": end,
+                "output": ["itemid", "clock", "value_avg"]})
+            yield from sorted(result, key=lambda x: int(x["clock"]))
+            start = end + 1
+
+class ItemClocks:
+    """
+    Clock and nanoseconds of the last sample output per metric, persisted in a checkpoint file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.clocks = {}
+        try:
+            with open(path) as f:
+                self.clocks = {k: tuple(v) for (k, v) in json.load(f)["metrics"].items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"ignoring checkpoint file {path}: {e}", file=sys.stderr)
+
+    def save(self):
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as f:
+            json.dump({"metrics": self.clocks}, f)
+        os.replace(temp, self.path)
+
+
+def output(key, value, clock, ns=0):
+    print(f"facility,country_code={os.environ.get('TAG_COUNTRY_CODE')},facility_id={os.environ.get('TAG_FACILITY_ID')} {key}={value} {int(clock)*10**9 + int(ns)}")
+    samples_output.inc()
+
+
+def backfill(clnt, hostid, clocks, max_samples, now=None):
+    """
+    Output the samples of all metrics since their last output sample, at most max_samples
+    of them (the oldest first), and update their clocks
+
+    Returns:
+        int: number of samples output
+    """
+    now = int(time.time() if now is None else now)
+    items = clnt.get_items_by_key(hostid, [desc["zabbix_key"] for desc in METRIC_MAP.values()])
+    metrics = {}  # itemid -> metric name
+    for key, desc in METRIC_MAP.items():
+        if desc["zabbix_key"] in items:
+            metrics[items[desc["zabbix_key"]]["itemid"]] = key
+            clocks.clocks.setdefault(key, (int(now - ZABBIX_BACKFILL_HOURS * 3600), 0))
+        else:
+            print(f"no item {desc['zabbix_key']} on host {hostid}", file=sys.stderr)
+    if not metrics:
+        return 0
+    start = min(clocks.clocks[key][0] for key in metrics.values())
+    history_start = int(now - ZABBIX_HISTORY_DAYS * 86400)
+
+    streams = []
+    if start < history_start:
+        # the history of this period has been deleted, use the hourly averages instead
+        itemids = [i for (i, key) in metrics.items() if clocks.clocks[key][0] < history_start]
+        streams.append(({"itemid": x["itemid"], "clock": x["clock"], "ns": "0", "value": x["value_avg"]}
+            for x in clnt.trends(itemids, start, history_start - 1, ZABBIX_PAGE_SIZE)))
+    # history.get needs the value type, one stream per type
+    by_type = {}
+    for (itemid, key) in metrics.items():
+        by_type.setdefault(items[METRIC_MAP[key]["zabbix_key"]]["value_type"], []).append(itemid)
+    for (value_type, itemids) in by_type.items():
+        streams.append(clnt.history(itemids, int(value_type), max(start, history_start), now, ZABBIX_PAGE_SIZE))
+
+    count = 0
+    for sample in heapq.merge(*streams, key=lambda x: int(x["clock"])):
+        key = metrics[sample["itemid"]]
+        clock = (int(sample["clock"]), int(sample["ns"]))
+        # skip samples which have already been output
+        if clock <= clocks.clocks[key]:
+            continue
+        if count >= max_samples:
+            print(f"output {count} samples, catching up with the rest in the next poll", file=sys.stderr)
+            break
+        output(key, float(sample["value"]), *clock)
+        clocks.clocks[key] = clock
+        count += 1
+    return count
+
 
 def signal_handler(signum, frame):
     """
@@ -144,9 +400,48 @@ def signal_handler(signum, frame):
     creating duplicate data.
 
     """
-    r = clnt._zabbix_api_call("item.get", {"hostids": hostid, "output": ["key_", "lastclock", "lastvalue"]}, clnt.auth_token)
+    with poll_seconds.time():
+        try:
+            poll()
+        except (requests.RequestException, PermanentHTTPError, ZabbixError, ValueError) as e:
+            # keep running with the cached items and session, the next SIGHUP tries again
+            print(f"polling Zabbix failed: {e}", file=sys.stderr)
+            poll_failures.inc()
+    # the metrics are printed by the main thread like all other output
+    reporter.maybe_report()
+
+
+def save_clocks():
+    # an unwritable checkpoint file must neither stop the crawler nor hide the error of the poll,
+    # the clocks stay in memory and the next poll saves them again
+    try:
+        item_clocks.save()
+    except OSError as e:
+        print(f"saving checkpoint file {item_clocks.path} failed: {e}", file=sys.stderr)
+        checkpoint_errors.inc()
+
+
+def poll():
+    # the work of signal_handler()
+    if ZABBIX_MODE == "history":
+        try:
+            backfill(clnt, hostid, item_clocks, ZABBIX_MAX_SAMPLES)
+        finally:
+            # the clocks of the samples output before an error are kept as well
+            save_clocks()
+        return
+    # only the items of METRIC_MAP, by their cached IDs
+    items = clnt.get_items_by_key(hostid, [desc["zabbix_key"] for desc in METRIC_MAP.values()])
+    if not items:
+        print(f"no items of METRIC_MAP on host {hostid}", file=sys.stderr)
+        return
+    result = clnt.call("item.get", {"itemids": [item["itemid"] for item in items.values()],
+        "output": ["key_", "lastclock", "lastvalue"]})
+    if len(result) < len(items):
+        # an item has been deleted, resolve the keys again in the next poll
+        clnt.forget_items(hostid)
 
-    item_dict = { x["key_"]: (float(x["lastvalue"]), int(x["lastclock"])) for x in r.json()["result"] }
+    item_dict = { x["key_"]: (float(x["lastvalue"]), int(x["lastclock"])) for x in result }
     for key, desc in METRIC_MAP.items():
         try:
             (value, clock) = item_dict[desc["zabbix_key"]]
@@ -154,17 +449,20 @@ def signal_handler(signum, frame):
             if previous_metric.get(key) != None:
                 if previous_metric.get(key).get("clock") == clock:
                     continue
-            print(f"facility,country_code={os.environ.get('TAG_COUNTRY_CODE')},facility_id={os.environ.get('TAG_FACILITY_ID')} {key}={value} {int(clock)*10**9}")
+            output(key, value, clock)
             previous_metric[key] = { "clock": clock, "value": value }
         except KeyError as e:
             print(e, file=sys.stderr)
             pass
 
 if __name__ == "__main__":
-    clnt = ZabbixClient(ZABBIX_URL, ZABBIX_USERNAME, ZABBIX_PASSWORD, ZABBIX_USERNAME, ZABBIX_PASSWORD)
-    hostid = clnt.get_host_id_by_name(NADIKI_HOST)
+    clnt = ZabbixClient(ZABBIX_URL, ZABBIX_USERNAME, ZABBIX_PASSWORD, ZABBIX_USERNAME, ZABBIX_PASSWORD, ZABBIX_TIMEOUT)
+    (hostid, _) = clnt.get_host_and_items(NADIKI_HOST, [desc["zabbix_key"] for desc in METRIC_MAP.values()])
+    reporter = start_reporting("zabbix-crawler", lambda lines: print("\n".join(lines)), background=False)
     signal.signal(signal.SIGHUP, signal_handler)
     # this hash will store the latest timestamps and values per metric
     previous_metric = {}
+    # the clocks of the last samples in history mode
+    item_clocks = ItemClocks(ZABBIX_CHECKPOINT_FILE) if ZABBIX_MODE == "history" else None
     while True:
         time.sleep(3600)
@@ -1,54 +1,57 @@
 #!env python3
 #
+# This script acts as a processor to Telegraf and adds the labels of the
+# pods to the container metrics of cadvisor
 #
 
 import fileinput
-import pprint
-import shlex
-import subprocess
-import re
+import os
 import sys
-import json
 
-def parse_line(line):
-    # parse the input line (Influx line protocol)
-    (tmp, fields_str, ts) = shlex.split(line) # shlex.split respects backslashed spaces
-    pairs = tmp.split(",")
-    measurement = pairs[0]
-    tags = {}
-    for x in pairs[1:]:
-        (k,v) = x.split("=")
-        tags[k] = v
-    fields = {}
-    for x in fields_str.split(","):
-        (k,v) = x.split("=")
-        fields[k] = v
-    return measurement, tags, fields, ts
+from nadiki_lineprotocol import is_skipped, parse_line, format_line
+from nadiki_podlabels import PodLabelCache
+from nadiki_metrics import REGISTRY, start_reporting
 
-regex = re.compile("cri-containerd-([^.]*).scope")
+# read the containers from this file (same format as crictl ps -o json) instead of calling crictl
+POD_LABELS_FILE = os.getenv("POD_LABELS_FILE")
+# seconds between two refreshes of the pod labels
+POD_LABELS_TTL = float(os.getenv("POD_LABELS_TTL", "60"))
+# minimum number of seconds between two refreshes caused by unknown pods
+POD_LABELS_MIN_REFRESH = float(os.getenv("POD_LABELS_MIN_REFRESH", "5"))
+# the lines read, written and those without pod labels are also reported in the measurement
+# nadiki_internal, see nadiki_metrics.py for the NADIKI_METRICS_* settings
 
-# FIXME: refresh this table every now and then
-cp = subprocess.run(["crictl", "ps", "-o", "json"], capture_output=True)
-containers = json.loads(cp.stdout)
-# create a translation table from pod (sandbox) ID to a dictionary of labels
-# (we assume that most of the time, all running pods will be requested though
-# the batching feature of proton remote UDFs, so it does not hurt
-# to create the whole table)
-pod2label = {}
-for c in containers["containers"]:
-    pod2label[c["podSandboxId"]] = c["labels"]
+pods = PodLabelCache(POD_LABELS_FILE, ttl=POD_LABELS_TTL, min_refresh_interval=POD_LABELS_MIN_REFRESH).start()
+unknown = set()  # IDs which have already been reported
+
+lines_in = REGISTRY.counter("lines_in")
+lines_out = REGISTRY.counter("lines_out")
+lines_unlabeled = REGISTRY.counter("lines_unlabeled")
+REGISTRY.gauge("pods", function=lambda: len(pods.labels))
+# reported by the main loop, which writes all output
+reporter = start_reporting("cadvisor-processor", lambda lines: print("\n".join(lines)), background=False)
 
 # main loop
 for line in fileinput.input():
+    if is_skipped(line):
+        continue
     (measurement, tags, fields, ts) = parse_line(line)
-    if tags.get("id") != None:
-      podid = ""
-      try:
-        podid = regex.findall(tags["id"])[0]
-        print(podid, file=sys.stderr)
-        tags = { **tags,  **pod2label[podid] }
-        print(f'{measurement},{",".join([f"{k}={tags[k]}" for k in tags.keys()])} {".".join([f"{fieldname}={fields[fieldname]}" for fieldname in fields.keys()])} {ts}') 
-      except:
-          print(f"Something went wrong with id {tags.get('id')}", file=sys.stderr)
-          pass
-
+    lines_in.inc()
+    reporter.maybe_report()
+    if tags.get("id") is None:
+        continue
+    podid = pods.pod_id(tags["id"])
+    labels = pods.get(podid) if podid is not None else None
+    if labels is None:
+        lines_unlabeled.inc()
+        if tags["id"] not in unknown and len(unknown) < 10000:
+            unknown.add(tags["id"])
+            print(f"No pod labels for id {tags['id']}", file=sys.stderr)
+        if podid is None:
+            # not a container of a pod
+            continue
+        # the pod may have been started after the last refresh, which is repeated in the
+        # background, the line is passed on without the labels instead of waiting for them
+        labels = {}
+    print(format_line(measurement, {**tags, **labels}, fields, ts))
+    lines_out.inc()
@@ -5,98 +5,123 @@
 # to the format according to the NADIKI specification (see also 
 # https://github.com/SDIAlliance/nadiki-api/blob/main/server/server-api.spec.yaml)
 #
+# With --replay it calculates the energy of archived line protocol files
+# instead (e.g. after a fix of the calculation), with the same results as
+# if the files were piped through the processor, but much faster:
+#
+#   python3 nadiki-server-telegraf-processor.py --replay -o energy.lp dump-1.lp dump-2.lp
+#   python3 nadiki-server-telegraf-processor.py --replay --columnar -o energy.npz dump-*.lp
+#
+# The ENERGY_* settings below apply to the replay as well.
+#
+# --replay and ENERGY_BATCH_WINDOW need NumPy (pip install -r requirements-replay.txt), the
+# default line by line processing works without it.
+#
 
+import argparse
 import fileinput
-import pprint
-import shlex
+import os
+import sys
+import time
 
-JOULES_PER_KWH = 3600000
-SECONDS_PER_HOUR = 3600
+from nadiki_lineprotocol import is_skipped, parse_line, parse_lines, format_line, read_batches
+from nadiki_energy import EnergyIntegrator, EnergyReplay
+from nadiki_metrics import REGISTRY, start_reporting
 
-def parse_line(line):
-    # parse the input line (Influx line protocol)
-    (tmp, fields_str, ts) = shlex.split(line) # shlex.split respects backslashed spaces
-    pairs = tmp.split(",")
-    measurement = pairs[0]
-    tags = {}
-    for x in pairs[1:]:
-        (k,v) = x.split("=")
-        tags[k] = v
-    fields = {}
-    for x in fields_str.split(","):
-        (k,v) = x.split("=")
-        fields[k] = v
-    return measurement, tags, fields, ts
+# readings and series older than this many seconds are dropped
+SERIES_TTL = float(os.getenv("ENERGY_SERIES_TTL", "900"))
+# upper bound for the number of series (servers, CPU packages and GPUs)
+MAX_SERIES = int(os.getenv("ENERGY_MAX_SERIES", "100000"))
+# seconds between the reports of the number of series on stderr, 0 disables them
+STATS_INTERVAL = float(os.getenv("ENERGY_STATS_INTERVAL", "300"))
+# "rectangle" uses the earlier of two readings for the interval between them, "trapezoid" their mean
+INTEGRATION = os.getenv("ENERGY_INTEGRATION", "rectangle")
+# seconds to collect lines before they are processed together with NumPy, 0 processes line by line
+BATCH_WINDOW = float(os.getenv("ENERGY_BATCH_WINDOW", "0"))
+# emit the energy of every CPU package and GPU (tagged with cpu and index) instead of the
+# cpu_ and gpu_energy_consumption_joules per server of the Nadiki spec
+PER_DEVICE = os.getenv("ENERGY_PER_DEVICE", "false").lower() in ("1", "true", "yes")
+# the lines read and written and the numbers of series are also reported in the
+# measurement nadiki_internal, see nadiki_metrics.py for the NADIKI_METRICS_* settings
 
-# CPU
-current_power_consumption_watts = {}
-current_dram_power_consumption_watts = {}
-current_total_power_consumption_watts = None
-last_ts = None
 
-# Server
-instantaneous_power_reading = {}
-last_ts2 = None
+def report_stats():
+    global next_stats
+    if STATS_INTERVAL and time.monotonic() >= next_stats:
+        next_stats = time.monotonic() + STATS_INTERVAL
+        print("energy integration: {series} series, {pending} incomplete readings, {expired} expired series, {late} late intervals".format(
+            **engine.stats()), file=sys.stderr)
 
-# GPU
-power_draw = {}
-last_ts3 = None
 
-for line in fileinput.input():
-    (measurement, tags, fields, ts) = parse_line(line)
+def replay(args):
+    parser = argparse.ArgumentParser(prog="nadiki-server-telegraf-processor.py --replay",
+        description="Calculate the energy of archived line protocol files, see nadiki_energy.EnergyReplay")
+    parser.add_argument("files", nargs="+", help="line protocol files, in the order they were written")
+    parser.add_argument("--output", "-o", default="-", help="file for the results, - for stdout")
+    parser.add_argument("--columnar", action="store_true", help="write NumPy arrays (.npz) instead of line protocol")
+    options = parser.parse_args(args)
+    if options.columnar and options.output == "-":
+        parser.error("--columnar needs --output")
+    started = time.monotonic()
+    energy = EnergyReplay(ttl=SERIES_TTL, max_series=MAX_SERIES, method=INTEGRATION, per_device=PER_DEVICE)
+    for path in options.files:
+        energy.scan(path)
+    if options.columnar:
+        energy.write_columns(options.output)
+    elif options.output == "-":
+        energy.write_lines(sys.stdout.buffer)
+    else:
+        with open(options.output, "wb") as out:
+            energy.write_lines(out)
+    seconds = time.monotonic() - started
+    print(f"energy replay: {energy.lines} lines ({energy.bytes / 10**6:.1f} MB) in {seconds:.1f}s "
+        f"({energy.bytes / 10**6 / max(seconds, 1e-9):.0f} MB/s), {len(energy.series)} series, {energy.invalid} invalid lines, "
+        f"{'all series at once' if energy.vectorized else 'line by line'}", file=sys.stderr)
 
-    if measurement == "powerstat_package":
-        if "current_power_consumption_watts" in fields.keys():
-            current_power_consumption_watts[ts] = float(fields["current_power_consumption_watts"])
-        elif "current_dram_power_consumption_watts" in fields.keys():
-            current_dram_power_consumption_watts[ts] = float(fields["current_dram_power_consumption_watts"])
-        else:
-            # do nothin with other fields of powerstat
-            continue
-        if ts in current_power_consumption_watts.keys() and ts in current_dram_power_consumption_watts.keys():
-            result = current_power_consumption_watts[ts] + current_dram_power_consumption_watts[ts]
-            if last_ts != None:
-                diff = (int(ts) - int(last_ts)) / 10**9
-                # fraction of an hour between the last two points
-                fraction = diff / SECONDS_PER_HOUR
-                # convert kWh to Joules (actually we could simplify the division by 3600 above and the
-                # multiplication with 3600000 here, but this makes it clearer)
-                joules = current_total_power_consumption_watts*fraction*JOULES_PER_KWH
-                print(f"server,country_code={tags['country_code']},facility_id={tags['facility_id']},rack_id={tags['rack_id']},server_id={tags['server_id']} cpu_energy_consumption_joules={joules} {last_ts}")
-                del(current_dram_power_consumption_watts[last_ts])
-                del(current_power_consumption_watts[last_ts])
-            last_ts = ts
-            current_total_power_consumption_watts = result
-            
-    elif measurement == "ipmi_sensor" and tags["name"] == "instantaneous_power_reading":
-        instantaneous_power_reading[ts] = fields["value"]
-        #print(last_ts2, instantaneous_power_reading)
-        if last_ts2 != None:
-            diff = (int(ts) - int(last_ts2)) / 10**9
-            # fraction of an hour between the last two points
-            fraction = diff / SECONDS_PER_HOUR
-            # convert kWh to Joules (actually we could simplify the division by 3600 above and the
-            # multiplication with 3600000 here, but this makes it clearer)
-            joules = float(instantaneous_power_reading[last_ts2])*fraction*JOULES_PER_KWH
-            print(f"server,country_code={tags['country_code']},facility_id={tags['facility_id']},rack_id={tags['rack_id']},server_id={tags['server_id']} server_energy_consumption_joules={joules} {last_ts2}")
-            del(instantaneous_power_reading[last_ts2])
-        last_ts2 = ts
 
-    elif measurement == "nvidia_smi":
-        if power_draw.get(ts) == None:
-            power_draw[ts] = 0
-        # we have more than one GPU, so we need to sum up the power draw with the same timestamp
-        power_draw[ts] += float(fields["power_draw"])
-        #print(last_ts2, instantaneous_power_reading)
-        if last_ts3 != None and last_ts3 != ts:
-            diff = (int(ts) - int(last_ts3)) / 10**9
-            # fraction of an hour between the last two points
-            fraction = diff / SECONDS_PER_HOUR
-            # convert kWh to Joules (actually we could simplify the division by 3600 above and the
-            # multiplication with 3600000 here, but this makes it clearer)
-            joules = float(power_draw[last_ts3])*fraction*JOULES_PER_KWH
-            print(f"server,country_code={tags['country_code']},facility_id={tags['facility_id']},rack_id={tags['rack_id']},server_id={tags['server_id']} gpu_energy_consumption_joules={joules} {last_ts3}")
-            del(power_draw[last_ts3])
-        last_ts3 = ts
+if sys.argv[1:2] == ["--replay"]:
+    replay(sys.argv[2:])
+    sys.exit(0)
+
+engine = EnergyIntegrator(ttl=SERIES_TTL, max_series=MAX_SERIES, method=INTEGRATION, per_device=PER_DEVICE)
+next_stats = time.monotonic() + STATS_INTERVAL
 
+lines_in = REGISTRY.counter("lines_in")
+lines_out = REGISTRY.counter("lines_out")
+for name in ("series", "pending", "expired", "late"):
+    REGISTRY.gauge(f"energy_{name}", function=lambda name=name: engine.stats()[name])
+# reported by the main loop, which writes all output
+reporter = start_reporting("server-processor", lambda lines: print("\n".join(lines)), background=False)
 
+if BATCH_WINDOW > 0:
+    source = open(sys.argv[1], "rb") if len(sys.argv) > 1 else sys.stdin.buffer
+    for buffer in read_batches(source.fileno(), BATCH_WINDOW):
+        metrics = parse_lines(buffer)
+        lines = engine.process_batch(metrics)
+        lines_in.inc(len(metrics))
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+            lines_out.inc(len(lines))
+        report_stats()
+        reporter.maybe_report()
+    # the server totals which are still being summed up
+    lines = [format_line(*result) for result in engine.flush()]
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        lines_out.inc(len(lines))
+else:
+    for line in fileinput.input():
+        if is_skipped(line):
+            continue
+        result = engine.process(*parse_line(line))
+        lines_in.inc()
+        if result is not None:
+            print(format_line(*result))
+            lines_out.inc()
+        report_stats()
+        reporter.maybe_report()
+    # the server totals which are still being summed up
+    for result in engine.flush():
+        print(format_line(*result))
+        lines_out.inc()
@@ -6,195 +6,408 @@
 
 import fileinput
 import pprint
-import shlex
-import signal
 import json
 import sys
-import requests
 import os
+import threading
+import signal
+import time
+import uuid
 from proton_driver import client
-import datetime
-import itertools
 import setproctitle
 
+from nadiki_lineprotocol import is_skipped, parse_line, format_line, LineWriter, LineProtocolError
+from nadiki_metrics import REGISTRY, start_reporting, write_stdout
+from nadiki_proton_ingest import FlushPipeline, HTTPTransport, NativeTransport, ShardedParser, StreamSchema, ColumnarBatch
+from nadiki_spool import Spool
+
 from multiprocessing import Process, Lock
 
-PROTON_INGEST_URL = f"http://{os.environ.get('PROTON_HOST')}:3218/proton/v1/ingest/streams/"
-
-# primary keys of our streams
-# this should go to a config file
-STREAM_CONFIG = {
-    "ipmi_dcmi_power_consumption_watts":    ["instance"],
-    "node_cpu_seconds_total":               ["instance", "cpu", "mode"],
-    "node_network_transmit_bytes_total":    ["instance", "device"],
-    "node_network_receive_bytes_total":     ["instance", "device"],
-    "node_network_transmit_packets_total":  ["instance", "device"],
-    "node_network_receive_packets_total":   ["instance", "device"],
-    "node_disk_read_bytes_total":           ["instance", "device"],
-    "node_disk_written_bytes_total":        ["instance", "device"],
-    "node_disk_reads_completed_total":      ["instance", "device"],
-    "node_disk_writes_completed_total":     ["instance", "device"]
-}
-
-QUERIES = [
-    # Calculate server_energy_consumption_kwh by multiplying Watts with the fraction of an hour which lies between two data points (and then dividing though 1000 to get the kilos)
+# streams and queries, the file is read again on SIGHUP
+PROTON_CONFIG = os.environ.get("PROTON_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "nadiki-proton-config.json"))
+
+PROTON_INGEST_URL = os.environ.get("PROTON_INGEST_URL", f"http://{os.environ.get('PROTON_HOST')}:3218/proton/v1/ingest/streams/")
+
+# rows are sent to Proton when a stream has collected PROTON_BATCH_SIZE rows or
+# when the oldest row has waited PROTON_FLUSH_INTERVAL seconds, whichever comes first;
+# at most PROTON_QUEUE_DEPTH batches wait for the flusher before reading stdin blocks
+PROTON_BATCH_SIZE = int(os.environ.get("PROTON_BATCH_SIZE", 10000))
+PROTON_FLUSH_INTERVAL = float(os.environ.get("PROTON_FLUSH_INTERVAL", 1.0))
+PROTON_QUEUE_DEPTH = int(os.environ.get("PROTON_QUEUE_DEPTH", 8))
+# the batches of one flush are posted with up to PROTON_INGEST_CONCURRENCY parallel
+# requests over kept-alive connections, the bodies are compressed with gzip
+# (PROTON_INGEST_GZIP_LEVEL=0 disables that) and transient errors are retried
+# PROTON_INGEST_RETRIES times with exponential backoff
+PROTON_INGEST_CONCURRENCY = int(os.environ.get("PROTON_INGEST_CONCURRENCY", 4))
+PROTON_INGEST_GZIP_LEVEL = int(os.environ.get("PROTON_INGEST_GZIP_LEVEL", 1))
+PROTON_INGEST_RETRIES = int(os.environ.get("PROTON_INGEST_RETRIES", 3))
+# PROTON_INGEST_TRANSPORT=native inserts the batches as columnar blocks over the
+# native protocol (PROTON_HOST:PROTON_NATIVE_PORT) instead of posting them as JSON,
+# with up to PROTON_INGEST_CONCURRENCY connections which are kept open
+PROTON_INGEST_TRANSPORT = os.environ.get("PROTON_INGEST_TRANSPORT", "http")
+PROTON_NATIVE_PORT = int(os.environ.get("PROTON_NATIVE_PORT", 8463))
+# with PROTON_PARSE_WORKERS > 0, the lines are parsed by this many worker processes:
+# what arrives within PROTON_PARSE_WINDOW seconds is split into chunks of about
+# PROTON_PARSE_CHUNK_BYTES, the rows of every stream keep the order of the input
+PROTON_PARSE_WORKERS = int(os.environ.get("PROTON_PARSE_WORKERS", 0))
+PROTON_PARSE_CHUNK_BYTES = int(os.environ.get("PROTON_PARSE_CHUNK_BYTES", 2**20))
+PROTON_PARSE_WINDOW = float(os.environ.get("PROTON_PARSE_WINDOW", 0.05))
+# PROTON_QUERY_MODE=processes runs every query in a child process of its own,
+# PROTON_QUERY_MODE=threads runs all of them in one child process which writes the
+# results in batches of up to PROTON_OUTPUT_BATCH_LINES lines, at the latest every
+# PROTON_OUTPUT_FLUSH_INTERVAL seconds; PROTON_QUERY_MODE=off only ingests, the
+# streams are neither created nor queried (e.g. when another ingester runs the
+# queries, or for benchmarks against a stub of the ingest API)
+PROTON_QUERY_MODE = os.environ.get("PROTON_QUERY_MODE", "processes")
+# with PROTON_QUERY_MODE=threads, queries which failed are started again after at most this many seconds
+PROTON_QUERY_RESTART_INTERVAL = float(os.environ.get("PROTON_QUERY_RESTART_INTERVAL", 60))
+PROTON_OUTPUT_BATCH_LINES = int(os.environ.get("PROTON_OUTPUT_BATCH_LINES", 1000))
+PROTON_OUTPUT_FLUSH_INTERVAL = float(os.environ.get("PROTON_OUTPUT_FLUSH_INTERVAL", 0.5))
+# if PROTON_SPOOL_DIR is set, batches are written to a spool in this directory before
+# they are sent, see nadiki_spool.py for the meaning of the other settings
+PROTON_SPOOL_DIR = os.environ.get("PROTON_SPOOL_DIR")
+PROTON_SPOOL_MAX_BYTES = int(os.environ.get("PROTON_SPOOL_MAX_BYTES", 2**30))
+PROTON_SPOOL_SEGMENT_BYTES = int(os.environ.get("PROTON_SPOOL_SEGMENT_BYTES", 64 * 2**20))
+PROTON_SPOOL_DROP_POLICY = os.environ.get("PROTON_SPOOL_DROP_POLICY", "drop-oldest")
+PROTON_SPOOL_FSYNC = os.environ.get("PROTON_SPOOL_FSYNC", "interval")
+PROTON_SPOOL_MAX_RATE = float(os.environ.get("PROTON_SPOOL_MAX_RATE", 0))
+PROTON_SPOOL_CLOSE_TIMEOUT = float(os.environ.get("PROTON_SPOOL_CLOSE_TIMEOUT", 10))
+# the ingester and the query processes report their own metrics (lines parsed, rows
+# buffered, flush latency, rows per query, ...) in the measurement nadiki_internal,
+# see nadiki_metrics.py for the NADIKI_METRICS_* settings
+
+def load_config(path):
     """
-        SELECT
-        'server', tags, map_cast(['server_energy_consumption_kwh'], [((date_diff('s', t2, t1) / 3600) * watts) / 1000]) AS fields, to_unix_timestamp64_nano(t1)
-        FROM
-        (
-            SELECT
-            instance, tags, to_float(fields['value']) AS watts, _tp_time AS t1, lag(_tp_time) OVER (PARTITION BY instance) AS t2
-            FROM
-            ipmi_dcmi_power_consumption_watts
-        )
-        WHERE
-        (t1 != t2) AND (date_diff('s', t2, t1) < 86400)
-    """,
-#    # Calculate fraction of time (between 0 and 1) in which CPU cores were non-idle
-#    """
-#        SELECT
-#        'server', tags, map_cast(['cpu_not_idle_fraction'], [sum(seconds-last_seconds)/date_diff('s', t2, t1)]) as fields, to_unix_timestamp64_nano(t1)
-#        FROM
-#        (
-#            SELECT
-#            tags, to_float(fields['value']) as seconds, lag(to_float(fields['value'])) over (partition by instance, cpu, mode) as last_seconds, _tp_time as t1, lag(_tp_time) over (partition by instance, cpu, mode) as t2
-#            FROM
-#            node_cpu_seconds_total
-#            WHERE
-#            mode != 'idle'
-#        )
-#        WHERE
-#        (t1 != t2) AND (date_diff('s', t2, t1) < 86400) GROUP BY tags, t2, t1
-#    """
-]
-
-# generate queries which are very similar (network and disk)
-QUERIES.extend([
-    ##
-    f"""
-        SELECT
-        'server', tags, map_cast(['network_{transmit_receive}_{bytes_packets}'], [sum(units-last_units)]) as fields, to_unix_timestamp64_nano(t1)
-        FROM
-        (
-            SELECT
-            tags, to_float(fields['value']) as units, lag(to_float(fields['value'])) over (partition by instance, device) as last_units, _tp_time as t1, lag(_tp_time) over (partition by instance, device) as t2
-            FROM
-            node_network_{transmit_receive}_{bytes_packets}_total
-        )
-        WHERE
-        (t1 != t2) AND (date_diff('s', t2, t1) < 86400) GROUP BY tags, t2, t1
+    Read the streams and queries from the JSON config file
+
+    The file contains an object with two keys: "streams" maps stream names to the
+    list of tags which form their primary key, "queries" is a list of objects with
+    a "name" and the streaming "query" (a string or a list of lines).
+
+    Returns:
+        tuple: (dict of stream name -> primary key tags, dict of query name -> query)
     """
-    for (transmit_receive, bytes_packets) in itertools.product(["transmit", "receive"], ["bytes", "packets"])])
-
-QUERIES.extend([
-    ## number of bytes read and written
-    f"""
-        SELECT
-        'server', tags, map_cast(['io_bytes_{read_written}'], [sum(units-last_units)]) as fields, to_unix_timestamp64_nano(t1)
-        FROM
-        (
-            SELECT
-            tags, to_float(fields['value']) as units, lag(to_float(fields['value'])) over (partition by instance, device) as last_units, _tp_time as t1, lag(_tp_time) over (partition by instance, device) as t2
-            FROM
-            node_disk_{read_written}_bytes_total
-        )
-        WHERE
-        (t1 != t2) AND (date_diff('s', t2, t1) < 86400) GROUP BY tags, t2, t1
+    with open(path) as f:
+        config = json.load(f)
+    queries = {}
+    for q in config.get("queries", []):
+        query = q["query"]
+        queries[q["name"]] = "\n".join(query) if isinstance(query, list) else query
+    return config["streams"], queries
+
+def stream_columns(keys):
+    # the columns of a stream and their types
+    columns = {k: "string" for k in keys}
+    columns.update({"tags": "map(string, string)", "fields": "map(string, string)", "timestamp": "int64"})
+    return columns
+
+def create_statement(stream, keys):
+    return f"CREATE STREAM {stream} (" \
+        + ", ".join([f"{name} {type}" for (name, type) in stream_columns(keys).items()]) + ")" \
+        + f" PRIMARY KEY ({','.join(keys)}) SETTINGS mode='versioned_kv' "
+
+def reconcile_streams(c, stream_config):
     """
-    for (read_written) in ["read", "written"]])
-
-QUERIES.extend([
-    ## number of reads and writes completed
-    f"""
-        SELECT
-        'server', tags, map_cast(['io_{reads_writes}'], [sum(units-last_units)]) as fields, to_unix_timestamp64_nano(t1)
-        FROM
-        (
-            SELECT
-            tags, to_float(fields['value']) as units, lag(to_float(fields['value'])) over (partition by instance, device) as last_units, _tp_time as t1, lag(_tp_time) over (partition by instance, device) as t2
-            FROM
-            node_disk_{reads_writes}_completed_total
-        )
-        WHERE
-        (t1 != t2) AND (date_diff('s', t2, t1) < 86400) GROUP BY tags, t2, t1
+    Create the streams which are missing and alter the ones which differ from the config
+
+    Streams whose primary key has changed have to be recreated, all others keep their
+    versioned_kv state (and the lag() windows of the queries can continue).
     """
-    for (reads_writes) in ["reads", "writes"]])
-
-
-def parse_line(line):
-    # parse the input line (Influx line protocol)
-    (tmp, fields_str, ts) = shlex.split(line) # shlex.split respects backslashed spaces
-    pairs = tmp.split(",")
-    measurement = pairs[0]
-    tags = {}
-    for x in pairs[1:]:
-        (k,v) = x.split("=")
-        tags[k] = v
-    fields = {}
-    for x in fields_str.split(","):
-        (k,v) = x.split("=")
-        fields[k] = v
-    return measurement, tags, fields, ts
-
-data = {} # will contain one key per metric with an array of parsed lines as value
-
-def dump_metrics(a,b):
-    global data
-    #print("alarm!", file=sys.stderr)
-    for k in data.keys():
-        #print(f"{k} has {len(data[k])} entries", file=sys.stderr)
-        if len(data[k]) > 0:
-            #print(json.dumps({ "columns": columns, "data": data }), file=sys.stderr)
-            headers = {"Content-Type": "application/json"}
-            columns = STREAM_CONFIG[k] + ["tags", "fields", "timestamp", "_tp_time"]
-            payload = { "columns": columns, "data": data[k] }
-            #print(json.dumps(payload), file=open("debug.json", "w"))
-            response = requests.post(f"{PROTON_INGEST_URL}{k}", headers=headers, json=payload)
-            response.raise_for_status()
-            data[k] = []
-    signal.alarm(1)
-
-def handle_query(q, lock):
-    # child process queries proton and outputs metrics
-    setproctitle.setproctitle(q)
-    c = client.Client(host=os.environ.get('PROTON_HOST'), port=8463)
-    rows = c.execute_iter(q)
+    def normalize(type):
+        return type.replace(" ", "").lower()
+    existing = {}
+    for (name, primary_key, create_query) in c.execute(
+            "SELECT name, primary_key, create_table_query FROM system.tables WHERE database = current_database()"):
+        existing[name] = ([k.strip() for k in primary_key.split(",") if k.strip()], create_query)
+    columns = {}
+    for (table, name, type) in c.execute("SELECT table, name, type FROM system.columns WHERE database = current_database()"):
+        columns.setdefault(table, {})[name] = type
+    for (s, keys) in stream_config.items():
+        if s not in existing:
+            print(f"Creating stream {s}", file=sys.stderr)
+            c.execute(create_statement(s, keys))
+            continue
+        (primary_key, create_query) = existing[s]
+        if primary_key != keys or "versioned_kv" not in create_query:
+            print(f"Primary key of stream {s} changed from {primary_key} to {keys}, recreating it", file=sys.stderr)
+            c.execute(f"DROP STREAM IF EXISTS {s}")
+            c.execute(create_statement(s, keys))
+            continue
+        for (name, type) in stream_columns(keys).items():
+            current = columns.get(s, {}).get(name)
+            if current is None:
+                print(f"Adding column {name} to stream {s}", file=sys.stderr)
+                c.execute(f"ALTER STREAM {s} ADD COLUMN {name} {type}")
+            elif normalize(current) != normalize(type):
+                print(f"Changing column {name} of stream {s} from {current} to {type}", file=sys.stderr)
+                c.execute(f"ALTER STREAM {s} MODIFY COLUMN {name} {type}")
+
+def stream_query(c, q, write, rows_emitted, query_id=None, stopped=None):
+    # run a streaming query and pass its rows as line protocol to write(), until stopped is set
+    rows = c.execute_iter(q, query_id=query_id)
     for row in rows:
+        if stopped is not None and stopped.is_set():
+            break
         (measurement, tags, fields, timestamp) = row
-        tag_strings = [f"{tagname}={tags[tagname]}" for tagname in tags.keys()]
-        field_strings = [f"{fieldname}={fields[fieldname]}" for fieldname in fields.keys()]
-        lock.acquire()
-        print(f"{measurement},{','.join(tag_strings)} {'.'.join(field_strings)} {timestamp}")
-        lock.release()
+        write(format_line(measurement, tags, fields, timestamp))
+        rows_emitted.inc()
         #print(row, file=sys.stderr)
         ## this never terminates
 
-if __name__ == "__main__":
-    # create the streams
+def handle_query(name, q, lock):
+    # child process queries proton and outputs metrics
+    setproctitle.setproctitle(f"nadiki proton query {name}")
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    def write(line):
+        lock.acquire()
+        print(line, flush=True)
+        lock.release()
+    def write_lines(lines):
+        with lock:
+            write_stdout(lines)
+    # the metrics of the parent were copied by the fork
+    REGISTRY.clear()
+    start_reporting("ingester", write_lines, prometheus=False)
     c = client.Client(host=os.environ.get('PROTON_HOST'), port=8463)
-    for s in STREAM_CONFIG:
-        c.execute(f"DROP STREAM IF EXISTS {s}")
-        create_stmt = f"CREATE STREAM {s} (" \
-            + ", ".join([f"{field} string" for field in STREAM_CONFIG[s]]) \
-            + ", tags map(string, string), fields map(string, string), timestamp BIGINT)" \
-            + f" PRIMARY KEY ({','.join(STREAM_CONFIG[s])}) SETTINGS mode='versioned_kv' "
-        #print(create_stmt, file=sys.stderr)
-        c.execute(create_stmt)
+    stream_query(c, q, write, REGISTRY.counter("query_rows", {"query": name}))
 
-    # fork one child per query
-    lock = Lock()
-    for q in QUERIES:
-        Process(target=handle_query, args=(q, lock)).start()
+class QueryProcesses:
+    """
+    Runs every query in a child process of its own
+    """
+    def __init__(self, lock):
+        self.lock = lock  # held while a process writes to stdout
+        self.processes = {}  # query name -> (query, process)
 
+    def update(self, queries):
+        # stop the queries which were removed or changed, start the new ones
+        for (name, (q, process)) in list(self.processes.items()):
+            if queries.get(name) != q:
+                print(f"Stopping query {name}", file=sys.stderr)
+                process.terminate()
+                process.join()
+                del self.processes[name]
+        for (name, q) in queries.items():
+            if name not in self.processes:
+                process = Process(target=handle_query, args=(name, q, self.lock))
+                process.start()
+                self.processes[name] = (q, process)
+
+class QueryThread:
+    """
+    A query run by QueryThreads, its client is only used by its own thread
+    """
+    __slots__ = ("query", "query_id", "stopped", "thread")
+
+    def __init__(self, name, query):
+        self.query = query
+        self.query_id = f"nadiki-{name}-{uuid.uuid4().hex}"  # for KILL QUERY
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+class QueryThreads:
+    """
+    Runs every query in a thread of the current process, all threads write their
+    rows through one buffered writer
+
+    A query is stopped by setting its flag and killing it on the server through a
+    client of its own, the thread then leaves the blocked execute_iter() and
+    disconnects its client itself. Threads whose query failed or ended are started
+    again by the next update().
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.running = {}  # query name -> QueryThread
+        self.queries = {}  # query name -> query, as of the last update()
+
+    def _run(self, name, state):
+        c = client.Client(host=os.environ.get('PROTON_HOST'), port=8463)
+        try:
+            stream_query(c, state.query, self.writer.write_line, REGISTRY.counter("query_rows", {"query": name}),
+                state.query_id, state.stopped)
+            if not state.stopped.is_set():
+                print(f"Query {name} ended", file=sys.stderr)
+        except Exception as e:
+            if not state.stopped.is_set():
+                print(f"Query {name} failed: {e}", file=sys.stderr)
+        finally:
+            c.disconnect()
+
+    def _stop(self, name, state):
+        state.stopped.set()
+        try:
+            c = client.Client(host=os.environ.get('PROTON_HOST'), port=8463)
+            try:
+                c.execute(f"KILL QUERY WHERE query_id = '{state.query_id}'")
+            finally:
+                c.disconnect()
+        except Exception as e:
+            # the thread leaves the query with its next row
+            print(f"Killing query {name} failed: {e}", file=sys.stderr)
+
+    def _start(self, name, q):
+        state = QueryThread(name, q)
+        state.thread = threading.Thread(target=self._run, args=(name, state), name=name, daemon=True)
+        self.running[name] = state
+        state.thread.start()
+
+    def update(self, queries):
+        # stop the queries which were removed or changed, start the new ones and the dead ones again
+        self.queries = queries
+        for (name, state) in list(self.running.items()):
+            if queries.get(name) != state.query:
+                print(f"Stopping query {name}", file=sys.stderr)
+                del self.running[name]
+                self._stop(name, state)
+            elif not state.thread.is_alive():
+                print(f"Restarting query {name}", file=sys.stderr)
+                REGISTRY.counter("query_restarts", {"query": name}).inc()
+                self._start(name, queries[name])
+        for (name, q) in queries.items():
+            if name not in self.running:
+                self._start(name, q)
+
+def handle_queries(config_path, lock):
+    # child process which runs all queries in threads and reloads them on SIGHUP
+    setproctitle.setproctitle("nadiki proton queries")
+    writer = LineWriter(sys.stdout, max_lines=PROTON_OUTPUT_BATCH_LINES, flush_interval=PROTON_OUTPUT_FLUSH_INTERVAL,
+        output_lock=lock)
+    REGISTRY.clear()
+    start_reporting("ingester", writer.write_lines, prometheus=False)
+    runner = QueryThreads(writer)
+    reload_lock = threading.Lock()
+    def reload():
+        with reload_lock:
+            try:
+                runner.update(load_config(config_path)[1])
+            except Exception as e:
+                print(f"Reloading queries from {config_path} failed: {e}", file=sys.stderr)
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload).start())
+    reload()
+    while True:
+        # start the queries whose thread has died again
+        time.sleep(PROTON_QUERY_RESTART_INTERVAL)
+        with reload_lock:
+            runner.update(runner.queries)
+
+if __name__ == "__main__":
+    # create or update the streams, existing streams keep their state
+    (stream_config, queries) = load_config(PROTON_CONFIG)
+    if PROTON_QUERY_MODE != "off":
+        c = client.Client(host=os.environ.get('PROTON_HOST'), port=8463)
+        reconcile_streams(c, stream_config)
+
+    # the query processes and the reports of the metrics of this process write to stdout
+    output_lock = Lock()
+    if PROTON_QUERY_MODE == "threads":
+        # one child for all queries
+        query_child = Process(target=handle_queries, args=(PROTON_CONFIG, output_lock))
+        query_child.start()
+    elif PROTON_QUERY_MODE != "off":
+        # fork one child per query
+        query_processes = QueryProcesses(output_lock)
+        query_processes.update(queries)
+
+    schemas = {s: StreamSchema(s, keys) for (s, keys) in stream_config.items()}
+    reload_lock = threading.Lock()
+
+    def reload():
+        # apply changes of the config file without restarting
+        global schemas
+        with reload_lock:
+            try:
+                (stream_config, queries) = load_config(PROTON_CONFIG)
+                if PROTON_QUERY_MODE != "off":
+                    reconcile_streams(c, stream_config)
+                schemas = {s: (schemas[s] if s in schemas and schemas[s].keys == keys else StreamSchema(s, keys))
+                    for (s, keys) in stream_config.items()}
+                if PROTON_QUERY_MODE == "threads":
+                    os.kill(query_child.pid, signal.SIGHUP)
+                elif PROTON_QUERY_MODE != "off":
+                    query_processes.update(queries)
+                print(f"Reloaded {PROTON_CONFIG}", file=sys.stderr)
+            except Exception as e:
+                print(f"Reloading {PROTON_CONFIG} failed: {e}", file=sys.stderr)
+
+    # the reload runs in a thread of its own so that the signal handler returns immediately
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload).start())
 
     # parent process does the ingestion into proton
-    signal.signal(signal.SIGALRM, dump_metrics)
-    signal.alarm(1)
-    for line in fileinput.input():
-        #print(line, file=sys.stderr)
-        (measurement, tags, fields, ts) = parse_line(line)
-        data.setdefault(measurement, [])
-        #print(f"tags={tags}, k={STREAM_CONFIG[measurement]}", file=sys.stderr)
-        pkey_values = [tags[k] for k in STREAM_CONFIG[measurement]]
-        data[measurement].append(pkey_values + [tags, fields, ts, datetime.datetime.fromtimestamp(int(ts)/10**9, datetime.timezone.utc).strftime("%F %T.%f")])
+    if PROTON_INGEST_TRANSPORT == "native":
+        transport = NativeTransport(os.environ.get('PROTON_HOST'), port=PROTON_NATIVE_PORT,
+            concurrency=PROTON_INGEST_CONCURRENCY, retries=PROTON_INGEST_RETRIES)
+    else:
+        transport = HTTPTransport(PROTON_INGEST_URL, concurrency=PROTON_INGEST_CONCURRENCY,
+            compresslevel=PROTON_INGEST_GZIP_LEVEL, retries=PROTON_INGEST_RETRIES)
+    spool = None
+    flush = transport
+    if PROTON_SPOOL_DIR:
+        spool = Spool(PROTON_SPOOL_DIR, transport.post, concurrency=PROTON_INGEST_CONCURRENCY,
+            segment_size=PROTON_SPOOL_SEGMENT_BYTES, max_size=PROTON_SPOOL_MAX_BYTES,
+            drop_policy=PROTON_SPOOL_DROP_POLICY, fsync=PROTON_SPOOL_FSYNC, max_rate=PROTON_SPOOL_MAX_RATE)
+        spool.start()
+        flush = spool
+    pipeline = FlushPipeline(flush, lambda s: ColumnarBatch(schemas[s]), batch_size=PROTON_BATCH_SIZE, flush_interval=PROTON_FLUSH_INTERVAL, queue_depth=PROTON_QUEUE_DEPTH)
+    pipeline.start()
+
+    lines_parsed = REGISTRY.counter("lines_parsed")
+    lines_ignored = REGISTRY.counter("lines_ignored")
+    # lines which cannot be parsed or lack the timestamp or a primary key tag of their stream
+    lines_invalid = REGISTRY.counter("lines_invalid")
+    REGISTRY.gauge("rows_buffered", function=pipeline.buffered_rows)
+    if spool is not None:
+        REGISTRY.gauge("spool_bytes", function=spool.size)
+        REGISTRY.gauge("spool_batches", function=spool.backlog)
+        REGISTRY.gauge("spool_dropped_rows", function=lambda: spool.dropped_rows)
+    def write_lines(lines):
+        with output_lock:
+            write_stdout(lines)
+    start_reporting("ingester", write_lines)
+
+    unknown = set()
+    def ignore(measurement):
+        if measurement not in unknown:
+            print(f"Ignoring metrics for {measurement}, which has no stream in {PROTON_CONFIG}", file=sys.stderr)
+            unknown.add(measurement)
+    if PROTON_PARSE_WORKERS > 0:
+        parser = ShardedParser(PROTON_PARSE_WORKERS, chunk_size=PROTON_PARSE_CHUNK_BYTES, window=PROTON_PARSE_WINDOW)
+        for (batches, parsed, ignored, invalid, measurements) in parser.parse(sys.stdin.fileno(), lambda: {s: schema.keys for (s, schema) in schemas.items()}):
+            lines_parsed.inc(parsed)
+            lines_ignored.inc(ignored)
+            lines_invalid.inc(invalid)
+            for measurement in measurements:
+                ignore(measurement)
+            for (measurement, rows) in batches.items():
+                if measurement not in schemas or schemas[measurement].keys != rows.schema.keys:
+                    # the config was reloaded while the chunk was parsed
+                    print(f"Dropping {len(rows)} rows for {measurement}, whose stream changed while they were parsed", file=sys.stderr)
+                    lines_ignored.inc(len(rows))
+                    continue
+                pipeline.extend(measurement, rows)
+    else:
+        for line in fileinput.input():
+            #print(line, file=sys.stderr)
+            if is_skipped(line):
+                continue
+            try:
+                (measurement, tags, fields, ts) = parse_line(line, typed=False)
+            except LineProtocolError as e:
+                print(f"Skipping a line: {e}", file=sys.stderr)
+                lines_invalid.inc()
+                continue
+            lines_parsed.inc()
+            if measurement not in schemas:
+                lines_ignored.inc()
+                ignore(measurement)
+                continue
+            try:
+                pipeline.append(measurement, tags, fields, ts)
+            except (KeyError, ValueError, OverflowError) as e:
+                print(f"Skipping a line of {measurement}: {e!r}", file=sys.stderr)
+                lines_invalid.inc()
+    pipeline.close()
+    if spool is not None:
+        spool.close(timeout=PROTON_SPOOL_CLOSE_TIMEOUT)
+    if PROTON_INGEST_TRANSPORT == "native":
+        transport.close()
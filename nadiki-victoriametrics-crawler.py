@@ -8,13 +8,21 @@ import json
 import pprint
 import re
 import datetime, pytz
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-from botocore.exceptions import ClientError
-from botocore.config import Config
+from nadiki_http import make_session, request_with_retry, PermanentHTTPError
+from nadiki_lineprotocol import LineWriter, escape_measurement, escape_key
+from nadiki_metrics import REGISTRY, start_reporting
 
 SOCKS_PROXY=os.environ.get("SOCKS_PROXY")
 
+# number of metrics which are exported concurrently
+VM_CONCURRENCY = int(os.environ.get("VM_CONCURRENCY") or 4)
+# timeout in seconds for connecting and for waiting for the next part of an export
+VM_TIMEOUT = float(os.environ.get("VM_TIMEOUT") or 60)
+
 COUNTRY_CODE = os.environ.get("TAG_COUNTRY_CODE")
 RACK_ID = os.environ.get("TAG_RACK_ID")
 FACILITY_ID = os.environ.get("TAG_FACILITY_ID")
@@ -22,94 +30,292 @@ FACILITY_ID = os.environ.get("TAG_FACILITY_ID")
 # If the remote VictoriaMetrics system delivers timestamps in localtime, set the timezone
 # accordingly in the env variable VM_TIMEZONE.
 VM_TIMEZONE = pytz.timezone(os.environ.get("VM_TIMEZONE") or "UTC")
+VM_CONVERT_TIMEZONE = os.environ.get("VM_TIMEZONE") not in (None, "UTC")
+
+# maximum number of series whose tags are kept pre-rendered
+VM_SERIES_CACHE_SIZE = int(os.environ.get("VM_SERIES_CACHE_SIZE") or 100000)
+# report the hit rates of the caches on stderr after every poll
+VM_CACHE_STATS = (os.environ.get("VM_CACHE_STATS") or "false").lower() in ("1", "true", "yes")
+
+# Only fetch the points which are newer than the last point emitted for each series,
+# instead of the whole last hour on every poll. The timestamps of the last points are
+# kept in a checkpoint file, so they survive restarts.
+VM_INCREMENTAL = (os.environ.get("VM_INCREMENTAL") or "true").lower() not in ("0", "false", "no")
+VM_CHECKPOINT_FILE = os.environ.get("VM_CHECKPOINT_FILE") or "nadiki-victoriametrics-checkpoint.json"
+# seconds to look back before the oldest last point of a metric. Points at or before the
+# last emitted point of their series are still dropped, even if they arrive late, so this
+# only picks up the first points of series which have no last point yet (new series, or
+# series forgotten after VM_MAX_LOOKBACK)
+VM_LOOKBACK = float(os.environ.get("VM_LOOKBACK") or 60)
+# never look back further than this (and forget series which have not been seen for so long)
+VM_MAX_LOOKBACK = 3600
+
+# the crawler's own metrics (export latency, errors, points) are reported in the
+# measurement nadiki_internal, see nadiki_metrics.py for the NADIKI_METRICS_* settings
+api_seconds = REGISTRY.histogram("api_seconds", {"api": "victoriametrics"})
+api_errors = REGISTRY.counter("api_errors", {"api": "victoriametrics"})
+points_output = REGISTRY.counter("points_output")
+poll_seconds = REGISTRY.histogram("poll_seconds")
+checkpoint_errors = REGISTRY.counter("checkpoint_errors")
+
+# the mapping of instance IPs to our server IDs is read from TAG_SERVER_ID_MAPPING_FILE
+# if it is set (e.g. for testing), otherwise it is fetched from secrets manager
+if os.environ.get("TAG_SERVER_ID_MAPPING_FILE"):
+    with open(os.environ.get("TAG_SERVER_ID_MAPPING_FILE")) as f:
+        raw = f.read()
+else:
+    import boto3
+    from botocore.config import Config
 
-# fetch the mapping of instance IPs to our server IDs from secrets manager
-session = boto3.session.Session()
-my_config = Config(
-    region_name = os.environ.get("AWS_REGION") # Why do we need this?
-)
-client = session.client(service_name='secretsmanager', config=my_config)
+    session = boto3.session.Session()
+    my_config = Config(
+        region_name = os.environ.get("AWS_REGION") # Why do we need this?
+    )
+    client = session.client(service_name='secretsmanager', config=my_config)
 
-raw = client.get_secret_value(SecretId=os.environ.get("TAG_SERVER_ID_MAPPING_SECRETS_ARN"))["SecretString"]
+    raw = client.get_secret_value(SecretId=os.environ.get("TAG_SERVER_ID_MAPPING_SECRETS_ARN"))["SecretString"]
 SERVER_IDS = json.loads(raw)
 
-last_timestamp = dict()
+
+class HighWaterMarks:
+    """
+    Timestamp (in milliseconds, as delivered by VictoriaMetrics) of the newest emitted
+    point of every series, per query, persisted in a checkpoint file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.marks = {}  # query -> series key -> timestamp
+        try:
+            with open(path) as f:
+                self.marks = json.load(f)["queries"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"ignoring checkpoint file {path}: {e}", file=sys.stderr)
+
+    def save(self):
+        # write to a temporary file first, so a crash does not leave a broken checkpoint
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as f:
+            json.dump({"queries": self.marks}, f)
+        os.replace(temp, self.path)
+
+    def start(self, query):
+        """
+        Value of the start parameter of the export for a query
+        """
+        marks = self.marks.get(query)
+        if not marks:
+            return "-1h"
+        # forget series which have not delivered points for a long time, they would
+        # make every export of the query look back as far as their last point
+        newest = max(marks.values())
+        for (key, ts) in list(marks.items()):
+            if ts < newest - VM_MAX_LOOKBACK * 1000:
+                del marks[key]
+        return f"{(min(marks.values()) - VM_LOOKBACK * 1000) / 1000:.3f}"
+
+    def is_new(self, query, key, timestamp):
+        return timestamp > self.marks.get(query, {}).get(key, -1)
+
+    def update(self, query, key, timestamp):
+        self.marks.setdefault(query, {})[key] = timestamp
+
+
+def line_prefix(labels):
+    """
+    Measurement and tags of the lines of a series, up to and including "value="
+    """
+    # the __name__ tag is used as measurement name
+    metricname = labels["__name__"]
+    tags = {k: v for (k, v) in labels.items() if k != "__name__"}
+
+    server_id = "unknown_server"
+    try:
+        server_id = SERVER_IDS[tags['instance']]
+    except KeyError as e:
+        print(f"unknown instance {tags.get('instance')}", file=sys.stderr)
+
+    # add tags required according to Nadiki spec
+    tags.update(server_id=server_id, rack_id=RACK_ID, country_code=COUNTRY_CODE, facility_id=FACILITY_ID)
+    tag_string = ",".join([f"{escape_key(k)}={escape_key(str(v))}" for (k, v) in tags.items() if v is not None and v != ""])
+    return f"{escape_measurement(metricname)},{tag_string} value="
+
+
+class SeriesCache:
+    """
+    Bounded LRU cache from the labels of a series to its key in the checkpoint and the
+    start of its lines (see line_prefix()), with hit counters
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, labels):
+        key = tuple(labels.items())
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = (json.dumps(labels, sort_keys=True), line_prefix(labels))
+        with self.lock:
+            self.entries[key] = entry
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+class UTCOffsets:
+    """
+    Conversion of local timestamps of VictoriaMetrics into UTC, the UTC offset of the timezone is
+    cached per quarter of an hour (all timezones change their offset at full quarters of an hour)
+    """
+    BUCKET = 900000  # milliseconds
+
+    def __init__(self, timezone, max_size=100000):
+        self.timezone = timezone
+        self.max_size = max_size
+        self.offsets = {}  # timestamp // BUCKET -> offset in seconds
+        self.hits = 0
+        self.misses = 0
+
+    def to_utc_ns(self, timestamp):
+        """
+        Convert a timestamp in milliseconds into UTC and into nanoseconds
+        """
+        bucket = timestamp // self.BUCKET
+        utc_offset = self.offsets.get(bucket)
+        if utc_offset is None:
+            self.misses += 1
+            utc_offset = datetime.datetime.fromtimestamp(bucket * self.BUCKET / 1000, self.timezone).utcoffset().total_seconds()
+            if len(self.offsets) >= self.max_size:
+                self.offsets = {}
+            self.offsets[bucket] = utc_offset
+        else:
+            self.hits += 1
+        return int((timestamp/1000-utc_offset) * 10**9)
+
+
+def hit_rate(cache):
+    total = cache.hits + cache.misses
+    return f"{100 * cache.hits / total:.1f}% of {total}" if total else "no lookups"
+
 
 class VMQuery:
 
-    def __init__(self, url):
+    def __init__(self, url, marks=None, session=None, series=None, offsets=None):
         self.url = url
+        self.marks = marks
+        self.session = session if session is not None else make_session(proxy=SOCKS_PROXY)
+        self.series = series if series is not None else SeriesCache()
+        self.offsets = offsets  # UTCOffsets if the timestamps are not in UTC
     
     def query(self, metricname):
+        """
+        Stream the export of a metric, yields the non-empty lines (one per series)
+        """
         #response = requests.get(f"{self.url}/select/0/prometheus/api/v1/query?query={metricname}", proxies=dict(http=SOCKS_PROXY, https=SOCKS_PROXY))
         # We use the VictoriaMetrics expor instead of the query endpoint because we need stable timestamps without interpolation:
-        if SOCKS_PROXY != None:
-            response = requests.get(f"{self.url}/select/0/prometheus/api/v1/export?match[]={metricname}&start=-1h", proxies=dict(http=SOCKS_PROXY, https=SOCKS_PROXY))
-        else:
-            response = requests.get(f"{self.url}/select/0/prometheus/api/v1/export?match[]={metricname}&start=-1h")
-        response.raise_for_status()
-        return response.text
+        start = self.marks.start(metricname) if self.marks is not None else "-1h"
+        params = {"match[]": metricname, "start": start}
+        # the latency until the export starts, the points are streamed afterwards
+        with api_seconds.time():
+            response = request_with_retry(self.session, "GET", f"{self.url}/select/0/prometheus/api/v1/export",
+                params=params, stream=True, timeout=VM_TIMEOUT)
+        with response:
+            for line in response.iter_lines(chunk_size=1 << 16):
+                if line.strip(): # ignore empty lines
+                    yield line
 
-    def process_data_point(self, line):
-        data_point = json.loads(line)
-        timestamp = data_point["timestamps"][0]
-#        # only consider lines newer than the last one seen
-#        try:
-#            last_ts = last_timestamp[f'{data_point["metric"]["__name__"]}/{data_point["metric"]["instance"]}']
-#            if last_ts >= timestamp:
-#                continue
-#        except:
-#            pass
-
-        last_timestamp[f'{data_point["metric"]["__name__"]}/{data_point["metric"]["instance"]}'] = timestamp
-
-        # remove the __name__ tag because we use this as measurement name anyway
-        metricname = data_point["metric"]["__name__"]
-        del(data_point["metric"]["__name__"])
-
-
-        server_id = "unknown_server"
+    def fetch(self, metricname, write):
+        """
+        Export a metric and write every point with write() as soon as it was received
+        """
         try:
-            server_id = SERVER_IDS[data_point['metric']['instance']]
-        except KeyError as e:
-            print(f"unknown instance {data_point['metric']['instance']}", file=sys.stderr)
-
-        tag_string = ",".join([f"{k}={data_point['metric'][k]}" for k in data_point["metric"]] \
-            + [ \
-                f"server_id={server_id}", \
-                f"rack_id={RACK_ID}", \
-                f"country_code={COUNTRY_CODE}", \
-                f"facility_id={FACILITY_ID}"]) # add tags required according to Nadiki spec
+            for line in self.query(metricname):
+                results = self.process_data_point(line, metricname)
+                for result in results:
+                    write(result)
+                points_output.inc(len(results))
+        except Exception:
+            api_errors.inc()
+            raise
 
-        field_string = f"value={data_point['values'][0]}"
+    def process_data_point(self, line, metricquery=None):
+        """
+        Convert an export line into lines of line protocol, one per point (with incremental
+        fetching only the points which have not been emitted yet)
+        """
+        data_point = json.loads(line)
+        (key, prefix) = self.series.get(data_point["metric"])
+        points = zip(data_point["timestamps"], data_point["values"])
+        if self.marks is not None:
+            # only consider points newer than the last one emitted for this series
+            points = [(ts, value) for (ts, value) in points if self.marks.is_new(metricquery, key, ts)]
+            if not points:
+                return []
+            self.marks.update(metricquery, key, max(ts for (ts, _) in points))
 
         # we need to convert the timestamp from VictoriaMetrics into UTC and into nanoseconds
-        if os.environ.get("VM_TIMEZONE") == None or os.environ.get("VM_TIMEZONE") == "UTC":
-            nanosecond_utc_timestamp = timestamp * 10**6
-        else:
-            utc_offset = datetime.datetime.fromtimestamp(timestamp/1000, VM_TIMEZONE).utcoffset().total_seconds()
-            nanosecond_utc_timestamp = int((timestamp/1000-utc_offset) * 10**9)
-            #print(f"old timestamp {timestamp} ({datetime.datetime.fromtimestamp(timestamp/1000, VM_TIMEZONE)}), new timestamp {nanosecond_utc_timestamp} ({datetime.datetime.fromtimestamp(nanosecond_utc_timestamp/10**9)}), offset {utc_offset}", file=sys.stderr)
-        return f"{metricname},{tag_string} {field_string} {nanosecond_utc_timestamp}"
+        if self.offsets is None:
+            return [f"{prefix}{value} {timestamp * 10**6}" for (timestamp, value) in points]
+        to_utc_ns = self.offsets.to_utc_ns
+        return [f"{prefix}{value} {to_utc_ns(timestamp)}" for (timestamp, value) in points]
+
+
+METRICS = []
+if os.environ.get("VICTORIA_METRICS_METRIC") != None:
+    METRICS.append(os.environ.get("VICTORIA_METRICS_METRIC"))
+if os.environ.get("VICTORIA_METRICS_METRICS") != None:
+    METRICS.extend(os.environ.get("VICTORIA_METRICS_METRICS").split(","))
 
+marks = HighWaterMarks(VM_CHECKPOINT_FILE) if VM_INCREMENTAL else None
+vmq = VMQuery(os.environ.get("VICTORIA_METRICS_URL"), marks, make_session(pool_size=VM_CONCURRENCY, proxy=SOCKS_PROXY),
+    SeriesCache(VM_SERIES_CACHE_SIZE), UTCOffsets(VM_TIMEZONE) if VM_CONVERT_TIMEZONE else None)
+executor = ThreadPoolExecutor(max_workers=VM_CONCURRENCY, thread_name_prefix="vm-export")
+writer = LineWriter(sys.stdout)
+poll_lock = threading.Lock()
 
 def signal_handler(a,b):
-#    pprint.pprint(last_timestamp)
-    vmq = VMQuery(os.environ.get("VICTORIA_METRICS_URL"))
-    metrics = []
-    if os.environ.get("VICTORIA_METRICS_METRIC") != None:
-        metrics.append(os.environ.get("VICTORIA_METRICS_METRIC"))
-    if os.environ.get("VICTORIA_METRICS_METRICS") != None:
-        metrics.extend(os.environ.get("VICTORIA_METRICS_METRICS").split(","))
-
-    for metric in metrics:
-        r = vmq.query(metric)
-        for line in r.split("\n"):
-            if not line.strip(): # ignore empty lines
-                continue
-            print(vmq.process_data_point(line))
+    if not poll_lock.acquire(blocking=False):
+        print("previous poll is still running, skipping this one", file=sys.stderr)
+        return
+    try:
+        with poll_seconds.time():
+            # the exports run concurrently, every worker writes its points as they arrive
+            futures = [executor.submit(vmq.fetch, metric, writer.write_line) for metric in METRICS]
+            for (metric, future) in zip(METRICS, futures):
+                try:
+                    future.result()
+                except (requests.RequestException, PermanentHTTPError, ValueError, KeyError) as e:
+                    print(f"exporting {metric} failed: {e}", file=sys.stderr)
+            writer.flush()
+        if marks is not None:
+            try:
+                marks.save()
+            except OSError as e:
+                # keep crawling, the marks stay in memory and the next poll saves them again
+                print(f"saving checkpoint file {marks.path} failed: {e}", file=sys.stderr)
+                checkpoint_errors.inc()
+        if VM_CACHE_STATS:
+            stats = f"series cache: {len(vmq.series.entries)} series, hit rate {hit_rate(vmq.series)}"
+            if vmq.offsets is not None:
+                stats += f", timezone offsets: hit rate {hit_rate(vmq.offsets)}"
+            print(stats, file=sys.stderr)
+    finally:
+        poll_lock.release()
 
 def main():
+    REGISTRY.gauge("series_cached", function=lambda: len(vmq.series.entries))
+    start_reporting("victoriametrics-crawler", writer.write_lines)
     signal.signal(signal.SIGHUP, signal_handler)
     while True:
         time.sleep(60)
@@ -0,0 +1,203 @@
+"""
+Conversion of counters into gauges for the counter processor
+
+Inputs like net, diskio and node_exporter deliver counters which only
+increase (bytes sent, CPU seconds). For every series the difference
+between the values of a metric and the previous metric of the series is
+emitted, with the tags and timestamp of the later metric:
+
+    value = (value - previous value)                          by default
+    value = (value - previous value) / elapsed seconds        with calculate_ratio
+    value = 1 - (value - previous value) / elapsed seconds    with calculate_ratio and invert
+
+Fields which are not numbers (including booleans) are left out.
+
+A series is identified by the measurement, the names of the fields and
+the values of the key tags, e.g. device for IO metrics. These are the
+semantics of the Starlark script diff.star which this replaces, but only
+the timestamp and the field values of the last metric of a series are
+kept instead of a copy of the whole metric.
+
+A counter which decreases has either wrapped around or was reset (e.g.
+by a reboot). Integers which were close to 2**64, or to 2**32 for the
+fields which are known to be 32-bit counters (e.g. SNMP Counter32), are
+taken to have wrapped, and their increase is counted across the wrap.
+A value close to 2**32 is no proof of a 32-bit counter, so for other
+fields such a drop is a reset. On a reset the field is left out once and
+the series continues from the new value,
+so no negative differences are emitted. Metrics whose timestamp is not
+newer than the last one of their series (repeated or out of order) are
+dropped without changing the series.
+
+Series which have not been seen for the TTL are expired, and the number
+of series is limited (least recently used series go first).
+"""
+
+import time
+from collections import OrderedDict
+
+from nadiki_lineprotocol import format_line
+
+# sizes of the counters of the kernel and of SNMP, the first applies to known 32-bit counters only
+COUNTER32_LIMITS = (2**32, 2**64)
+WRAP_LIMITS = (2**64,)
+# a decreasing counter wrapped if it was within this fraction of the limit, otherwise it was reset
+WRAP_MARGIN = 0.1
+
+
+def counter_wrap(value, last, limits=WRAP_LIMITS):
+    """
+    Increase of an integer counter which decreased from last to value by wrapping around
+
+    Args:
+        limits (tuple): the sizes the counter can have, COUNTER32_LIMITS for 32-bit counters
+    Returns:
+        int: the increase, or None if the counter was reset
+    """
+    # ints and Unsigned, the caller leaves out bools
+    if not isinstance(value, int) or not isinstance(last, int):
+        return None
+    for limit in limits:
+        if last < limit:
+            if limit - last <= limit * WRAP_MARGIN:
+                return limit - last + value
+            return None
+    return None
+
+
+class CounterState:
+    """
+    Last metric of one series
+    """
+    __slots__ = ("ts", "values")
+
+    def __init__(self, ts, values):
+        self.ts = ts          # timestamp in nanoseconds
+        self.values = values  # tuple of the field values, in the order of the field names in the key
+
+
+class CounterDiff:
+    """
+    Keyed difference engine for counters
+
+    Args:
+        key_tags (list): names of the tags which distinguish the series of a measurement
+        calculate_ratio (bool): divide the differences by the elapsed seconds
+        invert (bool): subtract the results from 1 (e.g. idle CPU seconds -> busy fraction)
+        ttl (float): seconds (in data time) after which series without new metrics are dropped
+        max_series (int): maximum number of series, the least recently updated ones are dropped first
+        counter32_fields (list): names of the fields which are 32-bit counters and can wrap at 2**32
+    """
+
+    def __init__(self, key_tags=(), calculate_ratio=False, invert=False, ttl=900, max_series=100000,
+                 counter32_fields=()):
+        self.key_tags = tuple(key_tags)
+        self.counter32_fields = frozenset(counter32_fields)
+        self.calculate_ratio = calculate_ratio
+        self.invert = invert
+        self.ttl = int(ttl * 10**9)
+        self.max_series = max_series
+        self.series = OrderedDict()  # key -> CounterState, least recently updated first
+        self.newest = 0  # newest timestamp seen in any series
+        self.expired = 0
+        self.resets = 0
+        self.wraps = 0
+        self.dropped = 0  # repeated or out of order metrics
+
+    def __len__(self):
+        return len(self.series)
+
+    def stats(self):
+        """
+        Number of series, expired series, resets, wraps and dropped metrics
+        """
+        return {"series": len(self.series), "expired": self.expired, "resets": self.resets,
+            "wraps": self.wraps, "dropped": self.dropped}
+
+    def _expire(self):
+        # drop series which have not been updated for the TTL, oldest first
+        limit = self.newest - self.ttl
+        while self.series:
+            (key, state) = next(iter(self.series.items()))
+            if state.ts >= limit:
+                break
+            del self.series[key]
+            self.expired += 1
+
+    def process(self, measurement, tags, fields, ts):
+        """
+        Process one metric
+
+        Returns:
+            tuple: (measurement, tags, fields, timestamp) with the differences, or None
+                for the first metric of a series and for dropped metrics
+        """
+        if ts is None:
+            ts = time.time_ns()
+        tags_get = tags.get
+        key = (measurement, tuple(fields), tuple([tags_get(k, "") for k in self.key_tags]))
+        values = tuple(fields.values())
+        series = self.series
+        state = series.get(key)
+        if state is None:
+            series[key] = CounterState(ts, values)
+            if len(series) > self.max_series:
+                series.popitem(last=False)
+                self.expired += 1
+            self._advance(ts)
+            return None
+        last_ts = state.ts
+        if ts <= last_ts:
+            self.dropped += 1
+            return None
+        series.move_to_end(key)
+        self._advance(ts)
+        divisor = (ts - last_ts) / 1000000000 if self.calculate_ratio else 1
+        result = {}
+        for (name, value, last) in zip(key[1], values, state.values):
+            if type(value) is bool or type(last) is bool:
+                # bool is an int, but True - False is no difference of a counter
+                continue
+            try:
+                delta = value - last
+            except TypeError:
+                continue
+            if delta < 0:
+                delta = counter_wrap(value, last, COUNTER32_LIMITS if name in self.counter32_fields else WRAP_LIMITS)
+                if delta is None:
+                    self.resets += 1
+                    continue
+                self.wraps += 1
+            if self.invert:
+                result[name] = 1 - delta / divisor
+            else:
+                result[name] = delta / divisor
+        state.ts = ts
+        state.values = values
+        if not result:
+            return None
+        return (measurement, tags, result, ts)
+
+    def _advance(self, ts):
+        if ts > self.newest:
+            self.newest = ts
+            if self.series and next(iter(self.series.values())).ts < ts - self.ttl:
+                self._expire()
+
+    def process_batch(self, metrics):
+        """
+        Process many metrics at once
+
+        Args:
+            metrics (iterable): (measurement, tags, fields, timestamp) tuples in the order
+                they were received
+        Returns:
+            list: the differences as lines of Influx line protocol (without newlines)
+        """
+        process = self.process
+        lines = []
+        for metric in metrics:
+            result = process(*metric)
+            if result is not None:
+                lines.append(format_line(*result))
+        return lines
@@ -0,0 +1,935 @@
+"""
+Conversion of power readings into consumed energy for the server processor
+
+The inputs ipmi_sensor, intel_powerstat and nvidia_smi deliver power
+draws in watts. For every series (a server, or a CPU package or GPU of a
+server) the energy consumed between two readings is calculated from the
+earlier reading and the elapsed time:
+
+    joules = watts * (fraction of an hour between the readings) * 3600000
+
+and emitted with the timestamp of the earlier reading (rectangle rule).
+With the trapezoid rule the mean of both readings is used instead, which
+is more accurate when the power draw changes or the readings are
+irregular.
+
+CPU power is the sum of two fields, current_power_consumption_watts and
+current_dram_power_consumption_watts, which may arrive in separate lines
+with the same timestamp. Readings which are still waiting for their
+partner are kept per series and dropped when a later timestamp of the
+series is complete or when they are older than the TTL, so they cannot
+pile up.
+
+Every CPU package and GPU is integrated as a series of its own, so
+readings of several sockets or GPUs no longer overwrite each other. Their
+energy is summed up per server and emitted as one cpu_ and one
+gpu_energy_consumption_joules per server and timestamp, like before: the
+total of an interval start is complete, and emitted, when the first
+interval of the server which starts later arrives. An interval which
+starts before the total being summed up arrives too late for its own
+total and is added to the current one instead (counted in late), so no
+energy is lost. flush() emits the totals which are still open, e.g. at
+the end of the input. With per_device, the energy of every package and GPU
+is emitted instead, tagged with cpu and index like the watts metrics of
+telegraf.conf.
+
+Series which have not been seen for the TTL are expired, and the number
+of series is limited (least recently used series go first). This allows
+one processor to handle the metrics of many servers.
+
+process() handles one metric at a time. process_batch() handles the
+metrics of a short window at once, calculates the energy with NumPy and
+returns the serialized lines.
+
+EnergyReplay processes archived line protocol files offline with the same
+results as the streaming path, see its documentation.
+"""
+
+import json
+import mmap
+import os
+import sys
+from array import array
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:  # only needed by EnergyIntegrator.process_batch()
+    numpy = None
+
+from nadiki_lineprotocol import escape_key, parse_line, LineProtocolError
+
+JOULES_PER_KWH = 3600000
+SECONDS_PER_HOUR = 3600
+
+# the tags required by the Nadiki spec for the server measurement
+SERVER_TAGS = ("country_code", "facility_id", "rack_id", "server_id")
+
+# maximum number of incomplete CPU timestamps kept per series
+MAX_PENDING = 16
+
+INTEGRATION_METHODS = ("rectangle", "trapezoid")
+
+CPU_FIELDS = ("current_power_consumption_watts", "current_dram_power_consumption_watts")
+
+
+def energy_joules(watts, last_ts, ts):
+    """
+    Energy consumed with a power draw of watts between the nanosecond timestamps last_ts and ts
+    """
+    diff = (ts - last_ts) / 10**9
+    # fraction of an hour between the last two points
+    fraction = diff / SECONDS_PER_HOUR
+    # convert kWh to Joules (actually we could simplify the division by 3600 above and the
+    # multiplication with 3600000 here, but this makes it clearer)
+    return watts * fraction * JOULES_PER_KWH
+
+
+def series_of(measurement, tags, fields):
+    """
+    Classify a metric
+
+    Returns:
+        tuple: (kind, key, index_tag) where kind is "cpu", "server" or "gpu", key identifies
+            the series and index_tag is the (name, value) of the tag which distinguishes
+            packages or GPUs of a server (or None); None if the metric carries no power reading
+    """
+    if measurement == "powerstat_package":
+        if CPU_FIELDS[0] not in fields and CPU_FIELDS[1] not in fields:
+            return None
+        # intel_powerstat calls the tag package_id, the watts metrics call it cpu (see telegraf.conf)
+        package = tags.get("package_id", tags.get("package"))
+        return "cpu", ("cpu", tags.get("server_id"), package), (("cpu", package) if package is not None else None)
+    if measurement == "ipmi_sensor" and tags.get("name") == "instantaneous_power_reading":
+        return "server", ("server", tags.get("server_id")), None
+    if measurement == "nvidia_smi" and "power_draw" in fields:
+        gpu = tags.get("index")
+        return "gpu", ("gpu", tags.get("server_id"), gpu), (("index", gpu) if gpu is not None else None)
+    return None
+
+
+def output_tags(tags, index_tag):
+    # tags of the emitted energy metrics
+    result = {k: tags[k] for k in SERVER_TAGS}
+    if index_tag is not None:
+        result[index_tag[0]] = index_tag[1]
+    return result
+
+
+def line_prefix(tags, field):
+    # the part of an emitted line before the value, same as format_line() produces
+    head = ",".join(["server"] + [f"{escape_key(k)}={escape_key(str(v))}" for (k, v) in tags.items() if v is not None and v != ""])
+    return f"{head} {escape_key(field)}="
+
+
+class SeriesState:
+    """
+    Integration state of one series
+    """
+    __slots__ = ("kind", "tags", "field", "prefix", "total", "last_ts", "last_watts", "seen", "pending")
+
+    def __init__(self, kind, tags, summed=False):
+        self.kind = kind
+        self.tags = tags          # tags of the emitted metrics
+        self.field = f"{kind}_energy_consumption_joules"
+        self.prefix = None        # start of the emitted lines, see line_prefix()
+        # key of the server total the energy is added to, None if it is emitted as it is
+        self.total = (self.field, tuple(tags.items())) if summed else None
+        self.last_ts = None       # timestamp of the last complete reading
+        self.last_watts = None    # power draw of the last complete reading
+        self.seen = None          # newest timestamp seen for this series
+        self.pending = None       # CPU only: timestamp -> [cpu watts, dram watts]
+
+
+def summed_state(kind, tags, index_tag, per_device):
+    # the state of a new series, the energy of packages and GPUs is summed up per server unless per_device
+    if per_device or kind == "server":
+        return SeriesState(kind, output_tags(tags, index_tag))
+    return SeriesState(kind, output_tags(tags, None), summed=True)
+
+
+class ServerTotal:
+    """
+    Energy of the intervals of the packages or GPUs of a server which start at ts
+    """
+    __slots__ = ("ts", "joules")
+
+    def __init__(self, ts, joules):
+        self.ts = ts
+        self.joules = joules
+
+
+class EnergyIntegrator:
+    """
+    Keyed integration engine for power readings
+
+    Args:
+        ttl (float): seconds (in data time) after which incomplete readings and
+            series without new readings are dropped
+        max_series (int): maximum number of series, the least recently updated
+            ones are dropped first
+        method (str): integration method, "rectangle" or "trapezoid"
+        per_device (bool): emit the energy of every CPU package and GPU instead of the totals per server
+    """
+
+    def __init__(self, ttl=900, max_series=100000, method="rectangle", per_device=False):
+        if method not in INTEGRATION_METHODS:
+            raise ValueError(f"unknown integration method {method!r}, use one of {', '.join(INTEGRATION_METHODS)}")
+        self.method = method
+        self.ttl = int(ttl * 10**9)
+        self.max_series = max_series
+        self.per_device = per_device
+        self.series = OrderedDict()  # key -> SeriesState, least recently updated first
+        self.totals = OrderedDict()  # key of a server total -> ServerTotal, least recently updated first
+        self.expired = 0
+        self.late = 0    # intervals which were added to a server total with a later start
+        self.newest = 0  # newest timestamp seen in any series
+
+    def __len__(self):
+        return len(self.series)
+
+    def stats(self):
+        """
+        Number of series, incomplete CPU readings, expired series and late intervals
+        """
+        pending = sum(len(s.pending) for s in self.series.values() if s.pending)
+        return {"series": len(self.series), "pending": pending, "expired": self.expired, "late": self.late}
+
+    def _state(self, kind, key, tags, index_tag):
+        state = self.series.get(key)
+        if state is None:
+            state = self.series[key] = summed_state(kind, tags, index_tag, self.per_device)
+            if len(self.series) > self.max_series:
+                self.series.popitem(last=False)
+                self.expired += 1
+        else:
+            self.series.move_to_end(key)
+        return state
+
+    def _expire(self):
+        # drop series which have not been updated for the TTL, oldest first
+        limit = self.newest - self.ttl
+        while self.series:
+            (key, state) = next(iter(self.series.items()))
+            if state.seen is None or state.seen >= limit:
+                break
+            del self.series[key]
+            self.expired += 1
+
+    def _complete(self, state, ts, watts):
+        # a complete reading, returns the previous reading if the interval between them
+        # can be integrated, otherwise None
+        last_ts = state.last_ts
+        if last_ts is not None and ts <= last_ts:
+            # repeated or out of order reading
+            return None
+        last_watts = state.last_watts
+        state.last_ts = ts
+        state.last_watts = watts
+        if last_ts is None:
+            return None
+        return (state, last_ts, last_watts, watts)
+
+    def _accept(self, measurement, tags, fields, ts):
+        # update the state with one metric, returns (state, previous timestamp, previous
+        # power draw, power draw) if an interval is complete, otherwise None
+        classified = series_of(measurement, tags, fields)
+        if classified is None:
+            return None
+        (kind, key, index_tag) = classified
+        state = self._state(kind, key, tags, index_tag)
+        if state.seen is None or ts > state.seen:
+            state.seen = ts
+        if ts > self.newest:
+            self.newest = ts
+            if self.series and next(iter(self.series.values())).seen < ts - self.ttl:
+                self._expire()
+
+        if kind != "cpu":
+            watts = float(fields["value"] if kind == "server" else fields["power_draw"])
+            return self._complete(state, ts, watts)
+
+        # CPU: wait until both the package and the DRAM power draw have arrived
+        if state.pending is None:
+            state.pending = {}
+        parts = state.pending.get(ts)
+        if parts is None:
+            parts = state.pending[ts] = [None, None]
+        for (i, name) in enumerate(CPU_FIELDS):
+            if name in fields:
+                parts[i] = float(fields[name])
+        if parts[0] is None or parts[1] is None:
+            if len(state.pending) > MAX_PENDING or min(state.pending) < ts - self.ttl:
+                self._drop_pending(state, ts)
+            return None
+        del state.pending[ts]
+        # readings before this one can not become complete anymore
+        self._drop_pending(state, ts)
+        return self._complete(state, ts, parts[0] + parts[1])
+
+    def _add_total(self, state, ts, joules):
+        # add the energy of an interval starting at ts to the total of its server, returns the
+        # (timestamp, joules) of the previous total once an interval which starts later arrives
+        totals = self.totals
+        total = totals.get(state.total)
+        if total is None:
+            totals[state.total] = ServerTotal(ts, joules)
+            if len(totals) > self.max_series:
+                totals.popitem(last=False)
+                self.expired += 1
+            return None
+        totals.move_to_end(state.total)
+        if ts <= total.ts:
+            if ts < total.ts:
+                # the total of its start has been emitted already
+                self.late += 1
+            total.joules += joules
+            return None
+        done = (total.ts, total.joules)
+        total.ts = ts
+        total.joules = joules
+        return done
+
+    def process(self, measurement, tags, fields, ts):
+        """
+        Process one metric
+
+        Returns:
+            tuple: (measurement, tags, fields, timestamp) of the energy metric which
+                could be calculated with this reading, or None
+        """
+        interval = self._accept(measurement, tags, fields, ts)
+        if interval is None:
+            return None
+        (state, last_ts, last_watts, watts) = interval
+        if self.method == "trapezoid":
+            last_watts = (last_watts + watts) / 2
+        joules = energy_joules(last_watts, last_ts, ts)
+        if state.total is not None:
+            done = self._add_total(state, last_ts, joules)
+            if done is None:
+                return None
+            (last_ts, joules) = done
+        return ("server", state.tags, {state.field: joules}, last_ts)
+
+    def flush(self):
+        """
+        Emit the server totals which are still being summed up, e.g. at the end of the input
+
+        Returns:
+            list: (measurement, tags, fields, timestamp) tuples, least recently updated first
+        """
+        result = [("server", dict(tags), {field: total.joules}, total.ts)
+            for ((field, tags), total) in self.totals.items()]
+        self.totals.clear()
+        return result
+
+    def process_batch(self, metrics):
+        """
+        Process many metrics at once
+
+        The readings are matched up one by one, the energy of all intervals is then
+        calculated with NumPy. The results are the same as with process().
+
+        Args:
+            metrics (iterable): (measurement, tags, fields, timestamp) tuples in the order
+                they were received
+        Returns:
+            list: the energy metrics as lines of Influx line protocol (without newlines)
+        """
+        if numpy is None:
+            raise RuntimeError("process_batch() requires numpy")
+        states = []
+        starts = []
+        ends = []
+        start_watts = []
+        end_watts = []
+        accept = self._accept
+        for (measurement, tags, fields, ts) in metrics:
+            interval = accept(measurement, tags, fields, ts)
+            if interval is not None:
+                states.append(interval[0])
+                starts.append(interval[1])
+                ends.append(ts)
+                start_watts.append(interval[2])
+                end_watts.append(interval[3])
+        if not states:
+            return []
+        start = numpy.array(starts, dtype=numpy.int64)
+        watts = numpy.array(start_watts, dtype=numpy.float64)
+        if self.method == "trapezoid":
+            watts = (watts + numpy.array(end_watts, dtype=numpy.float64)) / 2
+        # the same operations in the same order as energy_joules()
+        diff = (numpy.array(ends, dtype=numpy.int64) - start) / 10**9
+        fraction = diff / SECONDS_PER_HOUR
+        joules = watts * fraction * JOULES_PER_KWH
+        lines = []
+        append = lines.append
+        add_total = self._add_total
+        for (state, value, ts) in zip(states, joules.tolist(), starts):
+            if state.total is not None:
+                done = add_total(state, ts, value)
+                if done is None:
+                    continue
+                (ts, value) = done
+            prefix = state.prefix
+            if prefix is None:
+                prefix = state.prefix = line_prefix(state.tags, state.field)
+            append(f"{prefix}{value!r} {ts}")
+        return lines
+
+    def _drop_pending(self, state, ts):
+        # drop incomplete readings which are older than ts or the TTL, keep at most MAX_PENDING
+        for pending_ts in sorted(state.pending):
+            if pending_ts < ts or pending_ts < self.newest - self.ttl or len(state.pending) > MAX_PENDING:
+                del state.pending[pending_ts]
+
+
+# measurements with power readings, see series_of()
+REPLAY_MEASUREMENTS = (b"ipmi_sensor", b"powerstat_package", b"nvidia_smi")
+# the fields with the power draw per measurement
+REPLAY_FIELDS = ((b"value",), tuple(f.encode() for f in CPU_FIELDS), (b"power_draw",))
+# flags of a reading: which part of the power draw it carries (CPU: package, DRAM; others both)
+FIRST, SECOND = 1, 2
+# longest field value which is converted with NumPy, and the bytes it may consist of (so
+# NumPy reads it like float() and parse_line() does not take it for an integer or boolean)
+MAX_VALUE_BYTES = 32
+NUMBER_BYTES = numpy.isin(numpy.arange(256), list(b"0123456789.+-eE")) if numpy else None
+# longest measurement and tags part which is compared with NumPy
+PADDING = 512
+# the digits of a timestamp
+POWERS_OF_TEN = numpy.uint64(10) ** numpy.arange(18, -1, -1, dtype=numpy.uint64) if numpy else None
+# odd factors of the hash of the measurement and tags parts, one per eight bytes
+HASH_FACTORS = numpy.arange(1, 2 * PADDING // 8, 2, dtype=numpy.uint64) * numpy.uint64(0x9e3779b97f4a7c15) if numpy else None
+
+
+def _gather(padded, starts, width):
+    # the bytes starting at starts as rows of width bytes
+    return numpy.lib.stride_tricks.sliding_window_view(padded, width)[starts]
+
+
+# The helpers of EnergyReplay._scan_window() work on the positions of a window (see there) and
+# on padded, the window with PADDING zero bytes before and after it. The checks which a line
+# fails set its flag in slow, they never clear it: such a line is parsed with parse_line() and
+# whatever was found for it with NumPy is ignored.
+
+def _line_bounds(window):
+    # start and end (the newline, or the end of the window) of every line
+    ends = numpy.flatnonzero(window == 10)
+    if not len(ends) or ends[-1] != len(window) - 1:
+        ends = numpy.append(ends, len(window))  # the last line has no newline
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    return (starts, ends)
+
+
+def _candidates(padded, starts, ends):
+    # the lines which may carry power readings in ascending order, and the index of their measurement
+    # in REPLAY_MEASUREMENTS or -1 for lines which start with whitespace (parse_line() strips it)
+    prefixes = _gather(padded, starts + PADDING, 8).view("<u8").ravel()
+    (candidates, kinds) = ([], [])
+    for (kind, name) in enumerate(REPLAY_MEASUREMENTS):
+        # the first eight bytes, then the rest of the name followed by a comma or space
+        lines = numpy.flatnonzero(prefixes == numpy.frombuffer(name[:8], dtype="<u8")[0])
+        rest = _gather(padded, starts[lines] + PADDING + 8, len(name) - 7)
+        lines = lines[(rest[:, :-1] == numpy.frombuffer(name[8:], dtype=numpy.uint8)).all(axis=1) &
+            ((rest[:, -1] == 44) | (rest[:, -1] == 32))]
+        candidates.append(lines)
+        kinds.append(numpy.full(len(lines), kind, dtype=numpy.int8))
+    first = prefixes.view(numpy.uint8)[::8]
+    stripped = numpy.flatnonzero(((first == 32) | (first == 9) | (first == 13)) & (ends > starts))
+    candidates.append(stripped)
+    kinds.append(numpy.full(len(stripped), -1, dtype=numpy.int8))
+    line = numpy.concatenate(candidates)
+    by_line = numpy.argsort(line)
+    (line, kind) = (line[by_line], numpy.concatenate(kinds)[by_line])
+    if len(stripped):
+        (line, index) = numpy.unique(line, return_index=True)
+        kind = numpy.where(numpy.isin(line, stripped), -1, kind[index]).astype(numpy.int8)
+    return (line, kind)
+
+
+def _separators(window, start, end, slow):
+    # the last (sp1) and second last (sp2) space of the lines, which separate the measurement and
+    # tags part, the fields and the timestamp
+    spaces = numpy.flatnonzero(window == 32)
+    k = numpy.searchsorted(spaces, end)
+    slow |= k < 2
+    spaces = numpy.concatenate([[-2, -1], spaces])
+    (sp1, sp2) = (spaces[k + 1], spaces[k])
+    # both within the line and apart, something after sp1, and a measurement and tags part which
+    # _heads() can read within the padding
+    slow |= (sp2 <= start) | (sp1 <= sp2 + 1) | (sp1 >= end - 1) | (sp2 - start > PADDING - 8)
+    # quotes (string fields may contain spaces) and escapes next to the separators
+    quotes = numpy.flatnonzero(window == 34)
+    if len(quotes):
+        slow |= numpy.searchsorted(quotes, end) > numpy.searchsorted(quotes, start)
+    backslashes = numpy.flatnonzero(window == 92)
+    if len(backslashes):
+        slow |= numpy.searchsorted(backslashes, sp1) > numpy.searchsorted(backslashes, sp2 - 1)
+    return (sp1, sp2)
+
+
+def _timestamps(padded, end, sp1, slow):
+    # the timestamps after the last space, which must be unsigned integers of up to 19 digits
+    digits = end - sp1 - 1
+    slow |= (digits < 1) | (digits > 19)
+    # the 19 bytes before the end of the line, the digits are right aligned and the bytes before them
+    # zeroed; every byte but a digit wraps around to more than 9
+    digit = _gather(padded, end + PADDING - 19, 19) - numpy.uint8(48)
+    digit[numpy.arange(19) < 19 - numpy.clip(digits, 0, 19)[:, None]] = 0
+    slow |= (digit > 9).any(axis=1)
+    timestamp = digit.astype(numpy.uint64) @ POWERS_OF_TEN
+    slow |= timestamp > numpy.uint64(2**63 - 1)
+    return timestamp.astype(numpy.int64)
+
+
+def _numbers(padded, begin, length):
+    # the field values of length bytes at begin as floats, and which are unusual (empty, too long,
+    # other bytes than NUMBER_BYTES, not read by float() or not finite), these are 0, NaN or inf
+    unusual = (length < 1) | (length > MAX_VALUE_BYTES)
+    text = _gather(padded, begin + PADDING, MAX_VALUE_BYTES)
+    text[numpy.arange(MAX_VALUE_BYTES) >= length[:, None]] = 0
+    unusual |= (~NUMBER_BYTES[text] & (text != 0)).any(axis=1)
+    text = text.view(f"S{MAX_VALUE_BYTES}").ravel()
+    try:
+        numbers = numpy.where(unusual, b"0", text).astype(numpy.float64)
+    except ValueError:
+        # e.g. "1.2.3", which parse_line() keeps as a string
+        numbers = numpy.full(len(text), numpy.nan)
+        for (i, t) in enumerate(text.tolist()):
+            try:
+                numbers[i] = float(t) if not unusual[i] else 0.0
+            except ValueError:
+                unusual[i] = True
+    # e.g. "1e999", which parse_line() rejects
+    unusual |= ~numpy.isfinite(numbers)
+    return (numbers, unusual)
+
+
+def _field_values(window, padded, kind, sp1, sp2, slow):
+    # the values of the fields of REPLAY_FIELDS (one array per name, in their order) of the lines of
+    # their measurement, NaN if a line does not have the field
+    # the fields start after the second last space and after every comma between the last two spaces,
+    # commas in strings do not matter as lines with quotes are slow
+    commas = numpy.flatnonzero(window == 44)
+    (low, high) = (numpy.searchsorted(commas, sp2), numpy.searchsorted(commas, sp1))
+    commas = numpy.append(commas, len(window))
+    values = []
+    for (kind_index, names) in enumerate(REPLAY_FIELDS):
+        # the line (field_row) and the start of the key (field_start) of every field of these lines
+        rows = numpy.flatnonzero((kind == kind_index) & ~slow)
+        more = rows[high[rows] > low[rows]]
+        counts = high[more] - low[more]
+        field_row = numpy.concatenate([rows, numpy.repeat(more, counts)])
+        field_start = numpy.concatenate([sp2[rows], commas[numpy.arange(counts.sum()) -
+            numpy.repeat(numpy.cumsum(counts) - counts - low[more], counts)]]) + 1
+        keys = _gather(padded, field_start + PADDING, max(len(name) for name in names) + 1)
+        for name in names:
+            pattern = numpy.frombuffer(name + b"=", dtype=numpy.uint8)
+            at = numpy.flatnonzero((keys[:, :len(pattern)] == pattern).all(axis=1))
+            # the last one wins like in parse_line()
+            begin = numpy.full(len(kind), -1, dtype=numpy.int64)
+            numpy.maximum.at(begin, field_row[at], field_start[at] + len(pattern))
+            found = numpy.flatnonzero(begin >= 0)
+            begin = begin[found]
+            length = numpy.minimum(commas[numpy.searchsorted(commas, begin)], sp1[found]) - begin
+            (numbers, unusual) = _numbers(padded, begin, length)
+            value = numpy.full(len(kind), numpy.nan)
+            value[found] = numbers
+            slow[found[unusual]] = True
+            values.append(value)
+    return values
+
+
+class EnergyReplay:
+    """
+    Offline integration of archived power readings, e.g. after a fix of the energy calculation
+
+    The files are memory mapped and scanned in windows of window bytes with NumPy:
+    line ends, measurements, timestamps and the values of the power fields are found
+    for all lines at once, the tags of every distinct series part of a line are only
+    parsed once. Lines with quotes, escapes next to the separators or values which
+    float() would not read the same are parsed with parse_line(). The readings are
+    then grouped by series and the intervals and their energy are calculated for all
+    series at once.
+
+    The results are the same as those of EnergyIntegrator.process() for the lines of
+    all files in order followed by flush(), and in the same order. The vectorized
+    calculation assumes that the timestamps of every series do not decrease, that no
+    series would be expired between two of its readings, that there are at most
+    max_series series.
+    The readings are checked for that, if they do not comply the lines with power
+    readings are passed through an EnergyIntegrator one by one instead. Lines which
+    the streaming path cannot process (e.g. without timestamp) are skipped and
+    counted in invalid.
+
+    Args: see EnergyIntegrator, and
+        window (int): bytes scanned at once
+    """
+
+    def __init__(self, ttl=900, max_series=100000, method="rectangle", window=16 * 2**20, per_device=False):
+        if numpy is None:
+            raise RuntimeError("EnergyReplay requires numpy")
+        if method not in INTEGRATION_METHODS:
+            raise ValueError(f"unknown integration method {method!r}, use one of {', '.join(INTEGRATION_METHODS)}")
+        self.ttl_seconds = ttl
+        self.ttl = int(ttl * 10**9)
+        self.max_series = max_series
+        self.method = method
+        self.per_device = per_device
+        self.window = window
+        self.paths = []
+        self.lines = 0        # lines scanned
+        self.bytes = 0        # bytes scanned
+        self.invalid = 0      # lines with power readings which were skipped
+        self.vectorized = None  # whether the last results were calculated for all series at once
+        self.heads = {}       # measurement and tags part of a line -> (kind, key, index_tag, tags) or None
+        self.keys = {}        # key of a series -> index
+        self.series = []      # (tags, field) of every series, in the order they were first seen
+        self.kinds = []       # True for CPU series
+        self.totals = []      # the first series with the same server total of every series, -1 if not summed up
+        self.total_keys = {}  # key of a server total -> the first series with it
+        # arrays of the line number, series, timestamp, parts and the values of both parts of the
+        # readings, one tuple per window
+        self.readings = []
+
+    def _windows(self, path):
+        # yield the mmap and the results of _scan_window() for every window of a file
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = numpy.frombuffer(mm, dtype=numpy.uint8)
+                try:
+                    offset = 0
+                    while offset < size:
+                        end = min(size, offset + self.window)
+                        if end < size:
+                            newline = mm.rfind(b"\n", offset, end)
+                            end = newline + 1 if newline >= 0 else (mm.find(b"\n", end) + 1 or size)
+                        yield (mm, self._scan_window(mm, data[offset:end], offset))
+                        self.bytes += end - offset
+                        offset = end
+                finally:
+                    del data
+
+    def _scan_window(self, mm, window, offset):
+        # returns the number of lines and dict with arrays of the lines which may carry power readings:
+        # line (index in the window), start, end (relative to the file), slow (must be parsed with
+        # parse_line()), timestamp, head (index in heads, the classification of the distinct measurement
+        # and tags parts), first and second (the values of the parts of the power draw, NaN if missing)
+        # _windows() ends every window but the last of a file after a newline, so no line is split
+        (starts, ends) = _line_bounds(window)
+        padded = numpy.concatenate([numpy.zeros(PADDING, dtype=numpy.uint8), window, numpy.zeros(PADDING, dtype=numpy.uint8)])
+        (line, kind) = _candidates(padded, starts, ends)
+        if not len(line):
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return (len(ends), {"line": empty, "start": empty, "end": empty, "slow": numpy.zeros(0, dtype=bool),
+                "timestamp": empty, "head": empty, "first": numpy.zeros(0), "second": numpy.zeros(0)}, [])
+        (start, end) = (starts[line], ends[line])
+        slow = kind < 0
+        (sp1, sp2) = _separators(window, start, end, slow)
+        (head_of, classified) = self._heads(mm, padded, offset, start, sp2, slow)
+        # only the lines with power readings from here on, slow lines may be some as well
+        relevant = numpy.array([c is not None for c in classified] + [False], dtype=bool)
+        keep = relevant[head_of] | slow
+        (line, kind, start, end, sp1, sp2, slow, head_of) = (a[keep] for a in (line, kind, start, end, sp1, sp2, slow, head_of))
+        timestamp = _timestamps(padded, end, sp1, slow)
+        values = _field_values(window, padded, kind, sp1, sp2, slow)
+        # the values of the parts of the power draw, the columns of values are those of REPLAY_FIELDS
+        (server, cpu) = (kind == 0, kind == 1)
+        first = numpy.where(server, values[0], numpy.where(cpu, values[1], values[3]))
+        second = numpy.where(cpu, values[2], numpy.where(numpy.isnan(first), numpy.nan, 0.0))
+        # server lines without value field are left to parse_line()
+        slow |= server & numpy.isnan(first)
+        return (len(ends), {"line": line, "start": start + offset, "end": end + offset, "slow": slow,
+            "timestamp": timestamp, "head": head_of, "first": first, "second": second}, classified)
+
+    def _heads(self, mm, padded, offset, start, sp2, slow):
+        # the distinct measurement and tags parts of the lines which are not slow and their
+        # classifications (see _classify()), and the index of the part of every line in these,
+        # len(classified) for slow lines
+        # Equal parts are found by a hash of their eight byte words. The words of every line are
+        # compared with those of the first line with the same hash, on a collision the line is set
+        # slow, so a line never gets the series of another part.
+        fast = numpy.flatnonzero(~slow)
+        lengths = sp2[fast] - start[fast]
+        # at most PADDING - 8 bytes (see _separators()), so the words end within the padding
+        width = int(lengths.max() + 7) // 8 if len(fast) else 1
+        words = _gather(padded, start[fast] + PADDING, width * 8).view("<u8")
+        # zero the bytes after the part
+        (full, rest) = (lengths // 8, lengths % 8)
+        words[numpy.arange(width) >= full[:, None] + (rest[:, None] > 0)] = 0
+        partial = numpy.flatnonzero(rest)
+        words[partial, full[partial]] &= (numpy.uint64(1) << (rest[partial] * 8).astype(numpy.uint64)) - numpy.uint64(1)
+        digest = words @ HASH_FACTORS[:width] + lengths.astype(numpy.uint64)
+        order = numpy.argsort(digest, kind="stable")
+        new = numpy.concatenate([[True], digest[order][1:] != digest[order][:-1]])[:len(fast)]
+        head = numpy.empty(len(fast), dtype=numpy.int64)
+        head[order] = numpy.cumsum(new) - 1
+        first = order[new]  # the first line of every hash, as the sort is stable
+        collision = (words != words[first[head]]).any(axis=1) | (lengths != lengths[first[head]])
+        slow[fast[collision]] = True
+        classified = [self._classify(mm[offset + s:offset + s + n]) for (s, n) in
+            zip(start[fast[first]].tolist(), lengths[first].tolist())]
+        head_of = numpy.full(len(slow), len(classified), dtype=numpy.int64)
+        head_of[fast[~collision]] = head[~collision]
+        return (head_of, classified)
+
+    def _classify(self, head):
+        # kind, key, index tag and tags of the series of the measurement and tags part of a line
+        classified = self.heads.get(head, False)
+        if classified is False:
+            try:
+                (measurement, tags, _, _) = parse_line(head.decode("utf-8", "replace") + " _=0")
+                classified = series_of(measurement, tags, {CPU_FIELDS[0]: 0.0, "power_draw": 0.0})
+            except LineProtocolError:
+                classified = None
+            if classified is not None:
+                classified += (tags,)
+            self.heads[head] = classified
+        return classified
+
+    def _series(self, kind, key, index_tag, tags):
+        sid = self.keys.get(key)
+        if sid is None:
+            sid = self.keys[key] = len(self.series)
+            state = summed_state(kind, tags, index_tag, self.per_device)
+            self.series.append((state.tags, state.field))
+            self.kinds.append(kind == "cpu")
+            self.totals.append(-1 if state.total is None else self.total_keys.setdefault(state.total, sid))
+        return sid
+
+    def _parse(self, position, line):
+        # the classification, timestamp, parts and values of a line parsed with parse_line()
+        try:
+            (measurement, tags, fields, ts) = parse_line(line)
+            classified = series_of(measurement, tags, fields)
+            if classified is None:
+                return None
+            if ts is None:
+                raise LineProtocolError(f"missing timestamp in {line!r}")
+            kind = classified[0]
+            if kind == "cpu":
+                values = [float(fields[name]) if name in fields else 0.0 for name in CPU_FIELDS]
+                parts = (FIRST if CPU_FIELDS[0] in fields else 0) | (SECOND if CPU_FIELDS[1] in fields else 0)
+            else:
+                values = [float(fields["value"] if kind == "server" else fields["power_draw"]), 0.0]
+                parts = FIRST | SECOND
+        except (LineProtocolError, KeyError, TypeError, ValueError) as e:
+            print(f"skipping line {position + 1}: {e}", file=sys.stderr)
+            self.invalid += 1
+            return None
+        return (classified + (tags,), ts, parts, values[0], values[1])
+
+    def scan(self, path):
+        """
+        Collect the power readings of a file, the files are taken to follow each other
+        """
+        self.paths.append(path)
+        for (mm, (lines, rows, classified)) in self._windows(path):
+            (line, slow, head, first, second) = (rows[k] for k in ("line", "slow", "head", "first", "second"))
+            parts = (numpy.where(numpy.isnan(first), 0, FIRST) | numpy.where(numpy.isnan(second), 0, SECOND)).astype(numpy.int8)
+            fast = numpy.flatnonzero(~slow & (parts != 0))
+            # the series of the distinct heads and of the slow lines are created in the order of the lines
+            firsts = numpy.full(len(classified), len(line))
+            numpy.minimum.at(firsts, head[fast], fast)
+            events = [(i, h, None) for (h, i) in enumerate(firsts.tolist()) if i < len(line)]
+            for (i, s, e) in zip(numpy.flatnonzero(slow).tolist(), rows["start"][slow].tolist(), rows["end"][slow].tolist()):
+                events.append((i, None, self._parse(self.lines + int(line[i]), mm[s:e].decode("utf-8", "replace"))))
+            head_sid = numpy.zeros(len(classified), dtype=numpy.int32)
+            slow_rows = []
+            for (i, h, parsed) in sorted(events, key=lambda event: event[0]):
+                if h is not None:
+                    head_sid[h] = self._series(*classified[h])
+                elif parsed is not None:
+                    slow_rows.append((i, self._series(*parsed[0])) + parsed[1:])
+            slow_rows = [numpy.array(column, dtype=dtype) for (column, dtype) in
+                zip(list(zip(*slow_rows)) or [()] * 6, (numpy.int64, numpy.int32, numpy.int64, numpy.int8, numpy.float64, numpy.float64))]
+            index = numpy.concatenate([fast, slow_rows[0]])
+            order = numpy.argsort(index, kind="stable")
+            columns = [self.lines + line[index]] + [numpy.concatenate([column, extra]) for (column, extra) in
+                zip((head_sid[head[fast]], rows["timestamp"][fast], parts[fast], first[fast], second[fast]), slow_rows[1:])]
+            self.readings.append(tuple(column[order] for column in columns))
+            self.lines += lines
+
+    def _integrate(self):
+        # the intervals of all series at once, None if the readings do not allow that
+        if len(self.series) > self.max_series:
+            return None
+        empty = (numpy.zeros(0, dtype=numpy.int64),) * 2 + (numpy.zeros(0), numpy.zeros(0, dtype=numpy.int32))
+        if not self.readings:
+            return empty
+        (position, sid, ts, parts, *values) = [numpy.concatenate(a) for a in zip(*self.readings)]
+        n = len(ts)
+        if not n:
+            return empty
+        cpu = numpy.array(self.kinds, dtype=bool)[sid]
+        # the newest timestamp of all readings up to and before each reading
+        newest = numpy.maximum.accumulate(ts)
+        before = numpy.concatenate([ts[:1], newest[:-1]])
+        # incomplete CPU readings older than the TTL are dropped
+        if numpy.any(cpu & (ts < newest - self.ttl)):
+            return None
+        order = numpy.argsort(sid, kind="stable")
+        (sid, ts, before, parts, cpu) = (sid[order], ts[order], before[order], parts[order], cpu[order])
+        values = [v[order] for v in values]
+        same = sid[1:] == sid[:-1]
+        if numpy.any(same & (ts[1:] < ts[:-1])):
+            return None
+        # a series is expired if the newest timestamp passes its last one by more than the TTL
+        if numpy.any(same & (before[1:] - ts[:-1] > self.ttl)):
+            return None
+        index = numpy.arange(n)
+        # CPU readings are complete once both parts of a timestamp have arrived, with the last values of both
+        new_run = numpy.concatenate([[True], ~same | (ts[1:] != ts[:-1])])
+        runs = numpy.flatnonzero(new_run)
+        firsts = []
+        latest = []
+        for flag in (FIRST, SECOND):
+            has = (parts & flag) != 0
+            firsts.append(numpy.minimum.reduceat(numpy.where(has, index, n), runs))
+            latest.append(numpy.maximum.accumulate(numpy.where(has, index, -1)))
+        done = numpy.maximum(firsts[0], firsts[1])
+        done = done[(done < n) & cpu[runs]]
+        cpu_watts = values[0][latest[0][done]] + values[1][latest[1][done]]
+        # the other readings are complete by themselves
+        others = numpy.flatnonzero(~cpu)
+        done = numpy.concatenate([done, others])
+        watts = numpy.concatenate([cpu_watts, values[0][others]])
+        if not len(done):
+            return empty
+        by_index = numpy.argsort(done, kind="stable")
+        (done, watts) = (done[by_index], watts[by_index])
+        (c_sid, c_ts) = (sid[done], ts[done])
+        # repeated readings are ignored, so are CPU readings completed again
+        accepted = numpy.concatenate([[True], (c_sid[1:] != c_sid[:-1]) | (c_ts[1:] > c_ts[:-1])])
+        (done, watts, c_sid, c_ts) = (done[accepted], watts[accepted], c_sid[accepted], c_ts[accepted])
+        pair = c_sid[1:] == c_sid[:-1]
+        start = c_ts[:-1][pair]
+        end = c_ts[1:][pair]
+        start_watts = watts[:-1][pair]
+        if self.method == "trapezoid":
+            start_watts = (start_watts + watts[1:][pair]) / 2
+        # the same operations in the same order as energy_joules()
+        diff = (end - start) / 10**9
+        fraction = diff / SECONDS_PER_HOUR
+        joules = start_watts * fraction * JOULES_PER_KWH
+        emitted = position[order][done[1:][pair]]
+        by_position = numpy.argsort(emitted, kind="stable")
+        return (emitted[by_position], start[by_position], joules[by_position], c_sid[1:][pair][by_position])
+
+    def _sum_totals(self, emitted, start, joules, sid):
+        # the intervals of _integrate() with the energy of packages and GPUs summed up per server like
+        # EnergyIntegrator._add_total() and flush()
+        group = numpy.array(self.totals, dtype=numpy.int64)[sid]
+        summed = numpy.flatnonzero(group >= 0)
+        if not len(summed):
+            return (emitted, start, joules, sid)
+        # the intervals of every server in the order in which they arrive
+        summed = summed[numpy.argsort(group[summed], kind="stable")]
+        (g, ts, j, at) = (group[summed], start[summed], joules[summed], emitted[summed])
+        same = g[1:] == g[:-1]
+        # an interval is added to the total with the latest start of its server so far: the running
+        # maximum of the starts per server, by the rank of the starts offset by the server
+        (starts, rank) = numpy.unique(ts, return_inverse=True)
+        offset = g * len(starts)
+        ts = starts[numpy.maximum.accumulate(offset + rank.ravel()) - offset]
+        # the intervals of a total are added up in this order, beginning with the first one
+        new_run = numpy.concatenate([[True], ~same | (ts[1:] != ts[:-1])])
+        runs = numpy.flatnonzero(new_run)
+        sums = j[runs]
+        rest = numpy.flatnonzero(~new_run)
+        numpy.add.at(sums, (numpy.cumsum(new_run) - 1)[rest], j[rest])
+        # a total is emitted with the first interval of the next run of its server, the last run of
+        # every server by flush() after all lines, in the order of the last intervals of the servers
+        run_end = numpy.concatenate([runs[1:], [len(summed)]]) - 1
+        final = numpy.concatenate([~same, [True]])[run_end]
+        flushed = numpy.flatnonzero(final)
+        flushed = flushed[numpy.argsort(at[run_end[flushed]], kind="stable")]
+        emitting = numpy.concatenate([numpy.flatnonzero(~final), flushed])
+        run_at = numpy.where(final, self.lines, at[numpy.minimum(run_end + 1, len(summed) - 1)])
+        passed = numpy.flatnonzero(group < 0)
+        position = numpy.concatenate([emitted[passed], run_at[emitting]])
+        by_position = numpy.argsort(position, kind="stable")
+        return (position[by_position], numpy.concatenate([start[passed], ts[runs][emitting]])[by_position],
+            numpy.concatenate([joules[passed], sums[emitting]])[by_position],
+            numpy.concatenate([sid[passed], g[runs][emitting].astype(numpy.int32)])[by_position])
+
+    def _stream(self):
+        # the candidates of all files one by one through the streaming engine
+        engine = EnergyIntegrator(ttl=self.ttl_seconds, max_series=self.max_series, method=self.method,
+            per_device=self.per_device)
+        table = {}
+        results = ([], [], [], [])
+        position = 0
+        for path in self.paths:
+            for (mm, (lines, rows, _)) in self._windows(path):
+                for (line, start, end) in zip(rows["line"].tolist(), rows["start"].tolist(), rows["end"].tolist()):
+                    try:
+                        metric = engine.process(*parse_line(mm[start:end].decode("utf-8", "replace")))
+                    except (LineProtocolError, KeyError, TypeError, ValueError):
+                        continue
+                    if metric is None:
+                        continue
+                    (_, tags, fields, ts) = metric
+                    ((field, value),) = fields.items()
+                    key = (tuple(tags.items()), field)
+                    sid = table.get(key)
+                    if sid is None:
+                        sid = table[key] = len(table)
+                    for (column, v) in zip(results, (position + line, ts, value, sid)):
+                        column.append(v)
+                position += lines
+        for (_, tags, fields, ts) in engine.flush():
+            ((field, value),) = fields.items()
+            key = (tuple(tags.items()), field)
+            sid = table.get(key)
+            if sid is None:
+                sid = table[key] = len(table)
+            for (column, v) in zip(results, (position, ts, value, sid)):
+                column.append(v)
+        series = [(dict(tags), field) for ((tags, field), _) in sorted(table.items(), key=lambda item: item[1])]
+        return (numpy.array(results[0], dtype=numpy.int64), numpy.array(results[1], dtype=numpy.int64),
+            numpy.array(results[2], dtype=numpy.float64), numpy.array(results[3], dtype=numpy.int32), series)
+
+    def results(self):
+        """
+        The energy of all intervals in the order in which the streaming path emits them
+
+        Returns:
+            tuple: arrays of the line number which completed the interval, the timestamp,
+                the joules and the series (an index into the last item), and the list of
+                (tags, field) of the series
+        """
+        results = self._integrate()
+        if results is not None and not self.per_device:
+            results = self._sum_totals(*results)
+        self.vectorized = results is not None
+        if results is None:
+            return self._stream()
+        return results + (self.series,)
+
+    def write_lines(self, out):
+        """
+        Write the results as line protocol to a binary file object
+        """
+        (_, timestamps, joules, sids, series) = self.results()
+        prefixes = [line_prefix(tags, field) for (tags, field) in series]
+        chunk = 100000
+        for i in range(0, len(timestamps), chunk):
+            out.write("".join([f"{prefixes[s]}{value!r} {ts}\n" for (s, value, ts) in
+                zip(sids[i:i + chunk].tolist(), joules[i:i + chunk].tolist(), timestamps[i:i + chunk].tolist())]).encode("utf-8"))
+
+    def write_columns(self, path):
+        """
+        Write the results as NumPy arrays to an .npz file: timestamp, joules and series (an index into
+        series_tags, the tags as JSON objects, and series_field)
+        """
+        (_, timestamps, joules, sids, series) = self.results()
+        numpy.savez(path, timestamp=timestamps, joules=joules, series=sids,
+            series_tags=numpy.array([json.dumps(tags) for (tags, _) in series], dtype=str),
+            series_field=numpy.array([field for (_, field) in series], dtype=str))
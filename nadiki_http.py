@@ -0,0 +1,177 @@
+"""
+HTTP helpers shared by the Nadiki scripts
+
+All scripts talk to HTTP APIs (Proton, Zabbix, VictoriaMetrics,
+ElectricityMaps). This module provides pooled keep-alive sessions and a
+retry loop with bounded exponential backoff for transient failures.
+"""
+
+import random
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from nadiki_metrics import REGISTRY
+
+# status codes which are worth retrying
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+
+# retried requests of all APIs, the scripts count the failures which are left per API
+http_retries = REGISTRY.counter("http_retries")
+
+
+class PermanentHTTPError(Exception):
+    """
+    Raised for responses which will not succeed when retried (e.g. 400 Bad Request)
+    """
+    def __init__(self, response):
+        super().__init__(f"{response.status_code} {response.reason} for {response.url}: {response.text[:200]}")
+        self.response = response
+
+
+def make_session(pool_size=10, proxy=None, headers=None):
+    """
+    Create a requests session which keeps up to pool_size connections per host open
+
+    Args:
+        pool_size (int): maximum number of pooled connections per host, should be at least
+            the number of threads using the session concurrently
+        proxy (str): optional proxy URL (e.g. socks5h://host:port) used for http and https
+        headers (dict): optional headers sent with every request
+    Returns:
+        requests.Session: the session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if proxy:
+        session.proxies = {"http": proxy, "https": proxy}
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def backoff_delay(attempt, backoff=0.5, max_backoff=10.0):
+    """
+    Delay before retry number attempt (starting at 0): exponential, capped and with full jitter
+    """
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Rate limit shared by several threads: on average rate requests per second,
+    with bursts of up to burst requests
+
+    Args:
+        rate (float): tokens added per second
+        burst (int): maximum number of tokens
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is reserved even if it is not there yet, later callers wait longer
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to the Retry-After header of a response, None if there is none
+    """
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def may_have_arrived(e):
+    """
+    Whether the server may have received and processed a request which failed with e
+
+    Only errors raised before the connection was established (connect timeouts,
+    refused connections, unresolvable names) and error responses are known not to
+    have been processed. Anything raised while the request was sent or the response
+    was awaited (read timeouts, resets, the server closing the connection) is not.
+    """
+    if isinstance(e, (requests.ConnectTimeout, requests.HTTPError, PermanentHTTPError)):
+        return False
+    if isinstance(e, requests.ConnectionError) and not isinstance(e, requests.ReadTimeout):
+        # requests wraps the MaxRetryError of urllib3, whose reason is the actual error
+        reason = e.args[0] if e.args else None
+        return not isinstance(getattr(reason, "reason", reason), NewConnectionError)
+    return True
+
+
+def request_with_retry(session, method, url, retries=3, backoff=0.5, max_backoff=10.0, limiter=None,
+                       idempotent=True, **kwargs):
+    """
+    Perform a request and retry connection errors, timeouts and transient status codes
+
+    A read timeout or a connection lost after the request was sent means the server
+    may already have processed it, so for requests which must not be applied twice
+    (idempotent=False) only errors raised before the connection was established and
+    transient status codes are retried, everything else is raised right away (see
+    may_have_arrived()).
+
+    Args:
+        session (requests.Session): the session to use
+        method (str): HTTP method
+        url (str): the URL
+        retries (int): number of retries after the first attempt
+        backoff (float): base delay in seconds, doubled for every retry
+        max_backoff (float): upper bound for a single delay in seconds
+        limiter (TokenBucket): optional rate limit, a token is taken before every attempt
+        idempotent (bool): False to only retry errors before the request was sent, e.g. for ingest POSTs
+        kwargs: passed on to session.request()
+    Returns:
+        requests.Response: the successful response
+    Raises:
+        PermanentHTTPError: for status codes which are not retried
+        requests.RequestException: if the last retry failed
+    """
+    attempt = 0
+    while True:
+        response = None
+        try:
+            if limiter is not None:
+                limiter.acquire()
+            response = session.request(method, url, **kwargs)
+            if response.status_code < 400:
+                return response
+            if response.status_code not in RETRY_STATUSES:
+                raise PermanentHTTPError(response)
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            if attempt >= retries:
+                raise
+            if not idempotent and may_have_arrived(e):
+                raise
+            delay = backoff_delay(attempt, backoff, max_backoff)
+            if response is not None and retry_after(response) is not None:
+                # e.g. 429 Too Many Requests, the server knows best
+                delay = max(delay, min(retry_after(response), max_backoff))
+            print(f"{method} {url} failed ({e}), retrying in {delay:.1f}s", file=sys.stderr)
+            http_retries.inc()
+            time.sleep(delay)
+            attempt += 1
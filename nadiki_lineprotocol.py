@@ -0,0 +1,506 @@
+"""
+Parser and serializer for the InfluxDB line protocol
+
+This module is shared by all Nadiki scripts which read or write Telegraf
+metrics. It implements the escaping rules of the line protocol
+(https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/):
+
+- measurement names escape commas and spaces
+- tag keys, tag values and field keys escape commas, equal signs and spaces
+- string field values are enclosed in double quotes and escape double quotes
+  and backslashes
+
+Lines without any backslash or double quote (which is the vast majority of
+what Telegraf sends us) are split with plain str.split(), everything else
+goes through a small character scanner.
+
+Running this file directly executes a microbenchmark which compares the
+parser with the shlex based parse_line() the scripts used before.
+"""
+
+import math
+import os
+import select
+import sys
+import threading
+import time
+
+# values of boolean fields as accepted by InfluxDB
+_BOOLEANS = {
+    "t": True, "T": True, "true": True, "True": True, "TRUE": True,
+    "f": False, "F": False, "false": False, "False": False, "FALSE": False,
+}
+
+
+class LineProtocolError(ValueError):
+    """
+    Raised for lines which are not valid line protocol
+    """
+    pass
+
+
+class Unsigned(int):
+    """
+    Value of an unsigned integer field (with u suffix), which format_value() writes back
+    with the u suffix. Arithmetic on it returns plain ints.
+    """
+    __slots__ = ()
+
+
+def _typed_value(raw):
+    # convert the text of a non-string field value into a Python value
+    boolean = _BOOLEANS.get(raw)
+    if boolean is not None:
+        return boolean
+    last = raw[-1]
+    if last == "i":
+        return int(raw[:-1])
+    if last == "u":
+        value = Unsigned(raw[:-1])
+        if value < 0:
+            raise ValueError(f"negative unsigned integer {raw!r}")
+        return value
+    value = float(raw)
+    if not math.isfinite(value):
+        # inf and nan are not valid line protocol, and neither is what float() overflows to
+        raise ValueError(f"non-finite float {raw!r}")
+    return value
+
+
+def _untyped_value(raw):
+    # keep the text of a field value, but remove the integer suffix
+    last = raw[-1]
+    if last == "i" or last == "u":
+        return raw[:-1]
+    return raw
+
+
+def _scan_name(line, i, stops):
+    # read a measurement name, tag key/value or field key starting at
+    # position i until one of the characters in stops is found unescaped
+    n = len(line)
+    chars = []
+    while i < n:
+        c = line[i]
+        if c == "\\" and i + 1 < n and line[i + 1] in ", =":
+            chars.append(line[i + 1])
+            i += 2
+            continue
+        if c in stops:
+            break
+        chars.append(c)
+        i += 1
+    return i, "".join(chars)
+
+
+def _scan_string(line, i):
+    # read a string field value, i points to the first character after the
+    # opening double quote, returns the position after the closing quote
+    n = len(line)
+    chars = []
+    while i < n:
+        c = line[i]
+        if c == "\\" and i + 1 < n and line[i + 1] in "\"\\":
+            chars.append(line[i + 1])
+            i += 2
+            continue
+        if c == '"':
+            return i + 1, "".join(chars)
+        chars.append(c)
+        i += 1
+    raise LineProtocolError(f"unterminated string field value in {line!r}")
+
+
+def _parse_escaped(line, typed):
+    # slow path for lines containing escape sequences or string fields
+    convert = _typed_value if typed else _untyped_value
+    n = len(line)
+    i, measurement = _scan_name(line, 0, ", ")
+    if not measurement:
+        raise LineProtocolError(f"missing measurement in {line!r}")
+    tags = {}
+    while i < n and line[i] == ",":
+        i, key = _scan_name(line, i + 1, "=, ")
+        if i >= n or line[i] != "=":
+            raise LineProtocolError(f"invalid tag {key!r} in {line!r}")
+        i, value = _scan_name(line, i + 1, ", ")
+        tags[key] = value
+    if i >= n or line[i] != " ":
+        raise LineProtocolError(f"missing fields in {line!r}")
+    i += 1
+    fields = {}
+    while True:
+        i, key = _scan_name(line, i, "=, ")
+        if i >= n or line[i] != "=":
+            raise LineProtocolError(f"invalid field {key!r} in {line!r}")
+        i += 1
+        if i < n and line[i] == '"':
+            i, value = _scan_string(line, i + 1)
+        else:
+            start = i
+            while i < n and line[i] != "," and line[i] != " ":
+                i += 1
+            if i == start:
+                raise LineProtocolError(f"empty value for field {key!r} in {line!r}")
+            try:
+                value = convert(line[start:i])
+            except ValueError:
+                raise LineProtocolError(f"invalid value for field {key!r} in {line!r}") from None
+        fields[key] = value
+        if i < n and line[i] == ",":
+            i += 1
+            continue
+        break
+    ts = None
+    if i < n:
+        rest = line[i:].strip()
+        if rest:
+            try:
+                ts = int(rest)
+            except ValueError:
+                raise LineProtocolError(f"invalid timestamp in {line!r}") from None
+    return measurement, tags, fields, ts
+
+
+def parse_line(line, typed=True):
+    """
+    Parse one line of Influx line protocol
+
+    Args:
+        line (str): the line, a trailing newline is ignored
+        typed (bool): if True, field values are converted to int (Unsigned for the u suffix),
+            float, bool or str. If False, they are returned as text (without the i/u suffix of integers
+            and without the quotes of strings), e.g. for passing them on to Proton.
+    Returns:
+        tuple: (measurement, tags, fields, timestamp) where tags and fields are dicts
+            and timestamp is an int (nanoseconds) or None if the line has none
+    Raises:
+        LineProtocolError: if the line cannot be parsed
+    """
+    line = line.strip()
+    if "\\" in line or '"' in line:
+        return _parse_escaped(line, typed)
+    parts = line.split(" ")
+    try:
+        if len(parts) == 3:
+            head, fields_str, ts = parts
+            ts = int(ts)
+        elif len(parts) == 2:
+            head, fields_str = parts
+            ts = None
+        else:
+            raise LineProtocolError(f"expected 2 or 3 space separated sections in {line!r}")
+        names = head.split(",")
+        measurement = names[0]
+        tags = dict([x.split("=", 1) for x in names[1:]])
+        if typed:
+            fields = {k: _typed_value(v) for (k, v) in [x.split("=", 1) for x in fields_str.split(",")]}
+        else:
+            fields = {k: _untyped_value(v) for (k, v) in [x.split("=", 1) for x in fields_str.split(",")]}
+    except LineProtocolError:
+        raise
+    except (ValueError, IndexError):
+        raise LineProtocolError(f"invalid line {line!r}") from None
+    if not measurement:
+        raise LineProtocolError(f"missing measurement in {line!r}")
+    return measurement, tags, fields, ts
+
+
+def is_skipped(line):
+    """
+    Whether a line is empty or a comment, which parse_lines() skips and parse_line() rejects
+    """
+    return not line or line[0] == "#" or line.isspace()
+
+
+def parse_lines(buffer, typed=True, strict=True):
+    """
+    Parse a buffer containing many lines of Influx line protocol
+
+    Empty lines and comments are skipped.
+
+    Args:
+        buffer (str or bytes): the lines, separated by newlines
+        typed (bool): see parse_line()
+        strict (bool): if True, raise on the first invalid line, otherwise skip invalid
+            lines and report them on stderr
+    Returns:
+        list: list of (measurement, tags, fields, timestamp) tuples
+    """
+    if isinstance(buffer, (bytes, bytearray, memoryview)):
+        buffer = bytes(buffer).decode("utf-8")
+    result = []
+    append = result.append
+    for line in buffer.split("\n"):
+        if is_skipped(line):
+            continue
+        try:
+            append(parse_line(line, typed))
+        except LineProtocolError as e:
+            if strict:
+                raise
+            print(e, file=sys.stderr)
+    return result
+
+
+def escape_measurement(name):
+    """
+    Escape a measurement name
+    """
+    if "," in name or " " in name:
+        return name.replace(",", "\\,").replace(" ", "\\ ")
+    return name
+
+
+def escape_key(name):
+    """
+    Escape a tag key, tag value or field key
+    """
+    if "," in name or "=" in name or " " in name:
+        return name.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+    return name
+
+
+def format_value(value):
+    """
+    Format a field value: floats as they are, integers with an i suffix (Unsigned
+    with a u suffix), booleans as true/false and strings in double quotes
+
+    Raises:
+        ValueError: for inf and nan, which the line protocol cannot represent
+    """
+    t = type(value)
+    if t is float:
+        if not math.isfinite(value):
+            raise ValueError(f"non-finite float {value!r}")
+        return repr(value)
+    if t is str:
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    if t is bool:
+        return "true" if value else "false"
+    if t is int:
+        return f"{value}i"
+    if t is Unsigned:
+        return f"{int(value)}u"
+    # subclasses and numpy scalars
+    if isinstance(value, float):
+        return format_value(float(value))
+    if type(value).__name__ in ("bool", "bool_"):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        return format_value(str(value))
+    if isinstance(value, Unsigned):
+        return f"{int(value)}u"
+    if hasattr(value, "__index__"):
+        return f"{int(value)}i"
+    return format_value(float(value))
+
+
+def _finite(value):
+    # whether format_value() can write a value, strings always can
+    try:
+        return math.isfinite(value)
+    except TypeError:
+        return True
+
+
+def format_line(measurement, tags, fields, ts=None):
+    """
+    Serialize a metric into one line of Influx line protocol (without newline)
+
+    Tags with empty values and fields with inf or nan values are left out because the
+    line protocol cannot represent them.
+
+    Args:
+        measurement (str): name of the measurement
+        tags (dict): tag names and values
+        fields (dict): field names and values, see format_value()
+        ts (int): timestamp in nanoseconds or None
+    Returns:
+        str: the line
+    Raises:
+        LineProtocolError: if no field is left
+    """
+    parts = [escape_measurement(measurement)]
+    for k, v in tags.items():
+        if v is None or v == "":
+            continue
+        parts.append(f"{escape_key(k)}={escape_key(str(v))}")
+    head = ",".join(parts)
+    try:
+        field_str = ",".join([f"{escape_key(k)}={format_value(v)}" for k, v in fields.items()])
+    except ValueError:
+        field_str = ",".join([f"{escape_key(k)}={format_value(v)}" for k, v in fields.items()
+            if _finite(v)])
+        if not field_str:
+            raise LineProtocolError(f"no finite field value for {measurement!r}") from None
+    if ts is None:
+        return f"{head} {field_str}"
+    return f"{head} {field_str} {ts}"
+
+
+def format_lines(metrics):
+    """
+    Serialize an iterable of (measurement, tags, fields, timestamp) tuples into
+    one string with one line per metric (with trailing newline)
+    """
+    lines = [format_line(*m) for m in metrics]
+    if not lines:
+        return ""
+    lines.append("")
+    return "\n".join(lines)
+
+
+def read_batches(fd, window):
+    """
+    Read from a file descriptor and yield the complete lines received within window seconds as one buffer
+
+    With a window of 0, everything which has arrived is yielded at once.
+    """
+    buffer = bytearray()
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        (readable, _, _) = select.select([fd], [], [], timeout)
+        if readable:
+            data = os.read(fd, 1 << 20)
+            if not data:
+                if buffer:
+                    yield bytes(buffer)
+                return
+            buffer += data
+            if deadline is None:
+                deadline = time.monotonic() + window
+        if deadline is not None and time.monotonic() >= deadline:
+            end = buffer.rfind(b"\n") + 1
+            if end:
+                yield bytes(buffer[:end])
+                del buffer[:end]
+            # what is left is an incomplete line, the next window starts with the rest of it
+            deadline = None
+
+
+class LineWriter:
+    """
+    Thread-safe buffered writer for line protocol output
+
+    Lines are collected in memory and written with a single write() call when
+    max_lines lines are buffered, and at the latest every flush_interval seconds
+    by a background thread.
+
+    Args:
+        stream: file object to write to, defaults to sys.stdout
+        max_lines (int): number of buffered lines which triggers a write
+        flush_interval (float): maximum number of seconds a line stays in the buffer
+        output_lock: optional lock (e.g. a multiprocessing.Lock) held while writing to the
+            stream, for processes which share it
+    """
+
+    def __init__(self, stream=None, max_lines=1000, flush_interval=0.5, output_lock=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.max_lines = max_lines
+        self.flush_interval = flush_interval
+        self.output_lock = output_lock
+        self.lines = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="line-writer", daemon=True)
+        self.thread.start()
+
+    def write_line(self, line):
+        """
+        Buffer one already serialized line (without newline)
+        """
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.max_lines:
+                self._flush()
+
+    def write(self, measurement, tags, fields, ts=None):
+        """
+        Serialize a metric with format_line() and buffer it
+        """
+        self.write_line(format_line(measurement, tags, fields, ts))
+
+    def write_lines(self, lines):
+        """
+        Buffer many already serialized lines at once
+        """
+        with self.lock:
+            self.lines.extend(lines)
+            if len(self.lines) >= self.max_lines:
+                self._flush()
+
+    def _flush(self):
+        # must be called with the lock held
+        if self.lines:
+            self.lines.append("")
+            if self.output_lock is not None:
+                with self.output_lock:
+                    self.stream.write("\n".join(self.lines))
+                    self.stream.flush()
+            else:
+                self.stream.write("\n".join(self.lines))
+                self.stream.flush()
+            self.lines = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+
+
+def _benchmark(n=200000):
+    # compare the throughput of this parser with the shlex based parser
+    import random
+    import shlex
+
+    def shlex_parse_line(line):
+        (tmp, fields_str, ts) = shlex.split(line)
+        pairs = tmp.split(",")
+        measurement = pairs[0]
+        tags = {}
+        for x in pairs[1:]:
+            (k, v) = x.split("=")
+            tags[k] = v
+        fields = {}
+        for x in fields_str.split(","):
+            (k, v) = x.split("=")
+            fields[k] = v
+        return measurement, tags, fields, ts
+
+    rnd = random.Random(42)
+    templates = [
+        "node_cpu_seconds_total,instance=10.0.0.{host}:9100,cpu={cpu},mode=user,server_id=srv{host},rack_id=r1,country_code=NL,facility_id=f1 value={value} {ts}",
+        "ipmi_sensor,name=instantaneous_power_reading,unit=watts,server_id=srv{host},rack_id=r1,country_code=NL,facility_id=f1 value={value} {ts}",
+        "nvidia_smi,index={cpu},name=NVIDIA\\ A100,server_id=srv{host},rack_id=r1,country_code=NL,facility_id=f1 power_draw={value},fan_speed=30i {ts}",
+    ]
+    lines = []
+    for i in range(n):
+        lines.append(rnd.choice(templates).format(host=rnd.randrange(64), cpu=rnd.randrange(128), value=rnd.random() * 1000, ts=1700000000000000000 + i * 10**9) + "\n")
+    buffer = "".join(lines)
+
+    def measure(label, fn):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<32} {n / elapsed:>12,.0f} lines/s")
+
+    measure("shlex parse_line", lambda: [shlex_parse_line(l) for l in lines])
+    measure("parse_line (typed)", lambda: [parse_line(l) for l in lines])
+    measure("parse_line (untyped)", lambda: [parse_line(l, typed=False) for l in lines])
+    measure("parse_lines (typed, batch)", lambda: parse_lines(buffer))
+    parsed = parse_lines(buffer)
+    measure("format_line", lambda: [format_line(*m) for m in parsed])
+
+
+if __name__ == "__main__":
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,214 @@
+"""
+Synthetic Telegraf metrics for benchmarks of the Nadiki scripts
+
+LoadGenerator produces line protocol as the inputs of telegraf.conf deliver it
+to the processors: ipmi_sensor (one sensor of every server is the
+instantaneous_power_reading), powerstat_package (CPU and DRAM power of every
+package in separate lines), nvidia_smi, the container metrics of cadvisor and
+the node_* metrics of node_exporter which the Proton ingester stores and the
+counter processor turns into differences.
+
+The metrics are generated in ticks of interval seconds. Within a tick, every
+series gets its own offset of a few nanoseconds, so a timestamp identifies the
+series and the tick. The benchmarks use this to find the input line which caused
+an output line. The values are pseudo-random but the same for the same seed, the
+node_* counters increase from tick to tick.
+
+Use it from Python:
+
+    gen = LoadGenerator(servers=100, gpus=4)
+    for line in gen.lines(ticks=60):
+        ...
+
+or from the command line, e.g.
+
+    python3 nadiki_loadgen.py --servers 100 --gpus 4 --ticks 60 --rate 10000 | python3 nadiki-server-telegraf-processor.py
+    python3 nadiki_loadgen.py --servers 10 --pods 500 --crictl-json pods.json | POD_LABELS_FILE=pods.json python3 nadiki-server-cadvisor-processor.py
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from nadiki_lineprotocol import escape_key, escape_measurement
+
+# node_exporter metrics which have a stream in nadiki-proton-config.json, with the tags of their series
+NODE_METRICS = (
+    ("node_cpu_seconds_total", "cpu"),
+    ("node_network_transmit_bytes_total", "device"),
+    ("node_network_receive_bytes_total", "device"),
+    ("node_network_transmit_packets_total", "device"),
+    ("node_network_receive_packets_total", "device"),
+    ("node_disk_read_bytes_total", "device"),
+    ("node_disk_written_bytes_total", "device"),
+    ("node_disk_reads_completed_total", "device"),
+    ("node_disk_writes_completed_total", "device"),
+)
+
+IPMI_SENSORS = ("fan_1", "inlet_temp", "exhaust_temp", "cpu1_temp", "psu1_current", "psu2_current", "fan_2", "fan_3")
+
+
+class LoadGenerator:
+    """
+    Generator of synthetic Telegraf metrics
+
+    Args:
+        servers (int): number of servers
+        sensors (int): ipmi_sensor lines per server and tick (0: none), one of them is the power reading
+        packages (int): CPU packages per server, each with a CPU and a DRAM power line per tick
+        gpus (int): GPUs per server
+        pods (int): pods with a container_cpu_usage_seconds_total line per tick, spread over the servers
+        unknown_pods (int): additional pods which crictl does not know
+        node_metrics (int): node_* series per server
+        interval (int): seconds between two ticks
+        start (int): time of the first tick (seconds since the epoch)
+        seed (int): seed of the pseudo-random values
+        tags (dict): tags which Telegraf adds to every metric
+    """
+
+    def __init__(self, servers=10, sensors=4, packages=2, gpus=0, pods=0, unknown_pods=0, node_metrics=0,
+            interval=10, start=1700000000, seed=0, tags=None):
+        self.interval = interval
+        self.interval_ns = interval * 10**9
+        self.start_ns = start * 10**9
+        self.random = random.Random(seed)
+        self.pod_labels = {}  # pod sandbox ID -> labels of the pods known to crictl
+        self.series = []      # (measurement and tags, [(field, low, high, kind)]) per line of a tick
+        self.offsets = []     # timestamp offset of every line of a tick
+        common = {"country_code": "NL", "facility_id": "ams1", "rack_id": "r01"} if tags is None else tags
+        for s in range(servers):
+            server = {**common, "host": f"node{s:05d}", "server_id": f"srv{s:05d}"}
+            base = len(self.series)
+            for i in range(sensors):
+                # the power reading is the last sensor, so the line which completes a tick comes last
+                name = "instantaneous_power_reading" if i == sensors - 1 else IPMI_SENSORS[i % len(IPMI_SENSORS)]
+                self._add("ipmi_sensor", {**server, "name": name, "unit": "watts" if i == sensors - 1 else "unspecified"},
+                    [("value", 150.0, 450.0, "float")], base)
+            for p in range(packages):
+                offset = len(self.series)
+                tags = {**server, "package_id": str(p)}
+                self._add("powerstat_package", tags, [("current_power_consumption_watts", 40.0, 200.0, "float")], offset)
+                self._add("powerstat_package", tags, [("current_dram_power_consumption_watts", 2.0, 20.0, "float")], offset)
+            for g in range(gpus):
+                self._add("nvidia_smi", {**server, "index": str(g), "name": "NVIDIA A100-SXM4-40GB", "pstate": "P0"},
+                    [("power_draw", 50.0, 400.0, "float"), ("temperature_gpu", 30, 85, "int"), ("utilization_gpu", 0, 100, "int")])
+            for n in range(node_metrics):
+                (metric, tag) = NODE_METRICS[n % len(NODE_METRICS)]
+                value = str(n // len(NODE_METRICS)) if tag == "cpu" else f"eth{n // len(NODE_METRICS)}"
+                tags = {"instance": f"{server['host']}:9100", "job": "node", tag: value}
+                if tag == "cpu":
+                    tags["mode"] = "idle"
+                self._add(metric, {**server, **tags}, [("value", 0.0, 1000.0, "counter")])
+        for p in range(pods + unknown_pods):
+            server = f"srv{p % max(servers, 1):05d}"
+            sandbox = f"{self.random.getrandbits(128):032x}{p:032x}"
+            if p < pods:
+                self.pod_labels[sandbox] = {"io.kubernetes.pod.name": f"pod-{p}", "io.kubernetes.pod.namespace": f"ns-{p % 7}",
+                    "io.kubernetes.container.name": "main", "app": f"app-{p % 13}"}
+            container_id = f"/kubepods.slice/kubepods-burstable.slice/kubepods-burstable-pod{p:08x}.slice/cri-containerd-{sandbox}.scope"
+            self._add("container_cpu_usage_seconds_total", {**common, "cpu": "total", "host": f"node{p % max(servers, 1):05d}",
+                "id": container_id, "server_id": server}, [("counter", 0.0, 1e6, "float")])
+
+    def _add(self, measurement, tags, fields, offset=None):
+        # lines with the same offset have the same timestamp (e.g. CPU and DRAM power of a package)
+        head = ",".join([escape_measurement(measurement)] + [f"{escape_key(k)}={escape_key(v)}" for (k, v) in sorted(tags.items())])
+        self.series.append((head, fields))
+        self.offsets.append(len(self.series) - 1 if offset is None else offset)
+
+    def __len__(self):
+        """
+        Number of lines per tick
+        """
+        return len(self.series)
+
+    def timestamp(self, tick, line):
+        """
+        Timestamp in nanoseconds of a line (index within the tick) of a tick
+        """
+        return self.start_ns + tick * self.interval_ns + self.offsets[line]
+
+    def tick(self, tick):
+        """
+        Lines (without newline) of a tick
+        """
+        lines = []
+        for (i, (head, fields)) in enumerate(self.series):
+            values = ",".join([f"{name}={self._value(tick, low, high, kind)}" for (name, low, high, kind) in fields])
+            lines.append(f"{head} {values} {self.timestamp(tick, i)}")
+        return lines
+
+    def _value(self, tick, low, high, kind):
+        if kind == "int":
+            return f"{self.random.randint(low, high)}i"
+        if kind == "counter":
+            # increases by at least low per tick
+            return f"{tick * high + self.random.uniform(low, high):.2f}"
+        return f"{self.random.uniform(low, high):.2f}"
+
+    def lines(self, ticks):
+        """
+        Generator for the lines of the first ticks ticks
+        """
+        for tick in range(ticks):
+            yield from self.tick(tick)
+
+    def crictl_json(self):
+        """
+        Output of crictl ps -o json for the known pods, see nadiki_podlabels.py
+        """
+        return {"containers": [{"id": f"{i:064x}", "podSandboxId": sandbox, "labels": labels}
+            for (i, (sandbox, labels)) in enumerate(self.pod_labels.items())]}
+
+
+def write_paced(lines, stream, rate=0, chunk=None):
+    """
+    Write lines to a binary stream, at most rate lines per second (0: as fast as possible)
+    """
+    chunk = chunk or (max(1, int(rate / 100)) if rate else 1000)
+    batch = []
+    written = 0
+    start = time.monotonic()
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= chunk:
+            if rate:
+                delay = start + written / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            stream.write(("\n".join(batch) + "\n").encode("utf-8"))
+            stream.flush()
+            written += len(batch)
+            batch = []
+    if batch:
+        stream.write(("\n".join(batch) + "\n").encode("utf-8"))
+        stream.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic Telegraf metrics in line protocol")
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--sensors", type=int, default=4, help="ipmi_sensor lines per server, one is the power reading")
+    parser.add_argument("--packages", type=int, default=2, help="CPU packages per server")
+    parser.add_argument("--gpus", type=int, default=0, help="GPUs per server")
+    parser.add_argument("--pods", type=int, default=0, help="pods with cadvisor metrics")
+    parser.add_argument("--unknown-pods", type=int, default=0, help="pods which are missing in --crictl-json")
+    parser.add_argument("--node-metrics", type=int, default=0, help="node_* series per server")
+    parser.add_argument("--interval", type=int, default=10, help="seconds between two ticks")
+    parser.add_argument("--ticks", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=0, help="lines per second, 0 writes as fast as possible")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--crictl-json", help="write the crictl ps -o json output for the pods to this file")
+    args = parser.parse_args()
+
+    gen = LoadGenerator(servers=args.servers, sensors=args.sensors, packages=args.packages, gpus=args.gpus,
+        pods=args.pods, unknown_pods=args.unknown_pods, node_metrics=args.node_metrics, interval=args.interval,
+        seed=args.seed)
+    if args.crictl_json:
+        with open(args.crictl_json, "w") as f:
+            json.dump(gen.crictl_json(), f)
+    try:
+        write_paced(gen.lines(args.ticks), sys.stdout.buffer, args.rate)
+    except BrokenPipeError:
+        pass
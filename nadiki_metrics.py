@@ -0,0 +1,396 @@
+"""
+Self-monitoring of the Nadiki scripts
+
+The scripts count what they do in a Registry of counters, gauges and
+histograms with fixed buckets. A Reporter writes all of them every interval
+seconds as lines of the measurement nadiki_internal to the output of the
+script, so Telegraf routes them like any other metric:
+
+    nadiki_internal,script=ingester lines_parsed=1234i,rows_buffered=17,flush_seconds_count=12i,flush_seconds_sum=0.31,flush_seconds_p50=0.025,flush_seconds_p99=0.05 1700000000000000000
+
+Metrics with tags (e.g. the API or the query) are written as lines of their
+own with these tags. Histograms are reported with their count, sum and the
+p50 and p99 (the upper bound of the bucket in which the quantile lies).
+
+Optionally, the registry is also served in the Prometheus text format on
+http://NADIKI_METRICS_ADDRESS:NADIKI_METRICS_PORT/metrics.
+
+Updating a metric takes a lock, which costs a few hundred nanoseconds. Gauges
+can be given a function instead of being set, it is only called when the
+metrics are reported.
+
+Configuration (see start_reporting()):
+
+- NADIKI_METRICS_INTERVAL: seconds between two reports, 0 disables them (default 60)
+- NADIKI_METRICS_PORT: port of the Prometheus endpoint, disabled if not set
+- NADIKI_METRICS_ADDRESS: address of the Prometheus endpoint (default 127.0.0.1)
+- NADIKI_METRICS_INSTANCE: value of the instance tag, which tells several processes
+  of the same script apart (e.g. the counter processors of a telegraf.conf)
+"""
+
+import bisect
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nadiki_lineprotocol import format_line
+
+MEASUREMENT = "nadiki_internal"
+
+# upper bounds in seconds, from a millisecond (a small query) to half a minute (a slow export)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the largest write to a pipe which the kernel does not interleave with writes of other processes
+PIPE_BUF = 4096
+
+
+class Counter:
+    """
+    Number of events, only increases
+    """
+    __slots__ = ("name", "tags", "value", "lock")
+    kind = "counter"
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def fields(self):
+        return {self.name: self.value}
+
+
+class Gauge:
+    """
+    Current value of something, either set or calculated by a function when it is reported
+    """
+    __slots__ = ("name", "tags", "value", "function")
+    kind = "gauge"
+
+    def __init__(self, name, tags, function=None):
+        self.name = name
+        self.tags = tags
+        self.value = 0.0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception as e:
+            print(f"gauge {self.name} failed: {e}", file=sys.stderr)
+            return None
+
+    def fields(self):
+        value = self.get()
+        return {} if value is None else {self.name: float(value)}
+
+
+class Histogram:
+    """
+    Distribution of durations (or other values) in fixed buckets
+    """
+    __slots__ = ("name", "tags", "bounds", "counts", "count", "sum", "max", "lock")
+    kind = "histogram"
+
+    def __init__(self, name, tags, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.tags = tags
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket has no upper bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        """
+        Context manager which observes the seconds spent in its block
+        """
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket which contains the quantile q, the maximum for the last bucket
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+            largest = self.max
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for (i, n) in enumerate(counts):
+            cumulative += n
+            if cumulative >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else largest
+        return largest
+
+    def fields(self):
+        with self.lock:
+            (count, total) = (self.count, self.sum)
+        fields = {f"{self.name}_count": count, f"{self.name}_sum": total}
+        if count:
+            fields[f"{self.name}_p50"] = float(self.quantile(0.5))
+            fields[f"{self.name}_p99"] = float(self.quantile(0.99))
+        return fields
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class Registry:
+    """
+    All metrics of a process, a metric is identified by its name and tags
+    """
+
+    def __init__(self):
+        self.metrics = {}  # (name, tuple of tag items) -> metric
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, tags, *args):
+        key = (name, tuple(sorted((tags or {}).items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(name, dict(key[1]), *args)
+        if not isinstance(metric, cls):
+            raise TypeError(f"metric {name} is a {metric.kind}, not a {cls.kind}")
+        return metric
+
+    def counter(self, name, tags=None):
+        return self._get(Counter, name, tags)
+
+    def gauge(self, name, tags=None, function=None):
+        gauge = self._get(Gauge, name, tags)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, tags=None, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, tags, buckets)
+
+    def clear(self):
+        """
+        Forget all metrics, e.g. in a child process which must not report the metrics of its parent
+        """
+        with self.lock:
+            self.metrics = {}
+
+    def lines(self, tags=None, ts=None):
+        """
+        All metrics as lines of line protocol, one line per set of tags
+
+        Args:
+            tags (dict): tags added to every line, e.g. the name of the script
+            ts (int): timestamp in nanoseconds, defaults to now
+        """
+        ts = time.time_ns() if ts is None else ts
+        groups = {}  # tuple of tag items -> fields
+        for metric in list(self.metrics.values()):
+            key = tuple(sorted({**(tags or {}), **metric.tags}.items()))
+            groups.setdefault(key, {}).update(metric.fields())
+        return [format_line(MEASUREMENT, dict(key), fields, ts) for (key, fields) in groups.items() if fields]
+
+    def prometheus(self, tags=None):
+        """
+        All metrics in the Prometheus text format
+        """
+        out = []
+        previous = None
+        for metric in sorted(list(self.metrics.values()), key=lambda m: (m.name, sorted(m.tags.items()))):
+            labels = {**(tags or {}), **metric.tags}
+            name = f"nadiki_{metric.name}"
+            if name != previous:
+                out.append(f"# TYPE {name} {metric.kind}")
+                previous = name
+            if metric.kind == "histogram":
+                with metric.lock:
+                    (counts, count, total) = (list(metric.counts), metric.count, metric.sum)
+                cumulative = 0
+                for (bound, n) in zip(list(metric.bounds) + [float("inf")], counts):
+                    cumulative += n
+                    out.append(f"{name}_bucket{_labels({**labels, 'le': _number(bound)})} {cumulative}")
+                out.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                out.append(f"{name}_count{_labels(labels)} {count}")
+            else:
+                value = metric.value if metric.kind == "counter" else metric.get()
+                if value is not None:
+                    out.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "".join(line + "\n" for line in out)
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for (k, v) in zip(labels, escaped)) + "}"
+
+
+# the registry of the process, used by the shared modules and the scripts
+REGISTRY = Registry()
+
+
+def write_stdout(lines):
+    """
+    Write lines to stdout with single writes of at most PIPE_BUF bytes, which do not get
+    mixed up with the output of other processes (only for processes which do not use sys.stdout)
+    """
+    chunk = []
+    size = 0
+    for line in lines:
+        data = (line + "\n").encode("utf-8")
+        if chunk and size + len(data) > PIPE_BUF:
+            os.write(1, b"".join(chunk))
+            (chunk, size) = ([], 0)
+        chunk.append(data)
+        size += len(data)
+    if chunk:
+        os.write(1, b"".join(chunk))
+
+
+class Reporter:
+    """
+    Writes the metrics of a registry as lines of nadiki_internal every interval seconds
+
+    Either start() a thread which reports in the background (write must then be
+    thread-safe, e.g. LineWriter.write_line or write_stdout), or call maybe_report()
+    from the thread which writes the other output of the script.
+
+    Args:
+        registry (Registry): the metrics
+        write (callable): called with a list of lines
+        interval (float): seconds between two reports
+        tags (dict): tags of every line, e.g. {"script": "ingester"}
+    """
+
+    def __init__(self, registry, write, interval, tags):
+        self.registry = registry
+        self.write = write
+        self.interval = interval
+        self.tags = tags
+        self.next = time.monotonic() + interval
+
+    def report(self):
+        try:
+            lines = self.registry.lines(self.tags)
+            if lines:
+                self.write(lines)
+        except Exception as e:
+            print(f"reporting the internal metrics failed: {e}", file=sys.stderr)
+
+    def maybe_report(self):
+        """
+        Report if the interval has passed, cheap enough to be called for every line
+        """
+        if self.interval and time.monotonic() >= self.next:
+            self.next = time.monotonic() + self.interval
+            self.report()
+
+    def _run(self):
+        while True:
+            time.sleep(max(0.0, self.next - time.monotonic()))
+            self.next = time.monotonic() + self.interval
+            self.report()
+
+    def start(self):
+        if self.interval:
+            threading.Thread(target=self._run, name="nadiki-metrics", daemon=True).start()
+        return self
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus(self.server.tags).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_prometheus(registry, port, address="127.0.0.1", tags=None):
+    """
+    Serve the registry in the Prometheus text format from a background thread
+    """
+    server = ThreadingHTTPServer((address, port), _PrometheusHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    server.tags = tags
+    threading.Thread(target=server.serve_forever, name="nadiki-metrics-http", daemon=True).start()
+    return server
+
+
+def start_reporting(script, write=None, background=True, prometheus=True, registry=REGISTRY):
+    """
+    Set up the reporting of a script from the NADIKI_METRICS_* environment variables
+
+    Args:
+        script (str): value of the script tag
+        write (callable): called with a list of lines, defaults to write_stdout
+        background (bool): report from a thread, otherwise the script calls maybe_report()
+        prometheus (bool): serve the endpoint if NADIKI_METRICS_PORT is set (only one
+            process of a script can do that)
+    Returns:
+        Reporter: the reporter
+    """
+    tags = {"script": script}
+    if os.environ.get("NADIKI_METRICS_INSTANCE"):
+        tags["instance"] = os.environ["NADIKI_METRICS_INSTANCE"]
+    interval = float(os.environ.get("NADIKI_METRICS_INTERVAL", "60"))
+    reporter = Reporter(registry, write or write_stdout, interval, tags)
+    if background:
+        reporter.start()
+    port = os.environ.get("NADIKI_METRICS_PORT")
+    if port and prometheus:
+        try:
+            serve_prometheus(registry, int(port), os.environ.get("NADIKI_METRICS_ADDRESS", "127.0.0.1"), tags)
+        except (OSError, ValueError) as e:
+            print(f"cannot serve the internal metrics on port {port}: {e}", file=sys.stderr)
+    return reporter
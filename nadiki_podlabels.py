@@ -0,0 +1,141 @@
+"""
+Pod labels for the container metrics of cadvisor
+
+The labels of the running containers are read from `crictl ps -o json`
+(or from a file with the same content, e.g. for testing) into a table
+from pod sandbox ID to labels. The table is refreshed by a background
+thread every ttl seconds, and in another background thread when a pod
+is looked up which is not in the table, but not more often than every
+min_refresh_interval seconds. The lookup does not wait for that refresh.
+
+A refresh builds a new table and replaces the old one as a whole, so
+lookups read a consistent snapshot without taking a lock.
+"""
+
+import json
+import re
+import subprocess
+import sys
+import threading
+import time
+
+CRICTL_COMMAND = ("crictl", "ps", "-o", "json")
+
+regex = re.compile("cri-containerd-([^.]*).scope")
+
+
+def load_pod_labels(path=None, command=CRICTL_COMMAND):
+    """
+    Read the labels of all containers
+
+    Args:
+        path (str): JSON file with the output of crictl ps -o json, crictl is called if None
+        command (tuple): the crictl command
+    Returns:
+        dict: pod sandbox ID -> dict of labels
+    """
+    if path is None:
+        cp = subprocess.run(list(command), capture_output=True, check=True)
+        containers = json.loads(cp.stdout)
+    else:
+        with open(path) as f:
+            containers = json.load(f)
+    return {c["podSandboxId"]: c["labels"] for c in containers["containers"]}
+
+
+class PodLabelCache:
+    """
+    Table from pod sandbox ID to labels which is kept up to date in the background
+
+    Args:
+        path (str): read the containers from this JSON file instead of calling crictl
+        ttl (float): seconds between two refreshes of the background thread
+        min_refresh_interval (float): minimum number of seconds between two refreshes
+            caused by unknown pods
+        max_ids (int): maximum number of memoized cadvisor IDs
+    """
+
+    def __init__(self, path=None, ttl=60, min_refresh_interval=5, max_ids=100000):
+        self.path = path
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.max_ids = max_ids
+        self.labels = {}        # the current snapshot, replaced as a whole
+        self.pod_ids = {}       # cadvisor id -> pod ID or None
+        self.refreshed = None   # monotonic time of the last refresh attempt
+        self.refreshes = 0
+        self.refresh_lock = threading.Lock()
+        self.missing_lock = threading.Lock()  # held while a refresh for unknown pods is running
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="pod-labels", daemon=True)
+
+    def start(self):
+        """
+        Load the table and start the background refresh
+        """
+        self.refresh()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh(self, min_age=0):
+        """
+        Reload the table unless it is younger than min_age seconds, the old table is kept if this fails
+        """
+        with self.refresh_lock:
+            if self.refreshed is not None and time.monotonic() - self.refreshed < min_age:
+                # refreshed by another thread in the meantime
+                return
+            self.refreshed = time.monotonic()
+            self.refreshes += 1
+            try:
+                self.labels = load_pod_labels(self.path)
+            except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+                print(f"Reading the pod labels failed, keeping {len(self.labels)} known pods: {e}", file=sys.stderr)
+
+    def _run(self):
+        while not self.stopped.wait(self.ttl):
+            self.refresh()
+
+    def missing(self):
+        """
+        Called when a pod was not found, reads the table again in the background
+        """
+        # the pod may have been started after the last refresh, the next lines will hopefully find it
+        if time.monotonic() - self.refreshed < self.min_refresh_interval:
+            return
+        if not self.missing_lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._refresh_missing, name="pod-labels-missing", daemon=True).start()
+
+    def _refresh_missing(self):
+        try:
+            self.refresh(self.min_refresh_interval)
+        finally:
+            self.missing_lock.release()
+
+    def pod_id(self, cadvisor_id):
+        """
+        Pod ID contained in the id tag of a cadvisor metric, or None
+        """
+        try:
+            return self.pod_ids[cadvisor_id]
+        except KeyError:
+            pass
+        match = regex.search(cadvisor_id)
+        if len(self.pod_ids) >= self.max_ids:
+            self.pod_ids = {}
+        pod_id = self.pod_ids[cadvisor_id] = match.group(1) if match else None
+        return pod_id
+
+    def get(self, pod_id):
+        """
+        Labels of a pod in the current table or None if the pod is unknown, which
+        starts a refresh in the background (see missing())
+        """
+        labels = self.labels.get(pod_id)
+        if labels is None:
+            self.missing()
+        return labels
@@ -0,0 +1,684 @@
+"""
+Batching pipeline for ingesting metrics into Timeplus Proton
+
+The main thread of the ingester parses lines from stdin and appends rows
+to a per-stream batch (a ColumnarBatch). When a batch has reached the configured number of
+rows, or when its oldest row has waited longer than the flush interval,
+it is swapped for a fresh, empty batch (so parsing continues into the new
+buffer while the old one is being sent) and put into a bounded queue.
+A dedicated flusher thread takes all queued batches and hands them to a
+flush function.
+
+If the queue is full, appending blocks until the flusher has caught up.
+This slows down reading from stdin (and therefore Telegraf) instead of
+buffering an unbounded amount of rows. A batch whose flush fails is
+retried until it succeeds, so rows are neither dropped nor sent twice by
+the pipeline itself.
+
+HTTPTransport is the flush function which posts the batches to the REST
+ingest API of Proton, NativeTransport inserts them as columnar blocks over
+the native protocol of proton_driver instead.
+
+With ShardedParser, the lines are parsed by a pool of worker processes
+instead of the main thread. A reader thread splits stdin into chunks of
+whole lines, the workers turn every chunk into per-stream ColumnarBatches
+and these are merged into the batches of the pipeline in the order of the
+chunks, so the rows of every stream keep the order of the input.
+
+The duration of the flushes, the failed flushes and the flushed rows are
+counted in the registry of nadiki_metrics.
+"""
+
+import datetime
+import gzip
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from json.encoder import encode_basestring
+
+import requests
+from proton_driver import client, errors
+
+from nadiki_http import backoff_delay, make_session, may_have_arrived, request_with_retry, PermanentHTTPError
+from nadiki_lineprotocol import parse_lines, read_batches
+from nadiki_metrics import REGISTRY
+
+flush_seconds = REGISTRY.histogram("flush_seconds")
+flush_failures = REGISTRY.counter("flush_failures")
+rows_flushed = REGISTRY.counter("rows_flushed")
+rows_rejected = REGISTRY.counter("rows_rejected")
+api_seconds = REGISTRY.histogram("api_seconds", {"api": "proton"})
+api_errors = REGISTRY.counter("api_errors", {"api": "proton"})
+native_seconds = REGISTRY.histogram("api_seconds", {"api": "proton-native"})
+native_errors = REGISTRY.counter("api_errors", {"api": "proton-native"})
+
+# Proton adds the column _tp_time to every stream as datetime64(3, 'UTC'), in milliseconds
+TP_TIME_NS = 1000000
+
+
+def _format_tp_times(timestamps):
+    # convert nanosecond timestamps into JSON strings for the _tp_time column in one
+    # pass, the date and time part is formatted only once per second
+    seconds = {}
+    result = []
+    append = result.append
+    for ts in timestamps:
+        (sec, ns) = divmod(ts, 1000000000)
+        prefix = seconds.get(sec)
+        if prefix is None:
+            prefix = seconds[sec] = '"' + datetime.datetime.fromtimestamp(sec, datetime.timezone.utc).strftime("%F %T.")
+        append(f'{prefix}{ns // 1000:06d}"')
+    return result
+
+
+class StreamSchema:
+    """
+    Columns of a Proton stream and the caches shared by all batches of the stream
+
+    Repeated values (tag sets and field names) are stored only once and the JSON
+    representation of repeated values is computed only once. The caches are reset
+    when they reach max_cache entries, so series which disappear do not pile up.
+
+    Args:
+        stream (str): name of the stream
+        keys (list): names of the tags which form the primary key
+        max_cache (int): maximum number of entries per cache
+    """
+    __slots__ = ("stream", "keys", "columns_json", "max_cache",
+        "tagsets", "field_names", "json_strings", "json_tagsets", "json_field_names")
+
+    def __init__(self, stream, keys, max_cache=100000):
+        self.stream = stream
+        self.keys = list(keys)
+        self.columns_json = json.dumps(self.keys + ["tags", "fields", "timestamp", "_tp_time"])
+        self.max_cache = max_cache
+        self.tagsets = {}           # tuple of tag items -> shared instance
+        self.field_names = {}       # tuple of field names -> shared instance
+        self.json_strings = {}      # primary key value -> JSON string
+        self.json_tagsets = {}      # tuple of tag items -> JSON object
+        self.json_field_names = {}  # tuple of field names -> tuple of JSON '"name":' prefixes
+
+    def _store(self, cache, key, value):
+        if len(cache) >= self.max_cache:
+            cache.clear()
+        cache[key] = value
+        return value
+
+    def intern_tagset(self, tagset):
+        return self.tagsets.get(tagset) or self._store(self.tagsets, tagset, tagset)
+
+    def intern_field_names(self, names):
+        return self.field_names.get(names) or self._store(self.field_names, names, names)
+
+    def json_string(self, value):
+        return self.json_strings.get(value) or self._store(self.json_strings, value, encode_basestring(value))
+
+    def json_tags(self, tagset):
+        encoded = self.json_tagsets.get(tagset)
+        if encoded is None:
+            encoded = "{" + ",".join([encode_basestring(k) + ":" + encode_basestring(v) for (k, v) in tagset]) + "}"
+            self._store(self.json_tagsets, tagset, encoded)
+        return encoded
+
+    def json_field_prefixes(self, names):
+        prefixes = self.json_field_names.get(names)
+        if prefixes is None:
+            prefixes = self._store(self.json_field_names, names, tuple([encode_basestring(k) + ":" for k in names]))
+        return prefixes
+
+
+class ColumnarBatch:
+    """
+    Rows for one stream which will be sent to Proton together, stored column by column
+
+    Primary key values, tag sets and field names point to shared instances, field
+    values are kept in one flat list and timestamps in an array of 64 bit integers.
+    The _tp_time column is only computed when the batch is encoded.
+
+    A batch is pickled without the caches of its schema, which can be large: the
+    batches which the workers of a ShardedParser return only carry the rows and the
+    primary key, they are merged into the batches of the pipeline with extend().
+    """
+    __slots__ = ("stream", "schema", "key_columns", "tagsets", "field_names", "field_values", "timestamps", "created")
+
+    def __init__(self, schema):
+        self.stream = schema.stream
+        self.schema = schema
+        self.key_columns = [[] for _ in schema.keys]
+        self.tagsets = []
+        self.field_names = []
+        self.field_values = []
+        self.timestamps = array("q")
+        self.created = None  # monotonic time of the first row
+
+    def append(self, tags, fields, ts):
+        """
+        Append a row, raises KeyError if a primary key tag is missing and ValueError if
+        the timestamp is missing, in both cases before any column has been changed
+        """
+        schema = self.schema
+        if ts is None:
+            raise ValueError("missing timestamp")
+        key_values = [tags[key] for key in schema.keys]
+        # the only append which can still fail (a timestamp out of range) comes first
+        self.timestamps.append(ts)
+        for (column, value) in zip(self.key_columns, key_values):
+            column.append(sys.intern(value))
+        self.tagsets.append(schema.intern_tagset(tuple(tags.items())))
+        self.field_names.append(schema.intern_field_names(tuple(fields)))
+        self.field_values.extend(fields.values())
+        if self.created is None:
+            self.created = time.monotonic()
+
+    def extend(self, other, start, stop, values_start):
+        """
+        Append the rows start to stop of another batch of the same stream
+
+        Args:
+            values_start (int): index of the first field value of row start in other.field_values
+        Returns:
+            int: index of the first field value after row stop
+        """
+        schema = self.schema
+        for (column, values) in zip(self.key_columns, other.key_columns):
+            column.extend(values[start:stop])
+        # the rows of other share their tag sets and field names, so each of them is interned only once
+        interned = {}
+        tagsets = self.tagsets
+        for tagset in other.tagsets[start:stop]:
+            shared = interned.get(id(tagset))
+            if shared is None:
+                shared = interned[id(tagset)] = schema.intern_tagset(tagset)
+            tagsets.append(shared)
+        values_stop = values_start
+        field_names = self.field_names
+        for names in other.field_names[start:stop]:
+            shared = interned.get(id(names))
+            if shared is None:
+                shared = interned[id(names)] = schema.intern_field_names(names)
+            field_names.append(shared)
+            values_stop += len(names)
+        self.field_values.extend(other.field_values[values_start:values_stop])
+        self.timestamps.extend(other.timestamps[start:stop])
+        if self.created is None:
+            self.created = time.monotonic()
+        return values_stop
+
+    def __getstate__(self):
+        return (self.stream, self.schema.keys, self.key_columns, self.tagsets, self.field_names,
+            self.field_values, self.timestamps)
+
+    def __setstate__(self, state):
+        (self.stream, keys, self.key_columns, self.tagsets, self.field_names, self.field_values, self.timestamps) = state
+        # a schema without shared caches, only its keys are used
+        self.schema = StreamSchema(self.stream, keys)
+        self.created = None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def encode(self):
+        """
+        Serialize the batch into the JSON body expected by the Proton ingest API:
+        {"columns": [...], "data": [[...], ...]}
+        """
+        schema = self.schema
+        columns = [[schema.json_string(v) for v in column] for column in self.key_columns]
+        columns.append([schema.json_tags(t) for t in self.tagsets])
+        fields = []
+        values = iter(self.field_values)
+        for names in self.field_names:
+            prefixes = schema.json_field_prefixes(names)
+            if len(prefixes) == 1:
+                fields.append("{" + prefixes[0] + encode_basestring(next(values)) + "}")
+            else:
+                fields.append("{" + ",".join([p + encode_basestring(next(values)) for p in prefixes]) + "}")
+        columns.append(fields)
+        columns.append(map(str, self.timestamps))
+        columns.append(_format_tp_times(self.timestamps))
+        body = '{"columns":' + schema.columns_json + ',"data":[[' + "],[".join(map(",".join, zip(*columns))) + "]]}"
+        return body.encode("utf-8")
+
+    def columns(self):
+        """
+        The batch as values per column for a columnar insert with proton_driver
+
+        Returns:
+            tuple: (column names, list of one list of values per column), without _tp_time
+        """
+        schema = self.schema
+        columns = [list(column) for column in self.key_columns]
+        # the tag sets are shared instances, so each of them is converted only once
+        tag_dicts = {}
+        tags = []
+        for tagset in self.tagsets:
+            converted = tag_dicts.get(id(tagset))
+            if converted is None:
+                converted = tag_dicts[id(tagset)] = dict(tagset)
+            tags.append(converted)
+        columns.append(tags)
+        fields = []
+        append = fields.append
+        values = iter(self.field_values)
+        for names in self.field_names:
+            if len(names) == 1:
+                append({names[0]: next(values)})
+            else:
+                append({name: next(values) for name in names})
+        columns.append(fields)
+        columns.append(self.timestamps.tolist())
+        return (schema.keys + ["tags", "fields", "timestamp"], columns)
+
+
+class FlushPipeline:
+    """
+    Double-buffered per-stream batches feeding a flusher thread through a bounded queue
+
+    Args:
+        flush (callable): called by the flusher thread with a list of batches, returns
+            the batches which could not be delivered (these are retried)
+        new_batch (callable): creates an empty batch for a stream name
+        batch_size (int): number of rows after which a batch is flushed
+        flush_interval (float): maximum number of seconds a row waits before it is flushed
+        queue_depth (int): maximum number of batches waiting for the flusher
+        retry_interval (float): seconds to wait before retrying a failed flush
+    """
+
+    def __init__(self, flush, new_batch, batch_size=10000, flush_interval=1.0, queue_depth=8, retry_interval=1.0):
+        self.flush = flush
+        self.new_batch = new_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.batches = {}  # stream name -> batch currently being filled
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="proton-flusher", daemon=True)
+        self.closed = False
+        self.next_stale_check = 0.0  # monotonic time of the next check for stale batches
+
+    def start(self):
+        self.thread.start()
+
+    def append(self, stream, *row):
+        """
+        Append a row to the batch of a stream, blocks while the queue is full
+        """
+        with self.lock:
+            batch = self.batches.get(stream)
+            if batch is None:
+                batch = self.batches[stream] = self.new_batch(stream)
+            batch.append(*row)
+            if len(batch) >= self.batch_size:
+                # swap the buffers, the queue put blocks if the flusher is behind;
+                # it happens under the lock so that batches of a stream stay in order
+                self.batches[stream] = self.new_batch(stream)
+                self.queue.put(batch)
+
+    def extend(self, stream, rows):
+        """
+        Append all rows of a batch (e.g. parsed by a worker) to the batches of a stream,
+        blocks while the queue is full
+        """
+        with self.lock:
+            (start, values_start) = (0, 0)
+            while start < len(rows):
+                batch = self.batches.get(stream)
+                if batch is None:
+                    batch = self.batches[stream] = self.new_batch(stream)
+                stop = min(len(rows), start + self.batch_size - len(batch))
+                values_start = batch.extend(rows, start, stop, values_start)
+                start = stop
+                if len(batch) >= self.batch_size:
+                    self.batches[stream] = self.new_batch(stream)
+                    self.queue.put(batch)
+
+    def buffered_rows(self):
+        """
+        Number of rows in the batches being filled and in the queue (without locking, for monitoring)
+        """
+        return sum(len(b) for b in list(self.batches.values()) + list(self.queue.queue))
+
+    def _take_stale(self):
+        # swap out the batches which have waited long enough, called by the flusher thread on
+        # every pass (at most every half flush interval), so that rows of a quiet stream are
+        # flushed in time even while busy streams keep the queue from running empty
+        now = time.monotonic()
+        if now < self.next_stale_check:
+            return []
+        # the lock is not waited for: an append may hold it while it waits for the queue
+        if not self.lock.acquire(blocking=False):
+            return []
+        try:
+            self.next_stale_check = now + self.flush_interval / 2
+            stale = []
+            for stream, batch in list(self.batches.items()):
+                if len(batch) > 0 and now - batch.created >= self.flush_interval:
+                    stale.append(batch)
+                    self.batches[stream] = self.new_batch(stream)
+            return stale
+        finally:
+            self.lock.release()
+
+    def _flush_with_retry(self, batches):
+        while batches:
+            rows = sum(len(b) for b in batches)
+            try:
+                with flush_seconds.time():
+                    batches = self.flush(batches) or []
+            except Exception as e:
+                print(f"Flushing {len(batches)} batches failed: {e}", file=sys.stderr)
+            rows_flushed.inc(rows - sum(len(b) for b in batches))
+            if batches:
+                flush_failures.inc()
+                # only the batches which were not delivered are sent again
+                time.sleep(self.retry_interval)
+
+    def _run(self):
+        while True:
+            try:
+                batches = [self.queue.get(timeout=self.flush_interval / 2)]
+            except queue.Empty:
+                if self.closed:
+                    return
+                batches = []
+            # take everything that is waiting to flush it in one cycle
+            try:
+                while True:
+                    batches.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            queued = len(batches)
+            # the stale batches come after the queued ones, which were filled before them
+            batches.extend(self._take_stale())
+            # a flush cycle contains at most one batch per stream, so that a failed
+            # batch is delivered before the next batch of the same stream
+            rounds = []
+            depth = {}
+            for batch in batches:
+                n = depth.get(batch.stream, 0)
+                depth[batch.stream] = n + 1
+                if n == len(rounds):
+                    rounds.append([])
+                rounds[n].append(batch)
+            for cycle in rounds:
+                self._flush_with_retry(cycle)
+            for _ in range(queued):
+                self.queue.task_done()
+
+    def close(self):
+        """
+        Flush all remaining rows and stop the flusher thread
+        """
+        with self.lock:
+            pending = [b for b in self.batches.values() if len(b) > 0]
+            self.batches = {}
+            for batch in pending:
+                self.queue.put(batch)
+        self.queue.join()
+        self.closed = True
+        self.thread.join()
+
+
+# schemas of the streams in a worker process of a ShardedParser, kept from chunk to chunk
+_worker_schemas = {}
+
+
+def parse_chunk(data, streams):
+    """
+    Parse a chunk of whole lines into one batch per stream, runs in a worker process
+
+    Args:
+        data (bytes): the lines
+        streams (dict): stream name -> primary key tags
+    Returns:
+        tuple: (dict of stream name -> ColumnarBatch, number of lines, number of lines
+            without a stream, number of invalid lines, set of measurements without a stream)
+    """
+    batches = {}
+    ignored = 0
+    invalid = 0
+    unknown = set()
+    metrics = parse_lines(data, typed=False, strict=False)
+    for (measurement, tags, fields, ts) in metrics:
+        batch = batches.get(measurement)
+        if batch is None:
+            keys = streams.get(measurement)
+            if keys is None:
+                ignored += 1
+                unknown.add(measurement)
+                continue
+            schema = _worker_schemas.get(measurement)
+            if schema is None or schema.keys != keys:
+                schema = _worker_schemas[measurement] = StreamSchema(measurement, keys)
+            batch = batches[measurement] = ColumnarBatch(schema)
+        try:
+            batch.append(tags, fields, ts)
+        except (KeyError, ValueError, OverflowError) as e:
+            print(f"Skipping a line of {measurement}: {e!r}", file=sys.stderr)
+            invalid += 1
+    return (batches, len(metrics), ignored, invalid, unknown)
+
+
+def split_chunks(buffer, size):
+    """
+    Split a buffer of whole lines into chunks of about size bytes which end with a newline
+    """
+    start = 0
+    while start < len(buffer):
+        end = buffer.find(b"\n", start + size)
+        end = len(buffer) if end < 0 else end + 1
+        yield buffer[start:end]
+        start = end
+
+
+class ShardedParser:
+    """
+    Parses lines from a file descriptor with a pool of worker processes
+
+    A reader thread collects what arrives within window seconds, splits it into
+    chunks of about chunk_size bytes at line boundaries and submits them to the pool.
+    The results are returned in the order of the chunks, at most 2 * workers chunks
+    are parsed or waiting at the same time (so a slow consumer slows down reading).
+
+    The workers are started by a fork server, so they do not inherit the threads
+    and locks of the ingester.
+
+    Args:
+        workers (int): number of worker processes
+        chunk_size (int): bytes per chunk
+        window (float): seconds to collect lines before they are split into chunks
+    """
+
+    def __init__(self, workers, chunk_size=1 << 20, window=0.05):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.window = window
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+        self.pending = queue.Queue(maxsize=2 * workers)  # futures in the order of the chunks, None at the end
+
+    def _read(self, fd, streams):
+        try:
+            for buffer in read_batches(fd, self.window):
+                for chunk in split_chunks(buffer, self.chunk_size):
+                    self.pending.put(self.executor.submit(parse_chunk, chunk, streams()))
+        finally:
+            self.pending.put(None)
+
+    def parse(self, fd, streams):
+        """
+        Parse everything until the end of the input
+
+        Args:
+            fd (int): file descriptor to read from
+            streams (callable): returns the current dict of stream name -> primary key tags
+        Yields:
+            tuple: the results of parse_chunk() for every chunk, in order
+        """
+        threading.Thread(target=self._read, args=(fd, streams), name="proton-reader", daemon=True).start()
+        while True:
+            future = self.pending.get()
+            if future is None:
+                break
+            yield future.result()
+        self.executor.shutdown()
+
+
+class HTTPTransport:
+    """
+    Sends batches to the REST ingest API of Proton
+
+    Connections are pooled and kept alive between flushes, request bodies are
+    compressed with gzip and the batches of one flush cycle are posted
+    concurrently. An instance is used as flush function of a FlushPipeline.
+
+    Args:
+        url (str): ingest URL, the stream name is appended
+        concurrency (int): maximum number of requests in flight
+        compresslevel (int): gzip level from 1 to 9, 0 disables compression
+        retries (int): retries per request for transient errors
+        backoff (float): base delay of the exponential backoff in seconds
+        timeout (float): timeout for connecting and reading in seconds
+    """
+
+    def __init__(self, url, concurrency=4, compresslevel=1, retries=3, backoff=0.5, timeout=30):
+        self.url = url
+        self.compresslevel = compresslevel
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = make_session(pool_size=concurrency, headers={"Content-Type": "application/json"})
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="proton-post")
+
+    def post(self, batch):
+        """
+        Send one batch, returns True if it was delivered, rejected for good or
+        timed out after Proton may have received it
+        """
+        body = batch.encode()
+        headers = None
+        if self.compresslevel:
+            body = gzip.compress(body, compresslevel=self.compresslevel)
+            headers = {"Content-Encoding": "gzip"}
+        try:
+            with api_seconds.time():
+                request_with_retry(self.session, "POST", f"{self.url}{batch.stream}", retries=self.retries,
+                    backoff=self.backoff, idempotent=False, data=body, headers=headers, timeout=self.timeout)
+        except PermanentHTTPError as e:
+            # sending the same rows again will not help
+            print(f"Proton rejected {len(batch)} rows for {batch.stream}, dropping them: {e}", file=sys.stderr)
+            api_errors.inc()
+            rows_rejected.inc(len(batch))
+        except requests.RequestException as e:
+            api_errors.inc()
+            if may_have_arrived(e):
+                # Proton may have ingested the rows already, sending them again could duplicate them
+                print(f"Posting {len(batch)} rows to {batch.stream} failed after sending them, not resending them: {e}", file=sys.stderr)
+                return True
+            print(f"Posting {len(batch)} rows to {batch.stream} failed: {e}", file=sys.stderr)
+            return False
+        return True
+
+    def __call__(self, batches):
+        if len(batches) == 1:
+            delivered = [self.post(batches[0])]
+        else:
+            delivered = list(self.executor.map(self.post, batches))
+        return [b for (b, ok) in zip(batches, delivered) if not ok]
+
+
+class NativeTransport:
+    """
+    Inserts batches as columnar blocks over the native protocol of Proton (port 8463)
+
+    Every batch is one INSERT of all its columns, the driver serializes them block
+    by block without building rows. Up to concurrency connections are kept open
+    between flushes and the batches of one flush cycle are inserted concurrently.
+    Network errors are retried on a new connection, batches which Proton refuses
+    (e.g. because the stream does not exist) are dropped like rejected HTTP requests.
+    An instance is used as flush function of a FlushPipeline.
+
+    Args:
+        host (str): host of Proton
+        port (int): port of the native protocol
+        concurrency (int): maximum number of connections and inserts in flight
+        retries (int): retries per insert for network errors
+        backoff (float): base delay of the exponential backoff in seconds
+        timeout (float): timeout for connecting and reading in seconds
+    """
+
+    def __init__(self, host, port=8463, concurrency=4, retries=3, backoff=0.5, timeout=30):
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.clients = queue.LifoQueue()  # idle clients, the most recently used (and connected) one first
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="proton-insert")
+
+    def _client(self):
+        try:
+            return self.clients.get_nowait()
+        except queue.Empty:
+            return client.Client(host=self.host, port=self.port, connect_timeout=self.timeout,
+                send_receive_timeout=self.timeout)
+
+    def insert(self, c, batch):
+        """
+        Insert one batch with the client c, raises the errors of proton_driver
+        """
+        (names, columns) = batch.columns()
+        # the driver takes integers for datetime64 columns as they are stored
+        columns.append([ts // TP_TIME_NS for ts in columns[-1]])
+        c.execute(f"INSERT INTO {batch.stream} ({', '.join(names)}, _tp_time) VALUES", columns, columnar=True)
+
+    def post(self, batch):
+        """
+        Send one batch, returns True if it was delivered or rejected for good
+        """
+        c = self._client()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    with native_seconds.time():
+                        self.insert(c, batch)
+                    return True
+                except errors.ServerException as e:
+                    # inserting the same rows again will not help
+                    print(f"Proton rejected {len(batch)} rows for {batch.stream}, dropping them: {e}", file=sys.stderr)
+                    native_errors.inc()
+                    rows_rejected.inc(len(batch))
+                    return True
+                except (errors.Error, OSError, EOFError) as e:
+                    # the connection is in an unknown state, the next attempt opens a new one
+                    c.disconnect()
+                    if attempt >= self.retries:
+                        print(f"Inserting {len(batch)} rows into {batch.stream} failed: {e}", file=sys.stderr)
+                        native_errors.inc()
+                        return False
+                    delay = backoff_delay(attempt, self.backoff)
+                    print(f"Inserting into {batch.stream} failed ({e}), retrying in {delay:.1f}s", file=sys.stderr)
+                    attempt += 1
+                    time.sleep(delay)
+        finally:
+            self.clients.put(c)
+
+    def __call__(self, batches):
+        if len(batches) == 1:
+            delivered = [self.post(batches[0])]
+        else:
+            delivered = list(self.executor.map(self.post, batches))
+        return [b for (b, ok) in zip(batches, delivered) if not ok]
+
+    def close(self):
+        while True:
+            try:
+                self.clients.get_nowait().disconnect()
+            except queue.Empty:
+                return
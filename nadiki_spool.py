@@ -0,0 +1,427 @@
+"""
+Write-ahead spool for batches on their way to Proton
+
+Every batch is appended to a segment file on local disk before it is
+sent. A sender thread reads the batches back in the order they were
+written and posts them, and records which ones Proton has accepted in a
+small acknowledgement file next to each segment. Segments are deleted
+once all of their batches have been accepted.
+
+If Proton is down, batches pile up on disk instead of in memory (so
+reading from stdin continues) and are sent as fast as possible once it
+is back. After a restart, all batches which have not been acknowledged
+are sent again. Batches of the same stream are always sent in order.
+
+The spool is limited in size. When it is full, the drop policy decides:
+
+- "drop-oldest" deletes the oldest segment (the rows in it are lost)
+- "drop-newest" discards the batch which does not fit anymore
+- "block" waits until the sender has freed space, which slows down
+  reading from stdin
+
+File format of a segment: a sequence of records, each consisting of a
+header (magic, body length, CRC32 of the body, length of the stream
+name, number of rows), the stream name and the body (the encoded JSON
+batch). The acknowledgement file contains the offsets of accepted
+records as 64 bit integers, it is synced to disk like the segments
+(unless fsync is "never") since an acknowledgement which is lost sends a
+batch twice.
+
+Segment numbers are never reused: a new segment gets a higher number than
+any file found in the directory, and acknowledgement files whose segment
+is gone are deleted at startup, so they cannot mark the records of a
+later segment as accepted.
+"""
+
+import collections
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+_MAGIC = b"NSP1"
+_HEADER = struct.Struct("<4sIIHI")
+_ACK = struct.Struct("<Q")
+
+DROP_POLICIES = ("drop-oldest", "drop-newest", "block")
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class SpooledBatch:
+    """
+    A batch read back from the spool, it can be sent by HTTPTransport and NativeTransport like any other batch
+    """
+    __slots__ = ("stream", "body", "rows", "segment", "offset")
+
+    def __init__(self, stream, body, rows, segment, offset):
+        self.stream = stream
+        self.body = body
+        self.rows = rows
+        self.segment = segment
+        self.offset = offset
+
+    def encode(self):
+        return self.body
+
+    def columns(self):
+        # decode the JSON batch for a columnar insert, _tp_time is derived from the timestamps
+        batch = json.loads(self.body)
+        names = [name for name in batch["columns"] if name != "_tp_time"]
+        indexes = [batch["columns"].index(name) for name in names]
+        rows = batch["data"]
+        return (names, [[row[i] for row in rows] for i in indexes])
+
+    def __len__(self):
+        return self.rows
+
+
+class _Record:
+    # position of a record which has not been acknowledged yet
+    __slots__ = ("segment", "offset", "stream", "size", "rows", "replayed")
+
+    def __init__(self, segment, offset, stream, size, rows, replayed=False):
+        self.segment = segment
+        self.offset = offset
+        self.stream = stream
+        self.size = size
+        self.rows = rows
+        self.replayed = replayed  # recovered from a previous run, sent with at most max_rate
+
+
+class Spool:
+    """
+    Segment-rotated append-only spool with a sender thread
+
+    Args:
+        directory (str): directory for the segment files, created if necessary
+        send (callable): posts one batch (e.g. HTTPTransport.post), returns False if
+            it should be retried
+        concurrency (int): maximum number of batches sent at the same time
+        segment_size (int): size in bytes after which a new segment is started
+        max_size (int): maximum size of all segments in bytes
+        drop_policy (str): one of DROP_POLICIES
+        fsync (str): "always" syncs every batch to disk, "interval" at most every
+            fsync_interval seconds and "never" leaves it to the operating system
+        fsync_interval (float): seconds between syncs for the "interval" policy
+        max_rate (float): maximum number of bytes per second at which the batches recovered
+            after a restart are sent, 0 for no limit (new batches are never throttled)
+        retry_interval (float): seconds to wait after a failed round
+    """
+
+    def __init__(self, directory, send, concurrency=4, segment_size=64 * 2**20, max_size=2**30,
+            drop_policy="drop-oldest", fsync="interval", fsync_interval=1.0, max_rate=0,
+            retry_interval=1.0):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {DROP_POLICIES}")
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}")
+        self.directory = directory
+        self.send = send
+        self.concurrency = concurrency
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.drop_policy = drop_policy
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_rate = max_rate
+        self.retry_interval = retry_interval
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = collections.deque()  # records not yet sent, in spool order
+        self.unacked = {}                   # segment number -> number of unacknowledged records
+        self.sizes = {}                     # segment number -> size in bytes
+        self.sending = []                   # records currently being sent
+        self.dropped_rows = 0
+        self.closed = False
+        self.last_sync = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        self.active = self._recover() + 1
+        self.file = self._create(self.active)
+        self.sizes[self.active] = 0
+        self.unacked[self.active] = 0
+
+        self.executor = None
+        if concurrency > 1:
+            self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="spool-send")
+        self.thread = threading.Thread(target=self._run, name="spool-sender", daemon=True)
+
+    def _path(self, segment, suffix=".wal"):
+        return os.path.join(self.directory, f"spool-{segment:012d}{suffix}")
+
+    def _sync_directory(self):
+        # make new and deleted files in the directory survive a crash
+        if self.fsync == "never":
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _create(self, segment):
+        # open a new segment file for appending
+        f = open(self._path(segment), "ab")
+        self._sync_directory()
+        return f
+
+    def _recover(self):
+        # find the records of all segments which were not acknowledged before the last exit,
+        # returns the highest segment number found (0 if there is none)
+        recovered_rows = 0
+        segments = {int(os.path.basename(path)[6:18]) for path in glob.glob(os.path.join(self.directory, "spool-*.wal"))}
+        highest = max(segments, default=0)
+        for path in glob.glob(os.path.join(self.directory, "spool-*.ack")):
+            segment = int(os.path.basename(path)[6:18])
+            highest = max(highest, segment)
+            if segment not in segments:
+                # left behind by a crash while its segment was deleted
+                print(f"Deleting {path}, whose segment is gone", file=sys.stderr)
+                os.remove(path)
+        for segment in sorted(segments):
+            path = self._path(segment)
+            acked = set()
+            if os.path.exists(self._path(segment, ".ack")):
+                with open(self._path(segment, ".ack"), "rb") as f:
+                    data = f.read()
+                acked = {x[0] for x in _ACK.iter_unpack(data[:len(data) - len(data) % _ACK.size])}
+            records = []
+            offset = 0
+            with open(path, "rb") as f:
+                while True:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    (magic, length, crc, name_length, rows) = _HEADER.unpack(header)
+                    stream = f.read(name_length)
+                    body = f.read(length)
+                    if magic != _MAGIC or len(stream) < name_length or len(body) < length or zlib.crc32(body) != crc:
+                        break
+                    if offset not in acked:
+                        records.append(_Record(segment, offset, stream.decode("utf-8"), _HEADER.size + name_length + length, rows, True))
+                    offset += _HEADER.size + name_length + length
+            if offset < os.path.getsize(path):
+                # cut off a record which was only partially written when the process died
+                print(f"Truncating incomplete record at offset {offset} of {path}", file=sys.stderr)
+                os.truncate(path, offset)
+            if not records:
+                self._delete_segment(segment)
+                continue
+            self.pending.extend(records)
+            self.unacked[segment] = len(records)
+            self.sizes[segment] = offset
+            recovered_rows += sum(r.rows for r in records)
+        if self.pending:
+            print(f"Replaying {len(self.pending)} batches with {recovered_rows} rows from {self.directory}", file=sys.stderr)
+        return highest
+
+    def _delete_segment(self, segment):
+        for suffix in (".wal", ".ack"):
+            try:
+                os.remove(self._path(segment, suffix))
+            except FileNotFoundError:
+                pass
+        self.unacked.pop(segment, None)
+        self.sizes.pop(segment, None)
+
+    def size(self):
+        """
+        Current size of all segments in bytes
+        """
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def backlog(self):
+        """
+        Number of batches which have not been sent yet
+        """
+        with self.lock:
+            return len(self.pending)
+
+    def _make_room(self, needed):
+        # called with the lock held, returns False if the record must be discarded
+        if needed > self.max_size:
+            return False
+        while sum(self.sizes.values()) + needed > self.max_size:
+            if self.drop_policy == "block":
+                if self.closed:
+                    return False
+                self.changed.wait(1.0)
+                continue
+            if self.drop_policy == "drop-newest":
+                return False
+            oldest = min(self.sizes)
+            if oldest == self.active:
+                # only the active segment is left, start a new one so it can go
+                self._rotate()
+                continue
+            lost = [r for r in self.pending if r.segment == oldest]
+            self.dropped_rows += sum(r.rows for r in lost)
+            print(f"Spool is full, dropping {sum(r.rows for r in lost)} rows of segment {oldest}", file=sys.stderr)
+            self.pending = collections.deque(r for r in self.pending if r.segment != oldest)
+            self._delete_segment(oldest)
+        return True
+
+    def _rotate(self):
+        # called with the lock held
+        self.file.close()
+        if self.unacked.get(self.active) == 0:
+            self._delete_segment(self.active)
+        self.active += 1
+        self.file = self._create(self.active)
+        self.sizes[self.active] = 0
+        self.unacked[self.active] = 0
+
+    def append(self, stream, body, rows):
+        """
+        Write a batch to the spool, returns False if it was discarded by the drop policy
+        """
+        name = stream.encode("utf-8")
+        header = _HEADER.pack(_MAGIC, len(body), zlib.crc32(body), len(name), rows)
+        size = len(header) + len(name) + len(body)
+        with self.lock:
+            if not self._make_room(size):
+                self.dropped_rows += rows
+                print(f"Spool is full, dropping {rows} rows for {stream}", file=sys.stderr)
+                return False
+            if self.sizes[self.active] + size > self.segment_size and self.sizes[self.active] > 0:
+                self._rotate()
+            offset = self.sizes[self.active]
+            self.file.write(header + name + body)
+            self.file.flush()
+            if self.fsync == "always" or (self.fsync == "interval" and time.monotonic() - self.last_sync >= self.fsync_interval):
+                os.fsync(self.file.fileno())
+                self.last_sync = time.monotonic()
+            self.sizes[self.active] += size
+            self.unacked[self.active] += 1
+            self.pending.append(_Record(self.active, offset, stream, size, rows))
+            self.changed.notify_all()
+        return True
+
+    def __call__(self, batches):
+        # flush function for FlushPipeline: the batches are safe once they are spooled
+        for batch in batches:
+            self.append(batch.stream, batch.encode(), len(batch))
+        return []
+
+    def _read(self, record):
+        with open(self._path(record.segment), "rb") as f:
+            f.seek(record.offset)
+            data = f.read(record.size)
+        name_length = _HEADER.unpack_from(data)[3]
+        body = data[_HEADER.size + name_length:]
+        return SpooledBatch(record.stream, body, record.rows, record.segment, record.offset)
+
+    def _ack(self, record):
+        # called with the lock held
+        if record.segment not in self.unacked:
+            # the segment was dropped in the meantime
+            return
+        path = self._path(record.segment, ".ack")
+        created = not os.path.exists(path)
+        with open(path, "ab") as f:
+            f.write(_ACK.pack(record.offset))
+            if self.fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        if created:
+            self._sync_directory()
+        self.unacked[record.segment] -= 1
+        if self.unacked[record.segment] == 0 and record.segment != self.active:
+            self._delete_segment(record.segment)
+
+    def _next_round(self):
+        # take up to concurrency records, at most one per stream so that the batches
+        # of a stream are accepted in order; waits while there is nothing to send
+        with self.lock:
+            while not self.pending:
+                if self.closed:
+                    return None
+                self.changed.wait(1.0)
+            if self.closed:
+                return None
+            round = []
+            streams = set()
+            for (i, record) in enumerate(self.pending):
+                if record.stream not in streams:
+                    round.append(record)
+                    streams.add(record.stream)
+                if len(round) >= self.concurrency or i >= 16 * self.concurrency:
+                    break
+            for record in round:
+                self.pending.remove(record)
+            self.sending = round
+            return round
+
+    def _send_record(self, record):
+        try:
+            batch = self._read(record)
+        except FileNotFoundError:
+            # the segment was dropped in the meantime, _run() counts the rows
+            return False
+        return self.send(batch)
+
+    def _run(self):
+        while True:
+            round = self._next_round()
+            if round is None:
+                return
+            start = time.monotonic()
+            if self.executor is not None and len(round) > 1:
+                results = list(self.executor.map(self._send_record, round))
+            else:
+                results = [self._send_record(r) for r in round]
+            with self.lock:
+                failed = []
+                for (record, ok) in zip(round, results):
+                    if ok:
+                        self._ack(record)
+                    elif record.segment not in self.sizes:
+                        # the segment was dropped while the record was being sent
+                        self.dropped_rows += record.rows
+                    else:
+                        failed.append(record)
+                # put failed records back in front, in their original order
+                self.pending.extendleft(reversed(failed))
+                self.sending = []
+                self.changed.notify_all()
+            if failed:
+                time.sleep(self.retry_interval)
+            elif self.max_rate:
+                # only the replay after a restart is throttled, new batches go out right away
+                elapsed = time.monotonic() - start
+                wait = sum(r.size for r in round if r.replayed) / self.max_rate - elapsed
+                if wait > 0:
+                    time.sleep(wait)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) until everything has been sent,
+        then stop the sender; batches which were not sent stay on disk for the next start
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.pending or self.sending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.changed.wait(remaining if remaining is not None else 1.0)
+            self.closed = True
+            self.changed.notify_all()
+        self.thread.join()
+        with self.lock:
+            if self.pending:
+                print(f"{len(self.pending)} batches remain in {self.directory}", file=sys.stderr)
+            os.fsync(self.file.fileno())
+            self.file.close()
+            if self.unacked.get(self.active) == 0:
+                self._delete_segment(self.active)
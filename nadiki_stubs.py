@@ -0,0 +1,657 @@
+"""
+Local stand-in servers for the APIs used by the Nadiki scripts
+
+These servers are meant for trying out and benchmarking the scripts
+without access to the real services. Every server records the requests
+it receives and can be told to fail or to respond slowly.
+
+They can be used from Python:
+
+    with RecordingServer(ProtonIngestHandler) as server:
+        transport = HTTPTransport(server.url + "/proton/v1/ingest/streams/", ...)
+        ...
+        print(len(server.accepted()))
+
+or started from the command line, e.g.
+
+    python3 nadiki_stubs.py proton --port 3218
+    python3 nadiki_stubs.py proton-native --port 8463   # PROTON_INGEST_TRANSPORT=native
+    python3 nadiki_stubs.py zabbix --port 8080   # ZABBIX_URL=http://127.0.0.1:8080/api_jsonrpc.php
+    python3 nadiki_stubs.py victoriametrics --port 8428   # VICTORIA_METRICS_URL=http://127.0.0.1:8428
+    python3 nadiki_stubs.py electricitymaps --port 8081   # ELECTRICITYMAP_URL=http://127.0.0.1:8081/v3
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from proton_driver import client
+from proton_driver.block import ColumnOrientedBlock
+from proton_driver.bufferedreader import BufferedSocketReader
+from proton_driver.bufferedwriter import BufferedSocketWriter
+from proton_driver.connection import ServerInfo
+from proton_driver.reader import read_binary_str
+from proton_driver.streams.native import BlockInputStream, BlockOutputStream
+from proton_driver.varint import read_varint, write_varint
+from proton_driver.writer import write_binary_str
+
+
+class RecordedRequest:
+    """
+    One request received by a stub server (the body is already decompressed)
+    """
+    __slots__ = ("method", "path", "headers", "body", "raw_size", "status", "received")
+
+    def __init__(self, method, path, headers, body, raw_size):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.raw_size = raw_size
+        self.status = None  # status code of the response
+        self.received = time.monotonic()
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Base class for the request handlers, subclasses implement respond()
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        body = gzip.decompress(raw) if self.headers.get("Content-Encoding") == "gzip" else raw
+        request = RecordedRequest(self.command, self.path, dict(self.headers), body, len(raw))
+        with server.lock:
+            server.requests.append(request)
+            server.connections.add(self.client_address)
+            fail = server.fail_next > 0 or server.down
+            if server.fail_next > 0:
+                server.fail_next -= 1
+        if server.latency:
+            time.sleep(server.latency)
+        if fail:
+            request.status = server.fail_status
+            self._send(server.fail_status, b"stub failure")
+            return
+        status, payload = self.respond(request)
+        request.status = status
+        self._send(status, payload)
+
+    def _send(self, status, payload, content_type="application/json"):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def respond(self, request):
+        return 200, b""
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class ProtonIngestHandler(StubHandler):
+    """
+    Stand-in for the REST ingest API of Proton (/proton/v1/ingest/streams/<stream>)
+    """
+    def respond(self, request):
+        if not request.path.startswith("/proton/v1/ingest/streams/"):
+            return 404, {"error": "not found"}
+        try:
+            payload = request.json()
+            assert isinstance(payload["columns"], list) and isinstance(payload["data"], list)
+        except Exception as e:
+            return 400, {"error": f"invalid body: {e}"}
+        return 200, b""
+
+
+class ZabbixData:
+    """
+    Items and generated history of the Zabbix stub
+
+    Every item has a sample every interval seconds (at multiples of the interval)
+    whose value is derived from the item ID and the clock, see value(). The history
+    covers the last history_days, older data is only available as hourly trends.
+
+    Args:
+        keys (list): item keys of the host
+        host (str): name of the host
+        interval (int): seconds between two samples
+        history_days (float): retention of the history
+        now (callable): returns the current time, defaults to time.time
+    """
+
+    def __init__(self, keys, host="EDS-NADIKI", interval=60, history_days=7, now=time.time):
+        self.host = host
+        self.hostid = "10001"
+        self.interval = interval
+        self.history_days = history_days
+        self.now = now
+        self.items = {str(20001 + i): {"itemid": str(20001 + i), "hostid": self.hostid, "key_": key, "value_type": "0"}
+            for (i, key) in enumerate(keys)}
+
+    @staticmethod
+    def value(itemid, clock):
+        return float(int(itemid) % 1000 * 1000 + clock % 1000)
+
+    def _clocks(self, time_from, time_till):
+        first = -(-time_from // self.interval) * self.interval
+        return range(first, time_till + 1, self.interval)
+
+    def history(self, itemids, time_from, time_till):
+        end = int(self.now())
+        time_from = max(time_from, int(end - self.history_days * 86400))
+        time_till = min(time_till, end)
+        samples = []
+        for itemid in itemids:
+            for clock in self._clocks(time_from, time_till):
+                samples.append({"itemid": itemid, "clock": str(clock), "ns": "0", "value": repr(self.value(itemid, clock))})
+        return samples
+
+    def trends(self, itemids, time_from, time_till):
+        end = int(self.now())
+        result = []
+        for itemid in itemids:
+            for hour in range(time_from // 3600 * 3600, min(time_till, end) + 1, 3600):
+                if hour < time_from:
+                    continue
+                values = [self.value(itemid, c) for c in self._clocks(hour, hour + 3599)]
+                if values:
+                    result.append({"itemid": itemid, "clock": str(hour), "num": str(len(values)),
+                        "value_min": repr(min(values)), "value_avg": repr(sum(values) / len(values)), "value_max": repr(max(values))})
+        return result
+
+
+class ZabbixHandler(StubHandler):
+    """
+    Stand-in for the JSON-RPC API of Zabbix (api_jsonrpc.php), including batch requests
+
+    Uses the ZabbixData in server.zabbix. Setting server.zabbix_token to None makes
+    the current session expire.
+    """
+
+    def respond(self, request):
+        try:
+            payload = request.json()
+        except ValueError:
+            return 200, {"jsonrpc": "2.0", "error": {"code": -32700, "message": "Parse error."}, "id": None}
+        if isinstance(payload, list):
+            return 200, [self._call(call, request) for call in payload]
+        return 200, self._call(payload, request)
+
+    def _call(self, call, request):
+        server = self.server
+        method = call.get("method")
+        params = call.get("params") or {}
+        auth = call.get("auth") or request.headers.get("Authorization", "").replace("Bearer ", "") or None
+        try:
+            if method == "user.login":
+                server.zabbix_token = uuid.uuid4().hex
+                result = server.zabbix_token
+            elif auth is None or auth != getattr(server, "zabbix_token", None):
+                return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.",
+                    "data": "Session terminated, re-login, please."}, "id": call.get("id")}
+            else:
+                result = getattr(self, "_" + method.replace(".", "_"))(server.zabbix, params)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.", "data": str(e)}, "id": call.get("id")}
+        return {"jsonrpc": "2.0", "result": result, "id": call.get("id")}
+
+    @staticmethod
+    def _output(rows, output):
+        if output in (None, "extend"):
+            return rows
+        return [{k: row[k] for k in output if k in row} for row in rows]
+
+    @staticmethod
+    def _ids(value):
+        return {str(v) for v in (value if isinstance(value, list) else [value])}
+
+    def _host_get(self, data, params):
+        hosts = [{"hostid": data.hostid, "host": data.host}]
+        wanted = (params.get("filter") or {}).get("host")
+        if wanted is not None:
+            hosts = [h for h in hosts if h["host"] in (wanted if isinstance(wanted, list) else [wanted])]
+        return self._output(hosts, params.get("output"))
+
+    def _item_get(self, data, params):
+        items = list(data.items.values())
+        if "hostids" in params:
+            items = [i for i in items if i["hostid"] in self._ids(params["hostids"])]
+        if "itemids" in params:
+            items = [i for i in items if i["itemid"] in self._ids(params["itemids"])]
+        if "host" in params and params["host"] != data.host:
+            items = []
+        keys = (params.get("filter") or {}).get("key_")
+        if keys is not None:
+            items = [i for i in items if i["key_"] in (keys if isinstance(keys, list) else [keys])]
+        rows = []
+        for item in items:
+            clock = int(data.now()) // data.interval * data.interval
+            rows.append({**item, "lastclock": str(clock), "lastvalue": repr(data.value(item["itemid"], clock))})
+        return self._output(rows, params.get("output"))
+
+    def _history_get(self, data, params):
+        rows = data.history(sorted(self._ids(params["itemids"])), int(params.get("time_from", 0)),
+            int(params.get("time_till", 2**31)))
+        if params.get("sortfield") == "clock":
+            rows.sort(key=lambda r: int(r["clock"]), reverse=params.get("sortorder") == "DESC")
+        if "limit" in params:
+            rows = rows[:int(params["limit"])]
+        return self._output(rows, params.get("output"))
+
+    def _trend_get(self, data, params):
+        rows = data.trends(sorted(self._ids(params["itemids"])), int(params.get("time_from", 0)),
+            int(params.get("time_till", 2**31)))
+        if "limit" in params:
+            rows = rows[:int(params["limit"])]
+        return self._output(rows, params.get("output"))
+
+
+class VictoriaMetricsData:
+    """
+    Series and generated points of the VictoriaMetrics stub
+
+    Every metric has series_per_instance series per instance (distinguished by a
+    device label) with a point every interval seconds, at multiples of the interval.
+    The values are derived from the series and the timestamp, see value().
+
+    Args:
+        instances (list): values of the instance label, e.g. "10.0.0.1:9100"
+        series_per_instance (int): series per metric and instance
+        interval (float): seconds between two points
+        now (callable): returns the current time, defaults to time.time
+    """
+
+    def __init__(self, instances, series_per_instance=1, interval=15, now=time.time):
+        self.instances = list(instances)
+        self.series_per_instance = series_per_instance
+        self.interval = interval
+        self.now = now
+
+    @staticmethod
+    def value(instance_index, device, timestamp):
+        # timestamp in milliseconds
+        return float(instance_index * 1000 + device * 100 + timestamp // 1000 % 100)
+
+    def export(self, metric, start):
+        """
+        Lines of /api/v1/export for a metric (the name before any label filter) since start (seconds)
+        """
+        name = metric.split("{")[0]
+        now = self.now()
+        step = int(self.interval * 1000)
+        first = -(-int(start * 1000) // step) * step
+        timestamps = list(range(first, int(now * 1000) + 1, step))
+        for (i, instance) in enumerate(self.instances):
+            for device in range(self.series_per_instance):
+                yield json.dumps({"metric": {"__name__": name, "instance": instance, "job": "node", "device": f"dev{device}"},
+                    "values": [self.value(i, device, ts) for ts in timestamps], "timestamps": timestamps})
+
+    def start_of(self, value):
+        # the start parameter is a timestamp in seconds or relative like -1h
+        if value is None:
+            return self.now() - 3600
+        if value.startswith("-"):
+            units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+            return self.now() - float(value[1:-1]) * units[value[-1]]
+        return float(value)
+
+
+class VictoriaMetricsHandler(StubHandler):
+    """
+    Stand-in for the export API of VictoriaMetrics (/select/0/prometheus/api/v1/export)
+
+    Uses the VictoriaMetricsData in server.victoriametrics.
+    """
+    def respond(self, request):
+        url = urlsplit(request.path)
+        if not url.path.endswith("/api/v1/export"):
+            return 404, {"error": "not found"}
+        query = parse_qs(url.query)
+        data = self.server.victoriametrics
+        start = data.start_of(query.get("start", [None])[0])
+        lines = [line for metric in query.get("match[]", []) for line in data.export(metric, start)]
+        return 200, "".join(line + "\n" for line in lines)
+
+
+class ElectricityMapsData:
+    """
+    Generated histories of the ElectricityMaps stub: the last 24 full hours of every zone
+
+    Args:
+        missing_every (int): every missing_every-th hour has no renewablePercentage (0: none)
+        now (callable): returns the current time, defaults to time.time
+    """
+
+    def __init__(self, missing_every=0, now=time.time):
+        self.missing_every = missing_every
+        self.now = now
+
+    @staticmethod
+    def value(data_type, zone, hour):
+        # hour in seconds since the epoch
+        base = sum(map(ord, zone)) % 100
+        if data_type == "carbon-intensity":
+            return 100 + base + hour // 3600 % 24
+        return float(base + hour // 3600 % 50)
+
+    def history(self, data_type, zone):
+        end = int(self.now()) // 3600 * 3600
+        history = []
+        for hour in range(end - 23 * 3600, end + 1, 3600):
+            item = {"zone": zone, "datetime": datetime.datetime.fromtimestamp(hour, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "isEstimated": hour == end}
+            value = self.value(data_type, zone, hour)
+            if data_type == "carbon-intensity":
+                item["carbonIntensity"] = value
+            else:
+                missing = self.missing_every and hour // 3600 % self.missing_every == 0
+                item["renewablePercentage"] = None if missing else value
+            history.append(item)
+        return history
+
+
+class ElectricityMapsHandler(StubHandler):
+    """
+    Stand-in for the history API of ElectricityMaps (/v3/<data type>/history?zone=<zone>)
+
+    Uses the ElectricityMapsData in server.electricitymaps.
+    """
+    def respond(self, request):
+        url = urlsplit(request.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "v3" or parts[2] != "history" or parts[1] not in ("carbon-intensity", "power-breakdown"):
+            return 404, {"error": "not found"}
+        if not request.headers.get("auth-token"):
+            return 401, {"error": "missing auth-token"}
+        zone = parse_qs(url.query).get("zone", ["NL"])[0]
+        return 200, {"zone": zone, "history": self.server.electricitymaps.history(parts[1], zone)}
+
+
+class RecordingServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server on localhost which records all requests
+
+    Args:
+        handler (type): subclass of StubHandler
+        port (int): port to listen on, 0 picks a free one
+        latency (float): seconds to wait before each response
+    """
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, latency=0.0, host="127.0.0.1"):
+        super().__init__((host, port), handler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = set()  # distinct client addresses, i.e. TCP connections
+        self.latency = latency
+        self.fail_next = 0  # number of requests to answer with fail_status
+        self.fail_status = 503
+        self.down = False  # answer all requests with fail_status
+        self.thread = None
+
+    def accepted(self):
+        """
+        Requests which were answered with a 2xx status
+        """
+        with self.lock:
+            return [r for r in self.requests if r.status is not None and 200 <= r.status < 300]
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class RecordedInsert:
+    """
+    One INSERT received by the native stub, with the values of its columns
+    """
+    __slots__ = ("query", "stream", "names", "columns", "rows", "received")
+
+    def __init__(self, query, names, columns):
+        self.query = query
+        self.stream = query.split()[2]
+        self.names = names
+        self.columns = columns  # one list of values per column
+        self.rows = len(columns[0]) if columns else 0
+        self.received = time.monotonic()
+
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+
+class ProtonNativeHandler(socketserver.BaseRequestHandler):
+    """
+    Stand-in for the native protocol of Proton, as far as the ingester uses it
+
+    It answers INSERT queries with the columns of an ingester stream (see
+    ProtonNativeServer.column_type), reads the blocks with the readers of
+    proton_driver and records them. Other queries return no rows. The stub
+    announces an old protocol revision, so the client leaves out the client
+    info and sends the settings in their short form.
+    """
+    REVISION = 54031  # with block info, without client info
+    CLIENT_HELLO, CLIENT_QUERY, CLIENT_DATA, CLIENT_CANCEL, CLIENT_PING = range(5)
+    SERVER_HELLO, SERVER_DATA, SERVER_EXCEPTION, SERVER_PROGRESS, SERVER_PONG, SERVER_END_OF_STREAM = range(6)
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.context = client.Client(self.server.host).connection.context
+        self.context.server_info = ServerInfo("Proton stub", 1, 0, 0, self.REVISION, None, "")
+        self.fin = BufferedSocketReader(self.request, 1048576)
+        self.fout = BufferedSocketWriter(self.request, 1048576)
+        self.block_in = BlockInputStream(self.fin, self.context)
+        self.block_out = BlockOutputStream(self.fout, self.context)
+
+    def handle(self):
+        server = self.server
+        try:
+            if read_varint(self.fin) != self.CLIENT_HELLO:
+                return
+            read_binary_str(self.fin)  # client name
+            for _ in range(3):
+                read_varint(self.fin)  # major, minor, revision
+            for _ in range(3):
+                read_binary_str(self.fin)  # database, user, password
+            write_varint(self.SERVER_HELLO, self.fout)
+            write_binary_str("Proton stub", self.fout)
+            for value in (1, 0, self.REVISION):
+                write_varint(value, self.fout)
+            self.fout.flush()
+            with server.lock:
+                server.connections.add(self.client_address)
+            while True:
+                packet = read_varint(self.fin)
+                if packet == self.CLIENT_PING:
+                    write_varint(self.SERVER_PONG, self.fout)
+                    self.fout.flush()
+                    continue
+                if packet != self.CLIENT_QUERY:
+                    return
+                read_binary_str(self.fin)  # query ID
+                while read_binary_str(self.fin):
+                    pass  # the client sends no settings
+                read_varint(self.fin)  # stage
+                read_varint(self.fin)  # compression
+                query = read_binary_str(self.fin)
+                self._read_block()  # end of the external tables
+                with server.lock:
+                    fail = server.fail_next > 0 or server.down
+                    if server.fail_next > 0:
+                        server.fail_next -= 1
+                if fail:
+                    return  # the client sees a broken connection
+                if query.lstrip().upper().startswith("INSERT"):
+                    self._insert(query)
+                write_varint(self.SERVER_END_OF_STREAM, self.fout)
+                self.fout.flush()
+        except (EOFError, OSError):
+            pass
+
+    def _read_block(self):
+        if read_varint(self.fin) != self.CLIENT_DATA:
+            raise EOFError("expected a data packet")
+        read_binary_str(self.fin)  # table name
+        return self.block_in.read()
+
+    def _write_block(self, block):
+        write_varint(self.SERVER_DATA, self.fout)
+        write_binary_str("", self.fout)
+        self.block_out.write(block)
+
+    def _insert(self, query):
+        # answer with the structure of the columns, then read blocks until the empty one
+        names = [n.strip() for n in query[query.index("(") + 1:query.index(")")].split(",")]
+        self._write_block(ColumnOrientedBlock([(n, self.server.column_type(n)) for n in names], [[] for _ in names]))
+        columns = [[] for _ in names]
+        while True:
+            block = self._read_block()
+            if not block.num_rows:
+                break
+            for (column, values) in zip(columns, block.get_columns()):
+                column.extend(values)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.inserts.append(RecordedInsert(query, names, columns))
+
+
+class ProtonNativeServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded server for the native protocol of Proton on localhost which records all inserts
+
+    Args:
+        port (int): port to listen on, 0 picks a free one
+        latency (float): seconds to wait before acknowledging an insert
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, host="127.0.0.1"):
+        super().__init__((host, port), ProtonNativeHandler)
+        self.lock = threading.Lock()
+        self.inserts = []
+        self.connections = set()
+        self.latency = latency
+        self.fail_next = 0  # number of queries after which the connection is closed
+        self.down = False  # close the connection after every query
+        self.thread = None
+
+    @staticmethod
+    def column_type(name):
+        # the columns of the streams created by the ingester
+        if name in ("tags", "fields"):
+            return "map(string, string)"
+        if name == "timestamp":
+            return "int64"
+        if name == "_tp_time":
+            return "datetime64(3, 'UTC')"
+        return "string"
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+STUBS = {
+    "proton": ProtonIngestHandler,
+    "zabbix": ZabbixHandler,
+    "victoriametrics": VictoriaMetricsHandler,
+    "electricitymaps": ElectricityMapsHandler,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a stand-in server for one of the APIs used by Nadiki")
+    parser.add_argument("stub", choices=sorted(STUBS) + ["proton-native"])
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before each response")
+    args = parser.parse_args()
+    if args.stub == "proton-native":
+        server = ProtonNativeServer(port=args.port, latency=args.latency)
+        print(f"proton-native stub listening on {server.host}:{server.port}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print(f"received {len(server.inserts)} inserts over {len(server.connections)} connections", file=sys.stderr)
+        sys.exit(0)
+    server = RecordingServer(STUBS[args.stub], port=args.port, latency=args.latency)
+    if args.stub == "zabbix":
+        # the item keys of the Zabbix crawler with SEVERIUS_DC_PREFIX=NL3
+        server.zabbix = ZabbixData([f"NL3_{k}" for k in ("Heat_Pump_Power", "Office_Power", "Generators_Power",
+            "Total_Grid_Power", "Power_PV", "Total_IT_Power_Basic_Res", "Total_IT_Power_Intermediate_Res",
+            "PUE_Basic_Res", "PUE_Intermediate_Res")])
+    server.victoriametrics = VictoriaMetricsData([f"10.0.0.{i}:9100" for i in range(1, 11)])
+    server.electricitymaps = ElectricityMapsData()
+    print(f"{args.stub} stub listening on {server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"received {len(server.requests)} requests over {len(server.connections)} connections", file=sys.stderr)
@@ -1,10 +1,28 @@
-from flask import Flask, request
+from flask import Flask, Response, request
+import fcntl
 import json
 import subprocess
 import os
+import shlex
 import sys
+import threading
+import time
+import zlib
 
-if os.getuid() != 0:
+# command which lists the containers, can be replaced e.g. by "cat crictl-ps.json" for testing
+CRICTL_COMMAND = shlex.split(os.getenv("CRICTL_COMMAND", "crictl ps -o json"))
+# seconds for which the table of pod labels is used before it is read again
+POD_LABELS_TTL = float(os.getenv("POD_LABELS_TTL", "30"))
+# minimum number of seconds between two early refreshes caused by unknown pods
+POD_LABELS_MIN_REFRESH = float(os.getenv("POD_LABELS_MIN_REFRESH", "2"))
+# file through which several worker processes share the table, e.g. /dev/shm/pod-labels.json
+POD_LABELS_SHARED_FILE = os.getenv("POD_LABELS_SHARED_FILE")
+# gzip level for clients which accept it, 0 disables compression
+POD_LABELS_GZIP_LEVEL = int(os.getenv("POD_LABELS_GZIP_LEVEL", "1"))
+# number of pods per chunk of a streamed response
+CHUNK_SIZE = 1000
+
+if CRICTL_COMMAND[0] == "crictl" and os.getuid() != 0:
     sys.exit("This process must be run as root in order to use crictl!")
 
 app = Flask(__name__)
@@ -14,25 +32,258 @@ app = Flask(__name__)
 #
 # It translates pod IDs (which are used in cadvisor metrics) into labels.
 #
+# POST / with {"pod_id": [...]} returns {"result": [{labels}, ...]} as expected by
+# Proton, POST /?keys=a,b only returns the labels a and b.
+#
+# POST /columns with {"pod_id": [...], "keys": [...]} returns the selected labels
+# column by column, every distinct value is sent only once:
+#   {"keys": [...], "columns": [[index into values or null for each pod], ...], "values": [...]}
+#
+# Responses are streamed and compressed with gzip if the client accepts it. With
+# several worker processes, e.g.
+#   POD_LABELS_SHARED_FILE=/dev/shm/pod-labels.json gunicorn -w 4 -b 0.0.0.0:5000 app:app
+# only one of them calls crictl and the others read its result from the shared file.
+#
+
+
+class LabelTable:
+    """
+    Pod labels read at one point in time, the JSON of the labels is cached per selection of keys
+    """
+    __slots__ = ("labels", "encoded")
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.encoded = {}  # tuple of keys (None for all) -> pod ID -> JSON
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get(self, pod_id):
+        return self.labels.get(pod_id)
+
+    def json(self, pod_id, keys=None):
+        """
+        Labels of a pod (only the given keys) as JSON, None if the pod is unknown
+        """
+        cache = self.encoded.get(keys)
+        if cache is None:
+            if len(self.encoded) >= 16:
+                self.encoded = {}
+            cache = self.encoded[keys] = {}
+        encoded = cache.get(pod_id)
+        if encoded is None:
+            labels = self.labels.get(pod_id)
+            if labels is None:
+                return None
+            if keys is not None:
+                labels = {k: labels[k] for k in keys if k in labels}
+            encoded = cache[pod_id] = json.dumps(labels)
+        return encoded
+
+
+class LabelCache:
+    """
+    Table from pod (sandbox) ID to labels which is read again when it is older than ttl seconds
+
+    Only one thread reads the table at a time, concurrent requests either use the
+    previous table (if there is one) or wait for the result of that thread. With a
+    shared file, only one process reads the table and the others load it from the file.
+    """
+
+    def __init__(self, command, ttl, min_refresh_interval, shared_path=None):
+        self.command = command
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.shared_path = shared_path
+        self.shared_mtime = None  # modification time of the shared file when it was loaded
+        self.labels = None        # the current LabelTable, replaced as a whole
+        self.loaded = None        # monotonic time of the last attempt to read the table
+        self.flight = None        # event of the refresh in progress
+        self.lock = threading.Lock()
+
+    def load(self):
+        # call crictl and get all containers
+        cp = subprocess.run(self.command, capture_output=True, check=True)
+        containers = json.loads(cp.stdout)
+        # create a translation table from pod (sandbox) ID to a dictionary of labels
+        # (we assume that most of the time, all running pods will be requested though
+        # the batching feature of proton remote UDFs, so it does not hurt
+        # to create the whole table)
+        return {c["podSandboxId"]: c["labels"] for c in containers["containers"]}
+
+    def _load_shared(self, max_age):
+        # use the table of the shared file if it is younger than max_age seconds,
+        # returns the age of the table or None
+        try:
+            mtime = os.stat(self.shared_path).st_mtime
+            age = max(time.time() - mtime, 0)
+            if age >= max_age:
+                return None
+            if mtime != self.shared_mtime:
+                with open(self.shared_path) as f:
+                    self.labels = LabelTable(json.load(f))
+                self.shared_mtime = mtime
+        except (OSError, ValueError):
+            return None
+        return age
+
+    def _load_exclusive(self, max_age):
+        # read the table, with a shared file only in one process at a time,
+        # returns the age of the table
+        if self.shared_path is None:
+            self.labels = LabelTable(self.load())
+            return 0
+        age = self._load_shared(max_age)
+        if age is not None:
+            return age
+        with open(self.shared_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # another process may have read the table while we were waiting
+            age = self._load_shared(max_age)
+            if age is not None:
+                return age
+            labels = self.load()
+            temp = f"{self.shared_path}.{os.getpid()}"
+            with open(temp, "w") as f:
+                json.dump(labels, f)
+            os.replace(temp, self.shared_path)
+            self.labels = LabelTable(labels)
+            self.shared_mtime = os.stat(self.shared_path).st_mtime
+            return 0
+
+    def refresh(self, wait=True, max_age=None):
+        """
+        Read the table, or wait for the thread which is already reading it if wait is True
+
+        With a shared file, a table which is younger than max_age seconds (default: the TTL)
+        is taken from the file.
+        """
+        with self.lock:
+            flight = self.flight
+            leader = flight is None
+            if leader:
+                flight = self.flight = threading.Event()
+        if not leader:
+            if wait:
+                flight.wait()
+            return
+        age = 0
+        try:
+            age = self._load_exclusive(self.ttl if max_age is None else max_age)
+        except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+            print(f"Reading the pod labels failed: {e}", file=sys.stderr)
+            if self.labels is None:
+                self.labels = LabelTable({})
+        finally:
+            # a table from the shared file expires together with the file
+            self.loaded = time.monotonic() - age
+            with self.lock:
+                self.flight = None
+            flight.set()
+
+    def table(self):
+        """
+        The current LabelTable, read again if it has expired
+        """
+        if self.loaded is None or time.monotonic() - self.loaded >= self.ttl:
+            self.refresh(wait=self.labels is None)
+        return self.labels
+
+    def missing(self):
+        """
+        Called when a pod was not found, reads the table again in the background
+        """
+        # the pods may have been started after the table was read, the next
+        # batch will hopefully know them
+        if time.monotonic() - self.loaded >= self.min_refresh_interval:
+            threading.Thread(target=self.refresh, args=(False, self.min_refresh_interval), daemon=True).start()
+
+
+cache = LabelCache(CRICTL_COMMAND, POD_LABELS_TTL, POD_LABELS_MIN_REFRESH, POD_LABELS_SHARED_FILE)
+
+
+def streamed(chunks):
+    # send the chunks as they are produced, compressed if the client accepts gzip
+    headers = {}
+    if POD_LABELS_GZIP_LEVEL and "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        chunks = gzipped(chunks, POD_LABELS_GZIP_LEVEL)
+    return Response(chunks, mimetype="application/json", headers=headers)
+
+
+def gzipped(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def result_chunks(table, pod_ids, keys):
+    # {"result": [...]} in chunks of CHUNK_SIZE pods
+    yield '{"result":['
+    missing = False
+    for start in range(0, len(pod_ids), CHUNK_SIZE):
+        parts = []
+        for id in pod_ids[start:start + CHUNK_SIZE]:
+            encoded = table.json(id, keys)
+            if encoded is None:
+                # unknown pods get an empty map instead of failing the whole batch
+                missing = True
+                encoded = "{}"
+            parts.append(encoded)
+        yield ("," if start else "") + ",".join(parts)
+    yield "]}"
+    if missing:
+        cache.missing()
+
+
+def column_chunks(table, pod_ids, keys):
+    # {"keys": [...], "columns": [[...], ...], "values": [...]}, every distinct value
+    # is only sent once in values and referenced by its index
+    values = {}
+    missing = False
+    yield '{"keys":' + json.dumps(keys) + ',"columns":['
+    for (i, key) in enumerate(keys):
+        yield "," if i else ""
+        yield "["
+        for start in range(0, len(pod_ids), CHUNK_SIZE):
+            parts = []
+            for id in pod_ids[start:start + CHUNK_SIZE]:
+                labels = table.get(id)
+                if labels is None:
+                    missing = True
+                    parts.append("null")
+                    continue
+                value = labels.get(key)
+                if value is None:
+                    parts.append("null")
+                    continue
+                index = values.get(value)
+                if index is None:
+                    index = values[value] = len(values)
+                parts.append(str(index))
+            yield ("," if start else "") + ",".join(parts)
+        yield "]"
+    yield '],"values":' + json.dumps(list(values)) + "}"
+    if missing:
+        cache.missing()
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     pod_ids = request.json["pod_id"] # this is an array
+    keys = request.args.get("keys")
+    keys = tuple(keys.split(",")) if keys else None
+    return streamed(result_chunks(cache.table(), pod_ids, keys))
+
 
-    # call crictl and get all containers
-    #cp = subprocess.run(["cat", "crictl-ps.json"], capture_output=True)   
-    cp = subprocess.run(["crictl", "ps", "-o", "json"], capture_output=True)
-    print(cp.stderr)
-    containers = json.loads(cp.stdout)
-    # create a translation table from pod (sandbox) ID to a dictionary of labels
-    # (we assume that most of the time, all running pods will be requested though
-    # the batching feature of proton remote UDFs, so it does not hurt
-    # to create the whole table)
-    pod2label = {}
-    for c in containers["containers"]:
-        pod2label[c["podSandboxId"]] = c["labels"]
-    # and now, create the result by looking up all input IDs in our translation table
-    result = []
-    for id in pod_ids:
-        result.append(pod2label[id])
-    return(json.dumps({ "result": result }))
+@app.route("/columns", methods=["POST"])
+def columns():
+    body = request.json
+    keys = body.get("keys")
+    if not isinstance(keys, list) or not all(isinstance(k, str) for k in keys):
+        return Response(json.dumps({"error": "keys must be a list of label names"}), status=400, mimetype="application/json")
+    return streamed(column_chunks(cache.table(), body["pod_id"], keys))
@@ -0,0 +1,118 @@
+#!env python3
+#
+# Measures requests/sec and latency of the pod label UDF against a stub crictl
+# which prints crictl-ps.json after a delay (like the real crictl, which takes
+# a while to talk to containerd).
+#
+#   python3 benchmark.py [--requests 2000] [--clients 8] [--crictl-delay 0.05]
+#
+# The app is run once without the cache (crictl is called for every request, like
+# before the cache existed) and once with the cache.
+#
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def stub_crictl(directory, delay):
+    # a shell script which behaves like crictl ps -o json
+    path = os.path.join(directory, "crictl-stub")
+    with open(path, "w") as f:
+        f.write(f"#!/bin/sh\nsleep {delay}\nexec cat {os.path.join(HERE, 'crictl-ps.json')}\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+def run_clients(url, pod_ids, n_requests, n_clients, batch_size):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(n):
+        session = requests.Session()
+        for _ in range(n):
+            batch = [random.choice(pod_ids) for _ in range(batch_size)]
+            start = time.perf_counter()
+            try:
+                r = session.post(url, json={"pod_id": batch})
+                ok = r.status_code == 200 and len(r.json()["result"]) == batch_size
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(n_requests // n_clients,)) for _ in range(n_clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.perf_counter() - start
+
+
+def measure(app_module, ttl, args):
+    cache = app_module.cache
+    cache.labels = None
+    cache.loaded = None
+    if ttl is None:
+        # no cache at all, the table is read for every request
+        def uncached():
+            labels = app_module.LabelTable(cache.load())
+            cache.loaded = time.monotonic()
+            return labels
+        cache.table = uncached
+    else:
+        cache.ttl = ttl
+        del cache.table
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with open(os.path.join(HERE, "crictl-ps.json")) as f:
+        pod_ids = [c["podSandboxId"] for c in json.load(f)["containers"]]
+    # a few unknown pods, these must not fail the batch
+    pod_ids += ["unknown-pod-1", "unknown-pod-2"]
+    try:
+        latencies, errors, elapsed = run_clients(f"http://127.0.0.1:{server.port}/", pod_ids,
+            args.requests, args.clients, args.batch_size)
+    finally:
+        server.shutdown()
+    latencies.sort()
+    return {
+        "cache": "off" if ttl is None else f"ttl={ttl}",
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "requests_per_sec": round((len(latencies) + len(errors)) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2) if latencies else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pod label UDF against a stub crictl")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=50, help="pod IDs per request")
+    parser.add_argument("--crictl-delay", type=float, default=0.05, help="seconds the stub crictl takes")
+    parser.add_argument("--ttl", type=float, default=30, help="TTL of the cache for the second run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["CRICTL_COMMAND"] = stub_crictl(directory, args.crictl_delay)
+        sys.path.insert(0, HERE)
+        import app
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        for ttl in (None, args.ttl):
+            print(json.dumps(measure(app, ttl, args)))
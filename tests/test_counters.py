@@ -0,0 +1,95 @@
+import pytest
+
+from nadiki_counters import COUNTER32_LIMITS, CounterDiff, counter_wrap
+from nadiki_lineprotocol import Unsigned, parse_line
+
+S = 10**9
+
+
+def test_differences():
+    engine = CounterDiff(key_tags=["interface"])
+    assert engine.process("net", {"interface": "eth0"}, {"bytes_sent": 100, "bytes_recv": 10}, 1 * S) is None
+    assert engine.process("net", {"interface": "eth0", "host": "a"}, {"bytes_sent": 150, "bytes_recv": 30}, 2 * S) == \
+        ("net", {"interface": "eth0", "host": "a"}, {"bytes_sent": 50, "bytes_recv": 20}, 2 * S)
+    # another key tag value is another series
+    assert engine.process("net", {"interface": "eth1"}, {"bytes_sent": 500, "bytes_recv": 10}, 2 * S) is None
+    assert len(engine) == 2
+
+
+def test_ratio_and_invert():
+    engine = CounterDiff(calculate_ratio=True, invert=True)
+    engine.process("cpu", {}, {"idle": 100.0}, 10 * S)
+    (_, _, fields, _) = engine.process("cpu", {}, {"idle": 104.0}, 15 * S)
+    assert fields == {"idle": pytest.approx(1 - 4 / 5)}
+
+
+def test_non_numeric_fields_are_left_out():
+    engine = CounterDiff()
+    engine.process("m", {}, {"up": True, "state": "ok", "n": 1}, 1 * S)
+    assert engine.process("m", {}, {"up": False, "state": "ok", "n": 3}, 2 * S)[2] == {"n": 2}
+
+
+def test_wrap_at_2_64():
+    engine = CounterDiff()
+    engine.process("m", {}, {"c": 2**64 - 10}, 1 * S)
+    assert engine.process("m", {}, {"c": 5}, 2 * S)[2] == {"c": 15}
+    assert engine.stats()["wraps"] == 1
+
+
+def test_wrap_of_unsigned_fields():
+    engine = CounterDiff()
+    engine.process(*parse_line("snmp ifHCInOctets=18446744073709551610u 1000000000"))
+    assert engine.process(*parse_line("snmp ifHCInOctets=4u 2000000000"))[2] == {"ifHCInOctets": 10}
+
+
+def test_wrap_at_2_32_only_for_32_bit_fields():
+    engine = CounterDiff(counter32_fields=["ifInOctets"])
+    engine.process("snmp", {}, {"ifInOctets": 2**32 - 10, "bytes": 2**32 - 10}, 1 * S)
+    assert engine.process("snmp", {}, {"ifInOctets": 6, "bytes": 6}, 2 * S)[2] == {"ifInOctets": 16}
+    assert engine.stats()["wraps"] == 1
+    assert engine.stats()["resets"] == 1
+
+
+def test_reset_continues_from_the_new_value():
+    engine = CounterDiff()
+    engine.process("m", {}, {"c": 1000}, 1 * S)
+    assert engine.process("m", {}, {"c": 10}, 2 * S) is None
+    assert engine.process("m", {}, {"c": 25}, 3 * S)[2] == {"c": 15}
+    assert engine.stats()["resets"] == 1
+
+
+def test_counter_wrap():
+    assert counter_wrap(5, 2**64 - 10) == 15
+    assert counter_wrap(5, 2**63) is None
+    assert counter_wrap(5, 2**32 - 10, COUNTER32_LIMITS) == 15
+    assert counter_wrap(Unsigned(5), Unsigned(2**64 - 10)) == 15
+    assert counter_wrap(5.0, 2.0**64 - 10) is None
+
+
+def test_repeated_and_out_of_order_metrics_are_dropped():
+    engine = CounterDiff()
+    engine.process("m", {}, {"c": 10}, 2 * S)
+    assert engine.process("m", {}, {"c": 20}, 2 * S) is None
+    assert engine.process("m", {}, {"c": 5}, 1 * S) is None
+    assert engine.process("m", {}, {"c": 30}, 3 * S)[2] == {"c": 20}
+    assert engine.stats()["dropped"] == 2
+
+
+def test_series_expire_after_the_ttl():
+    engine = CounterDiff(ttl=60)
+    engine.process("a", {}, {"c": 1}, 0)
+    engine.process("b", {}, {"c": 1}, 30 * S)
+    engine.process("b", {}, {"c": 2}, 61 * S)
+    assert engine.stats()["expired"] == 1
+    # a starts over, its first metric after the expiry has no difference
+    assert engine.process("a", {}, {"c": 5}, 62 * S) is None
+    assert len(engine) == 2
+
+
+def test_max_series():
+    engine = CounterDiff(max_series=2)
+    for name in ("a", "b", "c"):
+        engine.process(name, {}, {"c": 1}, 1 * S)
+    assert len(engine) == 2
+    assert engine.process("a", {}, {"c": 2}, 2 * S) is None
+    assert engine.process("c", {}, {"c": 2}, 2 * S)[2] == {"c": 1}
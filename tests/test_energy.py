@@ -0,0 +1,125 @@
+import io
+import random
+
+import pytest
+
+from nadiki_energy import EnergyIntegrator, EnergyReplay, energy_joules
+from nadiki_lineprotocol import LineProtocolError, format_line, parse_line, parse_lines
+from nadiki_loadgen import LoadGenerator
+
+numpy = pytest.importorskip("numpy")
+
+SERVER = "country_code=NL,facility_id=ams1,rack_id=r01,server_id=srv1"
+
+
+def stream(lines, **kwargs):
+    # the streaming path of the server processor: process() line by line, then flush()
+    engine = EnergyIntegrator(**kwargs)
+    result = []
+    for line in lines:
+        try:
+            metric = engine.process(*parse_line(line))
+        except (LineProtocolError, KeyError, TypeError, ValueError):
+            continue
+        if metric is not None:
+            result.append(format_line(*metric))
+    result.extend(format_line(*metric) for metric in engine.flush())
+    return result
+
+
+def replay(tmp_path, chunks, **kwargs):
+    engine = EnergyReplay(**kwargs)
+    for (i, lines) in enumerate(chunks):
+        path = tmp_path / f"dump-{i}.lp"
+        path.write_text("".join(line + "\n" for line in lines))
+        engine.scan(str(path))
+    out = io.BytesIO()
+    engine.write_lines(out)
+    return (out.getvalue().decode().splitlines(), engine)
+
+
+def ticks(count=12, shuffle=None, **kwargs):
+    gen = LoadGenerator(**{"servers": 4, "sensors": 3, "packages": 2, "gpus": 2, "interval": 10, **kwargs})
+    lines = []
+    for t in range(count):
+        tick = gen.tick(t)
+        if shuffle is not None:
+            shuffle.shuffle(tick)
+        lines += tick
+    return lines
+
+
+def test_energy_joules():
+    # the fraction of an hour times JOULES_PER_KWH
+    assert energy_joules(360, 0, 10 * 10**9) == pytest.approx(360 * 10 / 3600 * 3600000)
+    assert energy_joules(360, 5, 5) == 0
+
+
+def test_server_totals_sum_packages_and_gpus():
+    lines = []
+    for (t, watts) in enumerate([(10, 20), (30, 40), (0, 0)]):
+        ts = t * 10 * 10**9
+        for (package, w) in enumerate(watts):
+            lines.append(f"powerstat_package,{SERVER},package_id={package} current_power_consumption_watts={w},"
+                f"current_dram_power_consumption_watts=1 {ts}")
+            lines.append(f"nvidia_smi,{SERVER},index={package} power_draw={w} {ts + 1}")
+    out = [parse_line(line) for line in stream(lines)]
+    cpu = [(m[3], m[2]["cpu_energy_consumption_joules"]) for m in out if "cpu_energy_consumption_joules" in m[2]]
+    ten_seconds = energy_joules(1, 0, 10 * 10**9)
+    assert cpu == [(0, pytest.approx((11 + 21) * ten_seconds)), (10 * 10**9, pytest.approx((31 + 41) * ten_seconds))]
+    assert all("cpu" not in m[1] and "index" not in m[1] for m in out)
+    per_device = [parse_line(line) for line in stream(lines, per_device=True)]
+    assert {m[1].get("cpu") for m in per_device if "cpu_energy_consumption_joules" in m[2]} == {"0", "1"}
+
+
+def test_cpu_parts_in_separate_lines():
+    lines = [
+        f"powerstat_package,{SERVER},package_id=0 current_power_consumption_watts=10 0",
+        f"powerstat_package,{SERVER},package_id=0 current_dram_power_consumption_watts=2 0",
+        f"powerstat_package,{SERVER},package_id=0 current_power_consumption_watts=10,current_dram_power_consumption_watts=2 {10**10}",
+    ]
+    (metric,) = [parse_line(line) for line in stream(lines, per_device=True)]
+    assert metric[2] == {"cpu_energy_consumption_joules": pytest.approx(energy_joules(12, 0, 10**10))}
+
+
+def test_process_batch_matches_process():
+    lines = ticks(shuffle=random.Random(3))
+    engine = EnergyIntegrator()
+    batched = []
+    for start in range(0, len(lines), 50):
+        batched += engine.process_batch(parse_lines("\n".join(lines[start:start + 50])))
+    batched += [format_line(*metric) for metric in engine.flush()]
+    assert batched == stream(lines)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"method": "trapezoid"}, {"per_device": True}])
+def test_replay_matches_stream(tmp_path, kwargs):
+    lines = ticks()
+    (result, engine) = replay(tmp_path, [lines], window=4096, **kwargs)
+    assert engine.vectorized
+    assert result == stream(lines, **kwargs)
+
+
+def test_replay_of_several_files_with_shuffled_ticks(tmp_path):
+    lines = ticks(shuffle=random.Random(1))
+    (result, engine) = replay(tmp_path, [lines[:100], [], lines[100:]])
+    assert engine.vectorized
+    assert result == stream(lines)
+
+
+def test_replay_falls_back_to_stream_for_decreasing_timestamps(tmp_path):
+    lines = list(reversed(ticks()))
+    (result, engine) = replay(tmp_path, [lines])
+    assert not engine.vectorized
+    assert result == stream(lines)
+
+
+def test_replay_skips_what_the_stream_skips(tmp_path):
+    lines = ticks()
+    gpu = f"nvidia_smi,{SERVER},index=0"
+    for (i, odd) in enumerate(["# a comment", "", "garbage", f"{gpu} power_draw=1e999 1700000000000000001",
+            f"{gpu} power_draw=inf 1700000000000000001", f"{gpu} power_draw=12.5", f'{gpu} power_draw=3i,note="a b" 1700000000000000003']):
+        lines.insert(5 + 7 * i, odd)
+    (result, engine) = replay(tmp_path, [lines])
+    assert result == stream(lines)
+    assert engine.invalid == 3
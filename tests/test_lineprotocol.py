@@ -0,0 +1,93 @@
+import pytest
+
+from nadiki_lineprotocol import (LineProtocolError, Unsigned, format_line, format_value, is_skipped,
+    parse_line, parse_lines)
+
+
+def test_parse_simple_line():
+    assert parse_line("cpu,host=a,cpu=0 usage=1.5,count=3i 1700000000000000000\n") == \
+        ("cpu", {"host": "a", "cpu": "0"}, {"usage": 1.5, "count": 3}, 1700000000000000000)
+
+
+def test_parse_without_timestamp():
+    assert parse_line("cpu value=1") == ("cpu", {}, {"value": 1.0}, None)
+
+
+def test_escaped_names_round_trip():
+    metric = ("my measurement,x", {"tag key": "a,b=c", "name": "NVIDIA A100"},
+        {"field=key": 1.0, "text": 'say "hi" \\ bye'}, 5)
+    line = format_line(*metric)
+    assert line == ('my\\ measurement\\,x,tag\\ key=a\\,b\\=c,name=NVIDIA\\ A100 '
+        'field\\=key=1.0,text="say \\"hi\\" \\\\ bye" 5')
+    assert parse_line(line) == metric
+
+
+def test_string_field_with_spaces_and_commas():
+    assert parse_line('m,t=x s="a b,c=d",v=2 7') == ("m", {"t": "x"}, {"s": "a b,c=d", "v": 2.0}, 7)
+
+
+@pytest.mark.parametrize("raw,value", [("1.5", 1.5), ("-2i", -2), ("t", True), ("FALSE", False), ("1e3", 1000.0)])
+def test_typed_values(raw, value):
+    fields = parse_line(f"m v={raw} 1")[2]
+    assert fields["v"] == value
+    assert type(fields["v"]) is type(value)
+
+
+def test_untyped_values_drop_the_integer_suffix():
+    assert parse_line('m a=3i,b=4u,c=1.5,d="x y" 1', typed=False)[2] == {"a": "3", "b": "4", "c": "1.5", "d": "x y"}
+
+
+def test_unsigned_round_trip():
+    (measurement, tags, fields, ts) = parse_line("snmp,host=a ifHCInOctets=18446744073709551615u,errors=2i 1")
+    assert type(fields["ifHCInOctets"]) is Unsigned
+    assert fields["ifHCInOctets"] == 2**64 - 1
+    assert type(fields["errors"]) is int
+    assert format_line(measurement, tags, fields, ts) == "snmp,host=a ifHCInOctets=18446744073709551615u,errors=2i 1"
+
+
+def test_unsigned_arithmetic_is_plain_int():
+    assert type(Unsigned(5) - Unsigned(3)) is int
+    assert format_value(Unsigned(5) - Unsigned(3)) == "2i"
+
+
+@pytest.mark.parametrize("line", ["m v=inf 1", "m v=-inf 1", "m v=nan 1", "m v=1e999 1", "m v=-1u 1"])
+def test_non_finite_and_negative_unsigned_values_are_rejected(line):
+    with pytest.raises(LineProtocolError):
+        parse_line(line)
+
+
+def test_format_drops_non_finite_fields():
+    assert format_line("m", {}, {"a": float("nan"), "b": 2.5}, 1) == "m b=2.5 1"
+    with pytest.raises(ValueError):
+        format_value(float("inf"))
+    with pytest.raises(LineProtocolError):
+        format_line("m", {}, {"a": float("inf")}, 1)
+
+
+def test_format_skips_empty_tags():
+    assert format_line("m", {"a": "", "b": None, "c": "x"}, {"v": 1}) == "m,c=x v=1i"
+
+
+def test_format_values():
+    assert format_value(True) == "true"
+    assert format_value(3) == "3i"
+    assert format_value(0.1) == "0.1"
+    assert format_value('a"b') == '"a\\"b"'
+
+
+@pytest.mark.parametrize("line", ["garbage", "m", "m v= 1", ",t=x v=1 1", "m v=1 notatime", 'm s="open 1'])
+def test_invalid_lines(line):
+    with pytest.raises(LineProtocolError):
+        parse_line(line)
+
+
+def test_parse_lines_skips_comments_and_empty_lines():
+    buffer = b"# comment\n\ncpu v=1 1\n   \ncpu v=2 2\n"
+    assert [m[3] for m in parse_lines(buffer)] == [1, 2]
+    assert is_skipped("# comment\n") and is_skipped("\n") and is_skipped("") and not is_skipped("cpu v=1 1\n")
+
+
+def test_parse_lines_strict_and_lenient():
+    with pytest.raises(LineProtocolError):
+        parse_lines("cpu v=1 1\ngarbage\n")
+    assert len(parse_lines("cpu v=1 1\ngarbage\ncpu v=2 2\n", strict=False)) == 2
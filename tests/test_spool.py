@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+
+from nadiki_spool import Spool, _ACK
+
+
+def spool_files(directory):
+    return sorted(os.listdir(directory))
+
+
+def fill(directory, count, segment_size=200):
+    # spool count batches while the sender fails, they stay on disk
+    spool = Spool(str(directory), lambda batch: False, concurrency=1, segment_size=segment_size,
+        fsync="always", retry_interval=0.01)
+    spool.start()
+    for i in range(count):
+        assert spool.append(f"s{i % 2}", b"%03d" % i + b"x" * 60, 1)
+    spool.close(timeout=0.1)
+    return spool
+
+
+def test_recovery_replays_unacknowledged_batches_in_order(tmp_path):
+    fill(tmp_path, 6)
+    sent = []
+    spool = Spool(str(tmp_path), lambda batch: sent.append(batch.encode()[:3]) or True, concurrency=1)
+    assert spool.backlog() == 6
+    spool.start()
+    spool.close(timeout=5)
+    assert sent == [b"%03d" % i for i in range(6)]
+    assert spool_files(tmp_path) == []
+
+
+def test_acknowledged_batches_are_not_sent_again(tmp_path):
+    fill(tmp_path, 4, segment_size=10**6)
+    # the first two batches of the only segment were accepted before the process died
+    (segment,) = [name for name in spool_files(tmp_path) if name.endswith(".wal")]
+    with open(tmp_path / segment, "rb") as f:
+        data = f.read()
+    second = data.index(b"001x")
+    with open(tmp_path / segment.replace(".wal", ".ack"), "wb") as f:
+        f.write(_ACK.pack(0) + _ACK.pack(data.rindex(b"NSP1", 0, second)))
+    spool = Spool(str(tmp_path), lambda batch: True)
+    assert spool.backlog() == 2
+
+
+def test_incomplete_record_is_truncated(tmp_path):
+    fill(tmp_path, 2, segment_size=10**6)
+    (segment,) = [name for name in spool_files(tmp_path) if name.endswith(".wal")]
+    size = os.path.getsize(tmp_path / segment)
+    with open(tmp_path / segment, "ab") as f:
+        f.write(b"NSP1\x10")
+    spool = Spool(str(tmp_path), lambda batch: True)
+    assert spool.backlog() == 2
+    assert os.path.getsize(tmp_path / segment) == size
+
+
+def test_orphan_ack_does_not_mark_new_records(tmp_path):
+    # an ack left behind by a crash while its segment was deleted, in an otherwise empty
+    # directory the first segment would get its number again
+    with open(tmp_path / "spool-000000000001.ack", "wb") as f:
+        f.write(_ACK.pack(0))
+    spool = Spool(str(tmp_path), lambda batch: False, concurrency=1, retry_interval=0.01)
+    spool.start()
+    assert spool.active == 2
+    assert "spool-000000000001.ack" not in spool_files(tmp_path)
+    spool.append("s", b"body", 1)
+    spool.close(timeout=0)
+    # the new record is still pending after a restart
+    assert Spool(str(tmp_path), lambda batch: True).backlog() == 1
+
+
+def test_segment_numbers_are_not_reused(tmp_path):
+    fill(tmp_path, 6)
+    highest = max(int(name[6:18]) for name in spool_files(tmp_path))
+    spool = Spool(str(tmp_path), lambda batch: True)
+    assert spool.active == highest + 1
+
+
+def test_drop_oldest_when_full(tmp_path):
+    spool = Spool(str(tmp_path), lambda batch: False, concurrency=1, segment_size=100, max_size=300,
+        drop_policy="drop-oldest", retry_interval=0.01)
+    spool.start()
+    for i in range(10):
+        assert spool.append("s", b"x" * 60, 1)
+    assert spool.size() <= 300
+    assert spool.dropped_rows > 0
+    spool.close(timeout=0)
+
+
+def test_drop_newest_when_full(tmp_path):
+    spool = Spool(str(tmp_path), lambda batch: False, concurrency=1, segment_size=100, max_size=300,
+        drop_policy="drop-newest", retry_interval=0.01)
+    spool.start()
+    results = [spool.append("s", b"x" * 60, 1) for _ in range(10)]
+    assert results[0] and not results[-1]
+    spool.close(timeout=0)
+
+
+def test_max_rate_throttles_only_the_replay(tmp_path):
+    fill(tmp_path, 3, segment_size=10**6)
+    sent = threading.Event()
+    spool = Spool(str(tmp_path), lambda batch: True, concurrency=1, max_rate=100)
+    spool.start()
+    start = time.monotonic()
+    spool.close(timeout=10)
+    # three records of about 83 bytes at 100 bytes per second
+    assert time.monotonic() - start > 1.5
+
+    live = Spool(str(tmp_path / "live"), lambda batch: sent.set() or True, concurrency=1, max_rate=1)
+    live.start()
+    for _ in range(3):
+        live.append("s", b"x" * 60, 1)
+    start = time.monotonic()
+    live.close(timeout=10)
+    assert sent.is_set()
+    assert time.monotonic() - start < 1